@@ -170,6 +170,24 @@ void* memcpy(void* restrict destination, const void* restrict source, size_t len
   return destination;
 }
 
+// the regions may overlap, so copy forward if the destination is before the source, otherwise backward, then each byte is read before it is overwritten
+__attribute__ ((noinline))
+void* memmove(void* destination, const void* source, size_t len) {
+  uint8_t* destination_ptr = (uint8_t*) destination;
+  uint8_t* source_ptr = (uint8_t*) source;
+  if (destination_ptr <= source_ptr) {
+    while (len-- > 0)
+      *destination_ptr++ = *source_ptr++;
+  }
+  else {
+    destination_ptr += len;
+    source_ptr += len;
+    while (len-- > 0)
+      *--destination_ptr = *--source_ptr;
+  }
+  return destination;
+}
+
 __attribute__ ((noinline))
 void* memset(void* restrict in, int c, size_t len) {
   uint8_t* in_ptr = (uint8_t*)in;
@@ -48,6 +48,11 @@ int verbose = 0;
 #define num_hash_bytes (num_hash_bits+7)/8
 #define num_balance_bytes (num_balance_bits+7)/8
 
+// bytes per hash by the depth where a node's edge starts, must match hash_length_schedule in merkle_token.py
+// a node's hash is truncated to this wherever it is used: as a proof hash, hashed into its parent, or as the root at depth 0
+// e.g. for 16-byte hashes above depth 16, and full hashes below: #define hash_length(depth) ((depth)<16 ? 16 : num_hash_bytes)
+#define hash_length(depth) num_hash_bytes
+
 
 // pointers related to merkle proofs, init to 0 otherwise linker has errors
 uint8_t *proof_hashes = 0;
@@ -57,10 +62,104 @@ uint8_t *balances_new = 0;
 uint8_t *opcodes = 0;
 uint8_t *address_chunks = 0;
 
+// packed calldata starts with a zero byte then this version, see pack_calldata() in merkle_token_tools.py
+#define packed_calldata_version 1
+int packed = 0;
+
+// index of the next opcode, in packed calldata opcodes are two bits each, four per byte with the first opcode in the highest bits
+uint32_t opcode_idx = 0;
+
+// read an unsigned LEB128 varint and advance the pointer past it
+uint32_t read_varint(uint8_t **ptr){
+  uint32_t value = 0;
+  for (int shift=0; ; shift+=7){
+    uint8_t byte = **ptr;
+    (*ptr)++;
+    value |= (uint32_t)(byte&0x7f)<<shift;
+    if (byte < 0x80)
+      return value;
+  }
+}
+
+// section lengths are four bytes little-endian, or a varint in packed calldata
+uint32_t read_section_length(uint8_t **ptr){
+  if (packed)
+    return read_varint(ptr);
+  uint32_t length = *(uint32_t*)*ptr;
+  *ptr += 4;
+  return length;
+}
+
+uint8_t get_next_opcode(void){
+  uint8_t opcode;
+  if (packed)
+    opcode = (opcodes[opcode_idx/4] >> (6-2*(opcode_idx%4))) & 3;
+  else
+    opcode = opcodes[opcode_idx];
+  opcode_idx++;
+  return opcode;
+}
+
 // this is input to blake2b to hash the leaf, declare here for convenience
 uint64_t leaf_buffer[] = {0,0,0,0,0,0};
 uint64_t *leaf_buffer_balance = (uint64_t*)(((uint8_t*)leaf_buffer)+num_address_bytes);
 
+// if the calldata has no addresses, they are rebuilt during merkleization
+// the bits of the path to the current node are written into the address in leaf_buffer, so at a leaf it holds the leaf's address
+int rebuild_addresses = 0;
+// in packed calldata, the address chunk bits are after all of the chunk lengths
+uint8_t *address_chunk_bits = 0;
+uint32_t address_chunk_bit_idx = 0;
+
+void set_address_bit(int depth, int bit){
+  uint8_t *address = (uint8_t*)leaf_buffer;
+  if (bit)
+    address[depth/8] |= 0x80>>(depth%8);
+  else
+    address[depth/8] &= ~(0x80>>(depth%8));
+}
+
+// returns the bit length of the next address chunk, and if addresses are rebuilt, writes its bits into the address starting at depth
+// in packed calldata, the lengths are varints of num_address_bits minus the bit length
+int get_next_address_chunk(int depth){
+  int addy_chunk_bit_length;
+  uint8_t *bits;
+  uint32_t bit_idx;
+  if (packed){
+    addy_chunk_bit_length = num_address_bits - read_varint(&address_chunks);
+    bits = address_chunk_bits;
+    bit_idx = address_chunk_bit_idx;
+    address_chunk_bit_idx += addy_chunk_bit_length;
+  }
+  else {
+    // the bits are right-aligned in big-endian bytes
+    addy_chunk_bit_length = *address_chunks;
+    bits = address_chunks+1;
+    bit_idx = (addy_chunk_bit_length+7)/8*8 - addy_chunk_bit_length;
+    address_chunks += 1 + (addy_chunk_bit_length+7)/8;
+  }
+  if (rebuild_addresses)
+    for (int i=0; i<addy_chunk_bit_length; i++, bit_idx++)
+      set_address_bit(depth+i, (bits[bit_idx/8] >> (7-bit_idx%8)) & 1);
+  return addy_chunk_bit_length;
+}
+
+
+// hash the children in a stack item for the old root, and also for the new root if a balance under them changed, otherwise copy
+// the children's edges start at depth+1, so each child hash is truncated to hash_length(depth+1) by moving the right child next to the truncated left child
+void hash_old_and_new(uint8_t *old_hash_output_ptr, uint8_t *new_hash_output_ptr, uint8_t *hash_stack_ptr, int dirty, int depth){
+  int length = hash_length(depth+1);
+  if (length != num_hash_bytes){
+    memmove(hash_stack_ptr+length, hash_stack_ptr+20, length);
+    memmove(hash_stack_ptr+40+length, hash_stack_ptr+60, length);
+  }
+  blake2b( old_hash_output_ptr, num_hash_bytes, hash_stack_ptr, length*2, NULL, 0 );
+  if (dirty)
+    blake2b( new_hash_output_ptr, num_hash_bytes, hash_stack_ptr+40, length*2, NULL, 0 );
+  else
+    memcpy(new_hash_output_ptr,old_hash_output_ptr,num_hash_bytes);
+}
+
 
 /*
 This function does all of the merklization, in a single-pass, of both old and new root.
@@ -75,70 +174,82 @@ data:         | old hash left | old hash right | new hash left | new hash right
 The hash output is put in indices to the left of this stack item, i.e. in its parent's stack item.
 
 leftFlag is 1 if this function is called on the left child, and 0 if right.
+
+Returns 1 if a balance under this node changed, otherwise the old and new hashes are equal, so the hash is computed once and copied.
 */
-void merkleize_new_and_old_root(int depth, uint8_t *hash_stack_ptr, int leftFlag){
+int merkleize_new_and_old_root(int depth, uint8_t *hash_stack_ptr, int leftFlag){
   // compute the offset to put the resulting hash for this node
   uint8_t* old_hash_output_ptr = hash_stack_ptr - (leftFlag?80:60);
   uint8_t* new_hash_output_ptr = hash_stack_ptr - (leftFlag?40:20);
   // if we are at a leaf, then hash it and return
   if (depth == num_address_bits){
-    // fill buffer with address
-    memcpy(leaf_buffer,addresses,num_address_bytes);
+    // fill buffer with address, unless it was already rebuilt along the path
+    if (!rebuild_addresses){
+      memcpy(leaf_buffer,addresses,num_address_bytes);
+      addresses += num_address_bytes;
+    }
     //memcpy(leaf_buffer+num_address_bytes,balances_old,num_balance_bytes);
     memcpy(leaf_buffer_balance,balances_old,num_balance_bytes);
     blake2b( old_hash_output_ptr, num_hash_bytes, leaf_buffer, num_address_bytes+num_balance_bytes, NULL, 0 );
-    // fill buffer with new value, then hash
-    memcpy(leaf_buffer_balance,balances_new,num_balance_bytes);
-    blake2b( new_hash_output_ptr, num_hash_bytes, leaf_buffer, num_address_bytes+num_balance_bytes, NULL, 0 );
-    // increment pointers to next address and next balances
-    addresses += num_address_bytes;
+    // fill buffer with new value, then hash, unless the balance is unchanged
+    int dirty = memcmp(balances_old,balances_new,num_balance_bytes) != 0;
+    if (dirty){
+      memcpy(leaf_buffer_balance,balances_new,num_balance_bytes);
+      blake2b( new_hash_output_ptr, num_hash_bytes, leaf_buffer, num_address_bytes+num_balance_bytes, NULL, 0 );
+    }
+    else
+      memcpy(new_hash_output_ptr,old_hash_output_ptr,num_hash_bytes);
+    // increment pointers to next balances
     balances_old += num_balance_bits/8;
     balances_new += num_balance_bits/8;
-    return;
+    return dirty;
   }
-  uint8_t opcode = *opcodes;
-  opcodes++;
-  uint8_t addy_chunk_bit_length, addy_chunk_byte_length;
+  uint8_t opcode = get_next_opcode();
+  int addy_chunk_bit_length;
+  int dirty = 0;
   switch (opcode){
     case 0:
       // get address chunk
-      addy_chunk_bit_length = *address_chunks;
-      addy_chunk_byte_length = (addy_chunk_bit_length+7)/8;
-      address_chunks += 1 + addy_chunk_byte_length;
+      addy_chunk_bit_length = get_next_address_chunk(depth);
       // recurse with updated depth, same hash_stack_ptr and leftFlag
-      merkleize_new_and_old_root(depth+addy_chunk_bit_length, hash_stack_ptr, leftFlag);
-      break;
+      return merkleize_new_and_old_root(depth+addy_chunk_bit_length, hash_stack_ptr, leftFlag);
     case 1:
       // recurse on right
-      merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 0);
+      if (rebuild_addresses)
+        set_address_bit(depth, 1);
+      dirty = merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 0);
       // get hash from calldata, put in in both old and new left slots
-      memcpy(hash_stack_ptr,proof_hashes,num_hash_bytes);
-      memcpy(hash_stack_ptr+40,proof_hashes,num_hash_bytes);
-      proof_hashes += num_hash_bytes;
+      memcpy(hash_stack_ptr,proof_hashes,hash_length(depth+1));
+      memcpy(hash_stack_ptr+40,proof_hashes,hash_length(depth+1));
+      proof_hashes += hash_length(depth+1);
       // finally hash old and new
-      blake2b( old_hash_output_ptr, num_hash_bytes, hash_stack_ptr, num_hash_bytes*2, NULL, 0 );
-      blake2b( new_hash_output_ptr, num_hash_bytes, hash_stack_ptr+40, num_hash_bytes*2, NULL, 0 );
-        break;
+      hash_old_and_new(old_hash_output_ptr, new_hash_output_ptr, hash_stack_ptr, dirty, depth);
+      break;
     case 2:
       // recurse on left
-      merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 1);
+      if (rebuild_addresses)
+        set_address_bit(depth, 0);
+      dirty = merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 1);
       // get hash from calldata, put in in both old and new right slots
-      memcpy(hash_stack_ptr+20,proof_hashes,num_hash_bytes);
-      memcpy(hash_stack_ptr+20+40,proof_hashes,num_hash_bytes);
-      proof_hashes += num_hash_bytes;
+      memcpy(hash_stack_ptr+20,proof_hashes,hash_length(depth+1));
+      memcpy(hash_stack_ptr+20+40,proof_hashes,hash_length(depth+1));
+      proof_hashes += hash_length(depth+1);
       // finally hash old and new
-      blake2b( old_hash_output_ptr, num_hash_bytes, hash_stack_ptr, num_hash_bytes*2, NULL, 0 );
-      blake2b( new_hash_output_ptr, num_hash_bytes, hash_stack_ptr+40, num_hash_bytes*2, NULL, 0 );
+      hash_old_and_new(old_hash_output_ptr, new_hash_output_ptr, hash_stack_ptr, dirty, depth);
       break;
     case 3:
       // recurse both left and right
-      merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 1);
-      merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 0);
+      if (rebuild_addresses)
+        set_address_bit(depth, 0);
+      dirty = merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 1);
+      if (rebuild_addresses)
+        set_address_bit(depth, 1);
+      dirty |= merkleize_new_and_old_root(depth+1, hash_stack_ptr+80, 0);
       // hash what was returned
-      blake2b( old_hash_output_ptr, num_hash_bytes, hash_stack_ptr, num_hash_bytes*2, NULL, 0 );
-      blake2b( new_hash_output_ptr, num_hash_bytes, hash_stack_ptr+40, num_hash_bytes*2, NULL, 0 );
+      hash_old_and_new(old_hash_output_ptr, new_hash_output_ptr, hash_stack_ptr, dirty, depth);
       break;
   }
+  return dirty;
 }
 
 
@@ -161,26 +272,55 @@ void _main(void){
   eth2_loadPreStateRoot((uint32_t*)pre_state_root);
 
   // parse calldata into pointers
+  // header, the number of bytes per hash must match what this contract was compiled for
+  if (calldata[0] == 0){
+    packed = 1;
+    if (calldata[1] != packed_calldata_version)
+      return; // error, revert
+    calldata += 2;
+    if (read_varint(&calldata) != num_hash_bytes)
+      return; // error, revert
+  }
+  else {
+    if (*(uint32_t*)calldata != num_hash_bytes)
+      return; // error, revert
+    calldata += 4;
+  }
   // proof hashes
-  uint32_t proof_hashes_length = *(uint32_t*)calldata;
-  proof_hashes = calldata+4;
-  calldata += 4 + proof_hashes_length;
-  // proof addresses
-  uint32_t addresses_length = *(uint32_t*)calldata;
-  addresses = calldata+4;
-  calldata += 4 + addresses_length;
+  uint32_t proof_hashes_length = read_section_length(&calldata);
+  proof_hashes = calldata;
+  calldata += proof_hashes_length;
+  // proof addresses, if empty then they are rebuilt during merkleization
+  uint32_t addresses_length = read_section_length(&calldata);
+  addresses = calldata;
+  calldata += addresses_length;
+  rebuild_addresses = addresses_length == 0;
   // balances
-  uint32_t balances_length = *(uint32_t*)calldata;
-  balances_old = calldata+4;
-  calldata += 4 + balances_length;
-  // opcodes
-  uint32_t opcodes_length = *(uint32_t*)calldata;
-  opcodes = calldata+4;
-  calldata += 4 + opcodes_length;
+  uint32_t balances_length = read_section_length(&calldata);
+  balances_old = calldata;
+  calldata += balances_length;
+  // transactions
+  uint32_t transactions_length = read_section_length(&calldata);
+  calldata += transactions_length;
+  // opcodes, packed opcodes start with the number of opcodes
+  uint32_t opcodes_length = read_section_length(&calldata);
+  opcodes = calldata;
+  calldata += opcodes_length;
+  uint32_t num_opcodes = 0;
+  if (packed)
+    num_opcodes = read_varint(&opcodes);
   // address_chunks
-  uint32_t address_chunks_length = *(uint32_t*)calldata;
-  address_chunks = calldata+4;
-  calldata += 4 + address_chunks_length;
+  uint32_t address_chunks_length = read_section_length(&calldata);
+  address_chunks = calldata;
+  calldata += address_chunks_length;
+  // packed address chunk bits are after a length for each 00 opcode
+  if (packed && rebuild_addresses){
+    address_chunk_bits = address_chunks;
+    for (uint32_t i=0; i<num_opcodes; i++)
+      if (get_next_opcode() == 0)
+        read_varint(&address_chunk_bits);
+    opcode_idx = 0;
+  }
 
   // verify transactions
   // TODO
@@ -194,12 +334,12 @@ void _main(void){
   uint8_t* hash_stack_ptr = malloc(10000); // 10,000 bytes is bigger than needed for depth 50 tree
   merkleize_new_and_old_root(0, hash_stack_ptr+80, 1);
 
-  // update hash, hash_stack_ptr+40 should correspond to new merkle root hash
-  for (int i=0; i<20; i++)
+  // update hash, hash_stack_ptr+40 should correspond to new merkle root hash, truncated since the root's edge starts at depth 0
+  for (int i=0; i<hash_length(0); i++)
     post_state_root[i] = hash_stack_ptr[40+i];
 
   // verify prestate against old merkle root hash
-  for (int i=0; i<20; i++){
+  for (int i=0; i<hash_length(0); i++){
     if (hash_stack_ptr[i] != pre_state_root[i]){
     //  return; // error, revert
     }
@@ -1,19 +1,34 @@
-
+import collections
 import hashlib
 
+import merkle_token_ed25519
+
+# numpy is optional, it executes large blocks of transactions with array operations instead of a loop
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 ##################
 # Host Interface #
 ##################
 
 _state_root = ''
+# with delta_witnesses, the post-state hashes known from the last verified proof, stored with the root they belong to, see Verifier.known_hashes
+_known_hashes = {}
 
 def get_state_root():
   return _state_root
 
-def set_state_root(new_state_root):
-  global _state_root
+def get_known_hashes():
+  return _known_hashes
+
+# setting the root alone forgets the known hashes, so back references to them fail until a full proof is verified
+def set_state_root(new_state_root, known_hashes=None):
+  global _state_root, _known_hashes
   _state_root = new_state_root
+  _known_hashes = known_hashes or {}
 
 def finish():
   print("Contract call ended manually, final state root is",_state_root)
@@ -27,6 +42,9 @@ def finish():
 # contract code #
 #################
 
+# flip this flag if you want each node printed, by merkle_token_profile.InstrumentedVerifier, the Verifier itself doesn't print
+verbose = 0
+
 # Some constants
 num_address_bits=160
 num_hash_bits=160
@@ -38,18 +56,59 @@ num_hash_bytes = (num_hash_bits+7)//8
 num_transaction_bytes=105
 num_transaction_bits=num_transaction_bytes*8
 
-# some global variables
-old_state_root = ''
-transactions = []	# list of signed messages
-balances = []		# list of balances
-new_balances = []	# list of updated
-address_chunks = []	# fragments of the address
-proof_hashes = []	# list of merkle hashes
-tree_encoding = []	# encoding of the tree structure
-signatures = []		# list of signatures, each for a balance transfer
-recovered_addresses = []# list of address
-
-# hash function
+# blocks with at least this many transactions are executed with numpy if it is available, below this numpy's overhead per call isn't worth it, None is never
+# measured with merkle_token_tools.benchmark_transaction_execution(), numpy is ahead from 256 transactions, and about twice as fast from 1000, and even or behind below 128
+bulk_execution_threshold = 256
+
+if numpy is not None:
+  # a transaction record as a numpy dtype, see Verifier.execute_transactions()
+  transaction_dtype = numpy.dtype([('sender','u1'), ('recipient','u1',(32,)), ('amount','<u8'), ('signature','u1',(64,))])
+
+# children per internal node, a power of two, 2 is the binary tree with opcodes, wider trees have child bitmaps, see kary_bitmaps()
+# wider trees have fewer levels to hash, but each level of a proof has more sibling hashes
+# num_address_bits must be a multiple of the bits per level, i.e. of log2(tree_arity)
+tree_arity = 2
+
+# bytes per hash by depth, a list of (depth, bytes per hash) in increasing order of depth, each used from its depth until the next one
+# None is num_hash_bytes at every depth
+# a node's hash is a blake2b digest of num_hash_bytes, which is truncated to the bytes per hash at the depth where the node's edge starts,
+#   i.e. one below its parent's branch, wherever it is used: as a proof hash, hashed into its parent, or as the root at depth 0
+# hashes near the root change often so are hard to attack in time, which may allow shorter hashes there, see Merkle Proof Sizes in the README
+hash_length_schedule = None
+
+# set this to a salt of up to 64 bytes to place each account in the tree at a salted hash of its address, its key, instead of at the address, see tree_key()
+# addresses can be chosen freely, e.g. by sending to them, so an attacker can pick addresses with long shared prefixes which make long paths, see Depth Attacks in the README
+# keys are spread evenly, so paths stay about log2 of the number of accounts long, and each level deeper than that costs an attacker about twice the hashes to find
+# leaves are hashed with their key in place of the address, and calldata must have the addresses section, in the order of the keys, each checked against its key
+# the C contract doesn't support this
+key_hash_salt = None
+
+# the key of an address, both raw big-endian bytes, a blake2b hash keyed with salt, e.g. key_hash_salt, truncated to num_address_bits
+def tree_key(address, salt, num_address_bits):
+  num_address_bytes = (num_address_bits+7)//8
+  key = int.from_bytes(hashlib.blake2b(address, digest_size=num_address_bytes, key=salt).digest(),'big')
+  return (key >> (8*num_address_bytes-num_address_bits)).to_bytes(num_address_bytes,'big')
+
+# flip this flag if you want main() to keep the hashes from each verified proof, so the next block's proof may back-reference them instead of repeating them
+# see proof_hash_keys() and Verifier.known_hashes, this is for serial verification of binary trees, and the C contract takes full proofs only
+delta_witnesses = 0
+
+# expands a hash length schedule to the bytes per hash at each depth from 0 to num_address_bits
+def hash_lengths(schedule, num_hash_bytes, num_address_bits):
+  lengths = [num_hash_bytes]*(num_address_bits+1)
+  previous_depth = -1
+  for depth, length in schedule or []:
+    if not previous_depth < depth <= num_address_bits or not 1 <= length <= num_hash_bytes:
+      raise ValueError("bad hash length schedule: "+str(schedule))
+    lengths[depth:] = [length]*(num_address_bits+1-depth)
+    previous_depth = depth
+  return tuple(lengths)
+
+# signature verification is pluggable, a signature verifier takes a list of (public key, message, signature) and returns whether all are valid
+# merkle_token_ed25519 has verify_each(), verify_batch(), and verify_batch_in_pool() which needs an executor bound with functools.partial()
+default_signature_verifier = merkle_token_ed25519.verify_batch
+
+# hash function, returns a hex string
 def hash_(to_hash):
   h = hashlib.blake2b(digest_size=(num_hash_bits+7)//8)
   if type(to_hash)==int:
@@ -59,172 +118,837 @@ def hash_(to_hash):
   #print("hash_() ",to_hash.hex()," ->", h.hexdigest())
   return h.hexdigest()
 
-
-# getters for address chunks, hash, balances, and address
-
-addychunk_idx=0
-def get_next_address_chunk():
-  global addychunk_idx
-  #print("get_next_address_chunk() addychunk_idx",addychunk_idx)
-  addychunk = address_chunks[addychunk_idx]
-  #print("get_next_address_chunk() addychunk_idx",addychunk_idx,"addychunk",addychunk)
-  addychunk_idx+=1
-  return addychunk
-  
-hash_idx=0
-def get_next_hash():
-  global hash_idx
-  hash__ = proof_hashes[hash_idx]
-  hash_idx+=1
-  return hash__
-
-old_balance_idx=0
-def get_next_old_balance():
-  global old_balance_idx
-  balance = balances[old_balance_idx]
-  old_balance_idx+=1
-  return balance
-
-new_balance_idx=0
-def get_next_new_balance():
-  global new_balance_idx
-  balance = new_balances[new_balance_idx]
-  new_balance_idx+=1
-  return balance
-
-address_idx=0
-def get_next_address():
-  global address_idx
-  address = recovered_addresses[address_idx]
-  address_idx+=1
-  return address
-
-
-# this recovers addresses by doing a single-pass through the tree encoding, consuming address chunks when needed
-opcode_idx=0
-def recover_addresses(address_prefix, depth):
-  # if leaf, append address
-  if depth == num_address_bits:
-    recovered_addresses.append(address_prefix)
-    return
-  # otherwise, process tree node based on the opcode
-  # "opcode" refers to a bit pair in the tree encoding
-  global opcode_idx
-  opcode = tree_encoding[opcode_idx]
-  opcode_idx+=1
-  if opcode == '11':
-    recover_addresses(address_prefix+'0',depth+1)
-    recover_addresses(address_prefix+'1',depth+1)
-  elif opcode == '10':
-    recover_addresses(address_prefix+'0', depth+1)
-  elif opcode == '01':
-    recover_addresses(address_prefix+'1', depth+1)
-  elif opcode == '00':
-    address_chunk = get_next_address_chunk()
-    recover_addresses(address_prefix+address_chunk, depth+len(address_chunk))
-
-# this is a single-pass to merkleize the old root and the new root
-# this should be called after addresses are recovered, and new balances are created from transactions
-def merklize_old_and_new_root(depth):
-  print("merklize_old_and_new_root(",depth,")")
-  # if leaf, hash it's address and value
-  if depth == num_address_bits:
-    print("merklize_old_and_new_root(",depth,")  leaf")
-    old_balance = get_next_old_balance()
-    new_balance = get_next_new_balance()
-    address = get_next_address()
-    return hash_(int(address+bin(old_balance)[2:].zfill(num_balance_bits),2)),\
-           hash_(int(address+bin(new_balance)[2:].zfill(num_balance_bits),2))
-  # otherwise, process the tree node, i.e. the opcode
-  global opcode_idx
-  opcode = tree_encoding[opcode_idx]
-  print("merklize_old_and_new_root(",depth,")  opcode",opcode)
-  opcode_idx+=1
-  if opcode == '11':
-    left_hash_old, left_hash_new = merklize_old_and_new_root(depth+1)
-    right_hash_old, right_hash_new = merklize_old_and_new_root(depth+1)
-    return hash_(int(left_hash_old+right_hash_old,16)), hash_(int(left_hash_new+right_hash_new,16))
-  elif opcode == '10':
-    left_hash_old, left_hash_new = merklize_old_and_new_root(depth+1)
-    right_hash = get_next_hash()
-    return hash_(int(left_hash_old+right_hash,16)),hash_(int(left_hash_new+right_hash,16))
-  elif opcode == '01':
-    right_hash_old, right_hash_new = merklize_old_and_new_root(depth+1)
-    left_hash = get_next_hash()
-    return hash_(int(left_hash+right_hash_old,16)),hash_(int(left_hash+right_hash_new,16))
-  elif opcode == '00':
-    address_chunk = get_next_address_chunk()
-    print("merklize_old_and_new_root(",depth,")  opcode address_chunk",opcode,address_chunk)
-    return merklize_old_and_new_root(depth+len(address_chunk))
-
-
-# verify all signatures for token transfers
-def verify_signature(sig):
-  # TODO
-  return True
-
-def  verify_signatures():
-  for sig in signatures:
-    if not verify_signature(sig):
-      finish()
-
-
-# apply balance transfer from each transaction, creating a list of new balances
-def execute_transactions():
-  global new_balances
-  new_balances = balances
-  # TODO
-
-# init calldata to global variables: transactions, balances, address chunks, proof hashes, tree encoding
-def decode_calldata(calldata):
-  # calldata is a dictionary for prot0typing, will later encode everything as a bytearray
-  global transactions
-  transactions = calldata["transactions"]
-  global balances
-  balances = calldata["balances"]
-  global address_chunks
-  address_chunks = calldata["address_chunks"]
-  global proof_hashes
-  proof_hashes = calldata["proof_hashes"]
-  global tree_encoding
-  tree_encoding = calldata["tree_encoding"]
-
-# init indices before each tree traversal
-def zero_global_indices():
-  global opcode_idx
-  global addychunk_idx
-  global address_idx
-  global new_balance_idx
-  global old_balance_idx
-  global hash_idx
+# a blake2b state for num_hash_bytes, parameterized once by init_hash_state(), which merkle_token_tools copies for each hash
+# the verifier has its own, see Verifier.hash_bytes()
+hash_state = hashlib.blake2b(digest_size=num_hash_bytes)
+def init_hash_state():
+  global hash_state
+  hash_state = hashlib.blake2b(digest_size=num_hash_bytes)
+
+
+# read an unsigned LEB128 varint, i.e. seven bits per byte with the lowest bits first and the high bit set on all but the last byte
+# returns the value and the index after it, and raises ValueError unless the varint is the shortest encoding of its value, so calldata is encoded one way only
+def read_varint(buf, idx):
+  value = 0
+  shift = 0
+  while True:
+    if idx >= len(buf):
+      raise ValueError("calldata is truncated in a varint")
+    byte = buf[idx]
+    idx += 1
+    value |= (byte&0x7f)<<shift
+    if byte < 0x80:
+      if byte == 0 and shift:
+        raise ValueError("varint is longer than needed")
+      return value, idx
+    shift += 7
+
+# packed calldata starts with a zero byte then this version, legacy calldata starts with the number of bytes per hash, which is never zero
+packed_calldata_version = 1
+
+# in packed calldata, opcodes are two bits each, four per byte with the first opcode in the highest bits
+# the section is a varint number of opcodes followed by the packed opcodes, padded with zero bits, this unpacks to one opcode per byte
+_unpacked_opcodes = [bytes([b>>6, (b>>4)&3, (b>>2)&3, b&3]) for b in range(256)]
+def unpack_opcodes(section):
+  num_opcodes, idx = read_varint(section, 0)
+  if len(section)-idx != (num_opcodes+3)//4:
+    raise ValueError("tree encoding length does not match its number of opcodes")
+  if num_opcodes%4 and section[-1] & ((1<<2*(-num_opcodes%4))-1):
+    raise ValueError("tree encoding padding bits are not zero")
+  return b''.join(map(_unpacked_opcodes.__getitem__, section[idx:]))[:num_opcodes]
+
+# in packed calldata, the address chunk section is a varint for each chunk of num_address_bits minus the chunk bit length, which is small for the long chunks above leaves
+# followed by the bits of all chunks back to back, big-endian, padded with zeros to a byte
+# this unpacks to the legacy layout: a byte with the bit length, then the bits as big-endian bytes
+def unpack_address_chunks(section, num_chunks, num_address_bits):
+  bit_lengths = []
+  idx = 0
+  for i in range(num_chunks):
+    value, idx = read_varint(section, idx)
+    if not 0 <= num_address_bits-value < 256:
+      raise ValueError("bad address chunk length")
+    bit_lengths.append(num_address_bits-value)
+  bits = section[idx:]
+  if (sum(bit_lengths)+7)//8 != len(bits):
+    raise ValueError("address chunk bits do not match their lengths")
+  if bits and bits[-1] & ((1<<(-sum(bit_lengths)%8))-1):
+    raise ValueError("address chunk padding bits are not zero")
+  unpacked = bytearray()
+  offset = 0
+  for bit_length in bit_lengths:
+    # the bytes which contain this chunk, then shift out the bits after it and mask the bits before it
+    end = offset+bit_length
+    chunk = int.from_bytes(bits[offset//8:(end+7)//8],'big') >> (-end%8)
+    unpacked.append(bit_length)
+    unpacked += (chunk&((1<<bit_length)-1)).to_bytes((bit_length+7)//8,'big')
+    offset = end
+  return unpacked
+
+# split binary calldata into its sections, checking that the sections exactly fill the calldata and agree with the tree encoding
+# legacy calldata is the number of bytes per hash in four bytes, then each section is a four byte length followed by the section, all little-endian
+# packed calldata is a zero byte, the version byte, the number of bytes per hash as a varint, then each section is a varint length followed by the section
+# sections are: proof hashes, addresses, balances, transactions, tree encoding, address chunks, and optionally back references
+#   back references are a bitmap with bit i, in byte i//8 from the lowest bit, set if the i-th proof hash is left out, see Verifier.get_next_proof_hash()
+#   calldata without the section, or with it empty, is a full proof
+# returns the number of bytes per hash, and the seven sections, which are memoryviews into calldata without copying
+#   except packed tree encoding and address chunks, which are unpacked to the legacy layout since they are small
+# schedule is a hash length schedule like hash_length_schedule, proof hashes are sized by it and the number of bytes per hash in the header
+# the other constants are passed in too, e.g. a Verifier's, so verifiers with different constants can parse at once
+# raises ValueError on malformed calldata, which the deployed contract would treat as a revert
+def parse_calldata(calldata, schedule, num_address_bits, num_balance_bytes, tree_arity):
+  num_address_bytes = (num_address_bits+7)//8
+  calldata = memoryview(calldata).cast('B')
+  if len(calldata) < 4:
+    raise ValueError("calldata is too short for the header")
+  packed = calldata[0] == 0
+  if packed:
+    if calldata[1] != packed_calldata_version:
+      raise ValueError("unsupported calldata version: "+str(calldata[1]))
+    hash_size, idx = read_varint(calldata, 2)
+  else:
+    hash_size, idx = int.from_bytes(calldata[0:4],'little'), 4
+  if not 1 <= hash_size <= 64:
+    raise ValueError("bad number of bytes per hash: "+str(hash_size))
+  sections = []
+  for i in range(7):
+    if i == 6 and idx == len(calldata):
+      sections.append(calldata[idx:])
+      break
+    if packed:
+      length, idx = read_varint(calldata, idx)
+    else:
+      if idx+4 > len(calldata):
+        raise ValueError("calldata is truncated at a section length")
+      length = int.from_bytes(calldata[idx:idx+4],'little')
+      idx += 4
+    if idx+length > len(calldata):
+      raise ValueError("section overruns the calldata")
+    sections.append(calldata[idx:idx+length])
+    idx += length
+  if idx != len(calldata):
+    raise ValueError("trailing bytes after the last section")
+  if packed:
+    # child bitmaps of wider trees are not packed
+    if tree_arity == 2:
+      sections[4] = unpack_opcodes(sections[4])
+      num_chunks = sections[4].count(0b00)
+    else:
+      num_chunks = kary_bitmaps(sections[4], tree_arity).count(0)
+    sections[5] = unpack_address_chunks(sections[5], num_chunks, num_address_bits)
+  proof_hashes_, addresses, balances_, transactions_, tree_encoding_, address_chunks_, back_references = sections
+  for section, item_size in ((addresses, num_address_bytes), (balances_, num_balance_bytes), (transactions_, num_transaction_bytes)):
+    if len(section) % item_size:
+      raise ValueError("section length is not a multiple of its item size")
+  # the opcodes determine the number of proof hashes, leaves, and address chunks
+  if tree_arity == 2:
+    opcode_counts = collections.Counter(tree_encoding_)
+    if opcode_counts and max(opcode_counts) > 0b11:
+      raise ValueError("bad opcode in tree encoding")
+    num_chunks = opcode_counts[0b00]
+    num_hashes = opcode_counts[0b10]+opcode_counts[0b01]
+    num_leaves = opcode_counts[0b11]+1 if tree_encoding_ else 0
+  else:
+    if schedule is not None:
+      raise ValueError("hash length schedules are only for binary trees")
+    num_chunks, num_hashes, num_leaves = kary_tree_counts(tree_encoding_, address_chunks_, tree_arity, num_address_bits)
+    if back_references:
+      raise ValueError("back references are only for binary trees")
+  if back_references:
+    if len(back_references) != (num_hashes+7)//8 or back_references[-1] >> (num_hashes-1)%8+1:
+      raise ValueError("back references do not match the number of proof hashes")
+  if schedule is None or not tree_encoding_:
+    num_references = bin(int.from_bytes(back_references,'little')).count('1')
+    proof_hashes_length = (num_hashes-num_references)*hash_size
+  else:
+    lengths = hash_lengths(schedule, hash_size, num_address_bits)
+    try:
+      depths = proof_hash_depths(tree_encoding_, address_chunks_, num_address_bits)
+      if back_references:
+        depths = [depth for i, depth in enumerate(depths) if not back_references[i>>3] >> (i&7) & 1]
+      proof_hashes_length = sum(map(lengths.__getitem__, depths))
+    except IndexError:
+      raise ValueError("tree encoding does not match the address chunks")
+  if len(proof_hashes_) != proof_hashes_length:
+    raise ValueError("number of proof hashes does not match the tree encoding")
+  if len(balances_) != num_leaves*num_balance_bytes:
+    raise ValueError("number of balances does not match the tree encoding")
+  if addresses and len(addresses) != num_leaves*num_address_bytes:
+    raise ValueError("number of addresses does not match the tree encoding")
+  idx = 0
+  for i in range(num_chunks):
+    if idx >= len(address_chunks_):
+      raise ValueError("fewer address chunks than in the tree encoding")
+    idx += 1+(address_chunks_[idx]+7)//8
+  if idx != len(address_chunks_):
+    raise ValueError("address chunks do not match the tree encoding")
+  return hash_size, sections
+
+# for trees wider than binary, the tree encoding is a sequence of child bitmaps, each (tree_arity+7)//8 bytes little-endian where bit i is child i
+#   a zero bitmap is an address chunk, like opcode 00
+#   otherwise it is an internal node's bitmap of present children, at least two, followed by its bitmap of children on paths to witness leaves, at least one
+#   each present child which is not on a path to a witness leaf has a proof hash, in the order the verifier reaches them, i.e. children in order, depth-first
+def kary_bitmaps(tree_encoding, tree_arity):
+  B = (tree_arity+7)//8
+  if len(tree_encoding) % B:
+    raise ValueError("tree encoding length is not a multiple of the bitmap size")
+  return [int.from_bytes(tree_encoding[i:i+B],'little') for i in range(0, len(tree_encoding), B)]
+
+# returns the number of address chunks, proof hashes, and leaves, and raises ValueError if the bitmaps are malformed
+# the tree is walked with the depth of each node, like Verifier.merklize_old_and_new_root_kary(), so this also checks that each address chunk,
+#   given in the legacy layout, ends on a level of the tree, and that the bitmaps end at the last leaf
+def kary_tree_counts(tree_encoding, address_chunks, tree_arity, num_address_bits):
+  bitmaps = kary_bitmaps(tree_encoding, tree_arity)
+  if not bitmaps:
+    return 0, 0, 0
+  bits_per_level = tree_arity.bit_length()-1
+  num_chunks = 0
+  num_hashes = 0
+  num_leaves = 0
+  idx = 0
+  addychunk_idx = 0
+  # depths of visited children still to walk
+  depths = [0]
+  while depths:
+    depth = depths.pop()
+    while depth < num_address_bits:
+      if idx == len(bitmaps):
+        raise ValueError("tree encoding ends before a leaf")
+      present = bitmaps[idx]
+      idx += 1
+      if present == 0:
+        if addychunk_idx >= len(address_chunks):
+          raise ValueError("fewer address chunks than in the tree encoding")
+        addychunk_bit_length = address_chunks[addychunk_idx]
+        addychunk_idx += 1+(addychunk_bit_length+7)//8
+        depth += addychunk_bit_length
+        if addychunk_bit_length == 0 or depth > num_address_bits or depth % bits_per_level:
+          raise ValueError("address chunk does not end on a level of the tree")
+        num_chunks += 1
+        continue
+      if idx == len(bitmaps):
+        raise ValueError("tree encoding ends before a bitmap of visited children")
+      visited = bitmaps[idx]
+      idx += 1
+      if present >> tree_arity or bin(present).count('1') < 2 or visited == 0 or visited & ~present:
+        raise ValueError("bad child bitmaps in tree encoding")
+      num_hashes += bin(present & ~visited).count('1')
+      depth += bits_per_level
+      depths += [depth]*(bin(visited).count('1')-1)
+    num_leaves += 1
+  if idx != len(bitmaps):
+    raise ValueError("tree encoding has bitmaps after the last leaf")
+  return num_chunks, num_hashes, num_leaves
+
+# the depth where each proof hash's edge starts, in the order of the proof hashes, by walking the tree encoding and address chunk lengths without hashing
+# proof hashes are in depth-first post-order, so the hash next to a child is after the child's subtree
+def proof_hash_depths(tree_encoding, address_chunks, num_address_bits):
+  depths = []
+  opcode_idx = 0
+  addychunk_idx = 0
+  # depths of right children still to visit, and ~depth for each proof hash after the subtree on top of it
+  stack = [0]
+  while stack:
+    depth = stack.pop()
+    if depth < 0:
+      depths.append(~depth)
+      continue
+    while depth < num_address_bits:
+      opcode = tree_encoding[opcode_idx]
+      opcode_idx += 1
+      if opcode == 0b11:
+        stack.append(depth+1)
+      elif opcode == 0b00:
+        addychunk_bit_length = address_chunks[addychunk_idx]
+        addychunk_idx += 1+(addychunk_bit_length+7)//8
+        depth += addychunk_bit_length-1
+      else:
+        stack.append(~(depth+1))
+      depth += 1
+  return depths
+
+# the key of each proof hash's node, in the order of the proof hashes, and the keys of all nodes below the root whose hashes a verifier knows after the proof
+#   i.e. the proof hashes' nodes and the nodes on paths to witness leaves, by walking the tree encoding and address chunks like proof_hash_depths()
+# a node's key is 1<<depth | prefix, where depth is where its edge starts and prefix is the int of the first depth bits of the addresses below it
+# the next block's proof may leave out the proof hashes whose keys are known, see Verifier.get_next_proof_hash()
+def proof_hash_keys(tree_encoding, address_chunks, num_address_bits):
+  keys = []
+  known_keys = set()
   opcode_idx = 0
-  address_index = 0
-  new_balance_idx = 0
-  old_balance_idx = 0
   addychunk_idx = 0
-  hash_idx = 0
-
-
-def main(calldata):
-  # initialize global variables
-  zero_global_indices()
-  decode_calldata(calldata)
-  # 1. Recover array of addresses
-  recover_addresses('',0)
-  # 2. verify all signatures
-  verify_signatures()
-  # 3. Build final balance array by executing all transactions, verifying no balance underflow.
-  execute_transactions()
-  # 4. Verify previous state root and compute new state root by traversing (b) (with (c), (d), (e), and balances computed in (2)).
-  zero_global_indices()
-  computed_hash_old,computed_hash_new = merklize_old_and_new_root(0)
-  # 5. If previous state root is verified, then update state root
+  # (depth, prefix) of right children still to visit, and (-1, key) for each proof hash after the subtree on top of it
+  stack = [(0, 0)]
+  while stack:
+    depth, prefix = stack.pop()
+    if depth < 0:
+      keys.append(prefix)
+      known_keys.add(prefix)
+      continue
+    while depth < num_address_bits:
+      opcode = tree_encoding[opcode_idx]
+      opcode_idx += 1
+      if opcode == 0b00:
+        addychunk_bit_length = address_chunks[addychunk_idx]
+        addychunk = int.from_bytes(address_chunks[addychunk_idx+1:addychunk_idx+1+(addychunk_bit_length+7)//8],'big')
+        addychunk_idx += 1+(addychunk_bit_length+7)//8
+        prefix = (prefix<<addychunk_bit_length)|addychunk
+        depth += addychunk_bit_length
+        continue
+      if opcode == 0b11:
+        stack.append((depth+1, (prefix<<1)|1))
+        known_keys.add((2<<depth)|(prefix<<1)|1)
+        prefix <<= 1
+      elif opcode == 0b10:
+        stack.append((-1, (2<<depth)|(prefix<<1)|1))
+        prefix <<= 1
+      else:
+        stack.append((-1, (2<<depth)|(prefix<<1)))
+        prefix = (prefix<<1)|1
+      depth += 1
+      known_keys.add((1<<depth)|prefix)
+  return keys, known_keys
+
+# the constants a Verifier is created with, from the module globals above, see Verifier.constants()
+def current_constants():
+  return num_address_bits, num_hash_bytes, num_balance_bytes, hash_length_schedule, tree_arity, key_hash_salt
+
+# the verifier holds the calldata being verified and the cursors into it, so blocks can be verified concurrently, each with its own Verifier
+# everything is kept as raw bytes, e.g. memoryviews into calldata, to avoid converting to and from hex strings and bit strings at each node
+# constants are read from the module globals above when the verifier is created, or given as a tuple from another verifier's constants()
+#   a worker process started by spawn or forkserver has the module globals as they are in this file, so work sent to it carries the constants
+class Verifier:
+  __slots__ = ('num_address_bits', 'num_address_bytes', 'num_hash_bytes', 'num_balance_bytes', 'hash_state', 'hash_length_schedule', 'hash_lengths', 'tree_arity',
+               'transactions', 'balances', 'new_balances', 'address_chunks', 'proof_hashes', 'tree_encoding', 'signatures', 'credits', 'recovered_addresses',
+               'addresses', 'key_hash_salt',
+               'signature_verifier', 'back_references', 'known_hashes', 'next_known_hashes',
+               'opcode_idx', 'addychunk_idx', 'hash_idx', 'old_balance_idx', 'new_balance_idx', 'proof_hash_slot')
+
+  def __init__(self, signature_verifier=None, constants=None):
+    num_address_bits, num_hash_bytes, num_balance_bytes, hash_length_schedule, tree_arity, key_hash_salt = constants or current_constants()
+    self.num_address_bits = num_address_bits
+    self.num_address_bytes = (num_address_bits+7)//8
+    self.num_hash_bytes = num_hash_bytes
+    self.num_balance_bytes = num_balance_bytes
+    # blake2b state parameterized once, copied for each hash
+    self.hash_state = hashlib.blake2b(digest_size=num_hash_bytes)
+    # bytes per hash by the depth where a node's edge starts
+    self.hash_length_schedule = hash_length_schedule
+    self.hash_lengths = hash_lengths(hash_length_schedule, num_hash_bytes, num_address_bits)
+    self.tree_arity = tree_arity
+    # None, or the salt of tree keys, see key_hash_salt
+    self.key_hash_salt = key_hash_salt
+    if tree_arity < 2 or tree_arity & (tree_arity-1) or num_address_bits % (tree_arity.bit_length()-1):
+      raise ValueError("tree_arity must be a power of two, with num_address_bits a multiple of its bits per level")
+    self.transactions = b''		# concatenated transactions, see execute_transactions()
+    self.balances = b''			# concatenated little-endian balances
+    self.new_balances = b''		# concatenated little-endian updated balances
+    self.address_chunks = b''		# fragments of the address, each is a byte with the bit length, then the bits as big-endian bytes
+    self.proof_hashes = b''		# concatenated raw merkle hashes
+    self.tree_encoding = b''		# encoding of the tree structure, one opcode per byte
+    self.signatures = []		# list of (sender index, signed part of the transaction, signature), one for each transaction
+    self.credits = {}			# amount transferred to each recipient address
+    self.recovered_addresses = bytearray()	# concatenated big-endian addresses, rebuilt during merkleization
+    self.addresses = b''		# concatenated big-endian addresses from the calldata, which may be empty, only read with key_hash_salt
+    self.signature_verifier = signature_verifier or default_signature_verifier
+    self.back_references = b''		# bitmap of proof hashes left out of the calldata, see get_next_proof_hash()
+    self.known_hashes = {}		# hashes by node key from the last verified proof, which back references are taken from, see proof_hash_keys()
+    self.next_known_hashes = None	# if a dict, the post-state hashes of this proof's nodes are recorded into it by key, for the next block's known_hashes
+    self.zero_indices()
+
+  def constants(self):
+    return self.num_address_bits, self.num_hash_bytes, self.num_balance_bytes, self.hash_length_schedule, self.tree_arity, self.key_hash_salt
+
+  # returns the post-state root as a hex string, given calldata and the pre-state root as a hex string
+  # raises ValueError if the calldata is malformed, a signature is invalid, or the calldata doesn't prove pre_root
+  def verify(self, calldata, pre_root):
+    self.zero_indices()
+    self.decode_calldata(calldata)
+    # 1. Build final balance array by executing all transactions, verifying no balance underflow.
+    self.execute_transactions()
+    # 2. Compute previous state root and new state root in a single pass over the tree encoding, which also recovers addresses.
+    # parse_calldata() checks that the counts of opcodes, chunks, hashes, and balances agree, but a binary tree's structure is only walked here
+    #   so calldata whose address chunks run past the leaves, or whose opcodes run out, is caught as an IndexError
+    try:
+      if self.tree_arity == 2:
+        computed_hash_old, computed_hash_new = self.merklize_old_and_new_root(0,0)
+      else:
+        computed_hash_old, computed_hash_new = self.merklize_old_and_new_root_kary(0,0)
+    except IndexError:
+      raise ValueError("tree encoding does not match the address chunks")
+    # 3. and 4.
+    return self.finish_verification(computed_hash_old, computed_hash_new, pre_root)
+
+  # the same as verify(), but the subtrees below the top split_levels levels of 11 opcodes are merkleized concurrently by executor
+  # executor is e.g. a concurrent.futures.ProcessPoolExecutor, each subtree is merkleized by merklize_subproof() in a worker
+  def verify_parallel(self, calldata, pre_root, executor, split_levels=2):
+    if self.tree_arity != 2:
+      raise ValueError("parallel merkleization is only for binary trees")
+    self.zero_indices()
+    self.decode_calldata(calldata)
+    if self.back_references or self.next_known_hashes is not None:
+      raise ValueError("delta witnesses are only for serial verification")
+    self.execute_transactions()
+    # pre-scan the top of the tree, collecting where each subtree below it starts in the calldata
+    # an IndexError, in the pre-scan, a worker, or the second walk, is malformed calldata, see verify()
+    try:
+      subproofs = []
+      self.merklize_top(0, 0, split_levels, subproofs, None)
+      # merkleize the subtrees concurrently
+      num_subproofs = len(subproofs)
+      results = executor.map(merklize_subproof, [calldata]*num_subproofs, [bytes(self.new_balances)]*num_subproofs, [self.credits]*num_subproofs, subproofs,
+                             [self.constants()]*num_subproofs)
+      # walk the top of the tree again, hashing it with the subtree hashes, which are in the same order
+      self.zero_indices()
+      self.recovered_addresses = bytearray()
+      computed_hash_old, computed_hash_new = self.merklize_top(0, 0, split_levels, None, iter(results))
+    except IndexError:
+      raise ValueError("tree encoding does not match the address chunks")
+    return self.finish_verification(computed_hash_old, computed_hash_new, pre_root)
+
+  # the checks after merkleization, returns the new state root as a hex string
+  def finish_verification(self, computed_hash_old, computed_hash_new, pre_root):
+    # the root's edge starts at depth 0
+    computed_hash_old = computed_hash_old[:self.hash_lengths[0]]
+    computed_hash_new = computed_hash_new[:self.hash_lengths[0]]
+    # 3. Verify all signatures against the recovered addresses, and that each recipient was credited. This is after merkleization, which is fine since any failure reverts everything.
+    self.verify_signatures(bytes.fromhex(pre_root))
+    self.check_credits()
+    # 4. If previous state root is verified, then return the new state root
+    if computed_hash_old.hex() != pre_root:
+      raise ValueError("stored root "+pre_root+" != verified root "+computed_hash_old.hex())
+    return computed_hash_new.hex()
+
+  # hash the concatenation of the inputs without building it, returns raw bytes
+  def hash_bytes(self, left, right=b''):
+    h = self.hash_state.copy()
+    h.update(left)
+    h.update(right)
+    return h.digest()
+
+  # init calldata: transactions, balances, address chunks, proof hashes, tree encoding
+  # calldata is bytes from merkle_token_tools.encode_calldata(), each section is kept as a memoryview into it without copying
+  # calldata may also be a dictionary of lists of strings for prototyping, which is converted to the same raw bytes
+  def decode_calldata(self, calldata):
+    self.recovered_addresses = bytearray()
+    if type(calldata)==dict:
+      self.transactions = b''.join(t if type(t)==bytes else t.to_bytes(num_transaction_bytes,'little') for t in calldata["transactions"])
+      self.balances = b''.join(b.to_bytes(self.num_balance_bytes,'little') for b in calldata["balances"])
+      self.address_chunks = b''.join(bytes([len(c)])+int(c,2).to_bytes((len(c)+7)//8,'big') for c in calldata["address_chunks"])
+      self.proof_hashes = bytes.fromhex(''.join(calldata["proof_hashes"]))
+      if self.tree_arity == 2:
+        self.tree_encoding = bytes(int(e,2) for e in calldata["tree_encoding"])
+      else:
+        self.tree_encoding = b''.join(bitmap.to_bytes((self.tree_arity+7)//8,'little') for bitmap in calldata["tree_encoding"])
+      self.addresses = b''
+      self.back_references = b''
+      return
+    hash_size, sections = parse_calldata(calldata, self.hash_length_schedule, self.num_address_bits, self.num_balance_bytes, self.tree_arity)
+    if hash_size != self.num_hash_bytes:
+      raise ValueError("calldata has "+str(hash_size)+" bytes per hash, expected "+str(self.num_hash_bytes))
+    # addresses are recovered from the tree encoding and address chunks during merkleization, the addresses section is only read for tree keys
+    self.proof_hashes, self.addresses, self.balances, self.transactions, self.tree_encoding, self.address_chunks, self.back_references = sections
+
+  # init indices before each tree traversal
+  def zero_indices(self):
+    self.opcode_idx = 0
+    self.new_balance_idx = 0
+    self.old_balance_idx = 0
+    self.addychunk_idx = 0
+    self.hash_idx = 0
+    self.proof_hash_slot = 0
+
+  # getters for address chunks, hash, and balances, each returns a memoryview into the underlying bytes, except address chunks
+
+  def get_next_address_chunk(self):
+    # an address chunk is a byte with the bit length, followed by the bits as big-endian bytes, returned as (bit length, int)
+    addychunk_idx = self.addychunk_idx
+    addychunk_bit_length = self.address_chunks[addychunk_idx]
+    addychunk_byte_length = (addychunk_bit_length+7)//8
+    addychunk = int.from_bytes(self.address_chunks[addychunk_idx+1:addychunk_idx+1+addychunk_byte_length],'big')
+    self.addychunk_idx = addychunk_idx+1+addychunk_byte_length
+    return addychunk_bit_length, addychunk
+
+  # a child bitmap in the tree encoding of a tree wider than binary
+  def get_next_bitmap(self):
+    opcode_idx = self.opcode_idx
+    self.opcode_idx = opcode_idx+(self.tree_arity+7)//8
+    return int.from_bytes(self.tree_encoding[opcode_idx:self.opcode_idx],'little')
+
+  def get_next_hash(self, length):
+    hash_idx = self.hash_idx
+    self.hash_idx = hash_idx+length
+    return self.proof_hashes[hash_idx:self.hash_idx]
+
+  # with back references, each proof hash is read through here with its node's key, see proof_hash_keys()
+  # a proof hash whose bit is set is not in the calldata, it is the hash known for its key from the last verified proof
+  def get_next_proof_hash(self, length, key):
+    slot = self.proof_hash_slot
+    self.proof_hash_slot = slot+1
+    if self.back_references[slot>>3] >> (slot&7) & 1:
+      known_hash = self.known_hashes.get(key)
+      if known_hash is None or len(known_hash) != length:
+        raise ValueError("back reference to a hash which the last verified proof doesn't have")
+      return known_hash
+    return self.get_next_hash(length)
+
+  # with next_known_hashes, the post-state hashes of a node's children, truncated as in their parent, by the left child's key
+  def record_known_hashes(self, left_key, left_hash, right_hash):
+    self.next_known_hashes[left_key] = bytes(left_hash)
+    self.next_known_hashes[left_key|1] = bytes(right_hash)
+
+  # with tree keys, the address of the leaf whose key is the path to it, which is checked against the key
+  # it is read from the addresses section at the leaf's index, which is the number of old balances read so far minus one, so it also works for a subproof
+  def get_keyed_address(self, key):
+    A = self.num_address_bytes
+    leaf = self.old_balance_idx//self.num_balance_bytes - 1
+    address = bytes(self.addresses[leaf*A:(leaf+1)*A])
+    if len(address) != A:
+      raise ValueError("calldata has no addresses, which tree keys need")
+    if tree_key(address, self.key_hash_salt, self.num_address_bits) != key:
+      raise ValueError("address "+address.hex()+" does not have the tree key "+key.hex())
+    return address
+
+  def get_next_old_balance(self):
+    old_balance_idx = self.old_balance_idx
+    self.old_balance_idx = old_balance_idx+self.num_balance_bytes
+    return self.balances[old_balance_idx:self.old_balance_idx]
+
+  def get_next_new_balance(self):
+    new_balance_idx = self.new_balance_idx
+    self.new_balance_idx = new_balance_idx+self.num_balance_bytes
+    return self.new_balances[new_balance_idx:self.new_balance_idx]
+
+  # this is a single-pass to merkleize the old root and the new root, returns raw hashes
+  # a subtree whose balances are unchanged returns the same hash object for both roots, so it is hashed once instead of twice
+  # it also recovers addresses, each leaf's address is the path to it, built from the opcodes and address chunks
+  # address_prefix is an int of the first depth bits of the address
+  # this should be called after new balances are created from transactions, except credits to recipients, which are added here
+  def merklize_old_and_new_root(self, address_prefix, depth):
+    # if leaf, recover its address, then hash its address and value
+    if depth == self.num_address_bits:
+      old_balance = self.get_next_old_balance()
+      new_balance = self.get_next_new_balance()
+      # the path is the key, which is the address unless keys are hashed
+      key = address_prefix.to_bytes(self.num_address_bytes,'big')
+      address = key if self.key_hash_salt is None else self.get_keyed_address(key)
+      self.recovered_addresses += address
+      if self.credits and address in self.credits:
+        new_balance = self.credit(new_balance, address)
+      hash_old = self.hash_bytes(key,old_balance)
+      if old_balance == new_balance:
+        return hash_old, hash_old
+      return hash_old, self.hash_bytes(key,new_balance)
+    # otherwise, process the tree node, i.e. the opcode
+    opcode = self.tree_encoding[self.opcode_idx]
+    self.opcode_idx+=1
+    # children's edges start at depth+1, so their hashes are used truncated to the length there
+    n = self.hash_lengths[depth+1]
+    if opcode == 0b11:
+      left_hash_old, left_hash_new = self.merklize_old_and_new_root(address_prefix<<1, depth+1)
+      right_hash_old, right_hash_new = self.merklize_old_and_new_root((address_prefix<<1)|1, depth+1)
+      if self.next_known_hashes is not None:
+        self.record_known_hashes((2<<depth)|(address_prefix<<1), left_hash_new[:n], right_hash_new[:n])
+      hash_old = self.hash_bytes(left_hash_old[:n],right_hash_old[:n])
+      if left_hash_old is left_hash_new and right_hash_old is right_hash_new:
+        return hash_old, hash_old
+      return hash_old, self.hash_bytes(left_hash_new[:n],right_hash_new[:n])
+    elif opcode == 0b10:
+      left_hash_old, left_hash_new = self.merklize_old_and_new_root(address_prefix<<1, depth+1)
+      if self.back_references:
+        right_hash = self.get_next_proof_hash(n, (2<<depth)|(address_prefix<<1)|1)
+      else:
+        right_hash = self.get_next_hash(n)
+      if self.next_known_hashes is not None:
+        self.record_known_hashes((2<<depth)|(address_prefix<<1), left_hash_new[:n], right_hash)
+      hash_old = self.hash_bytes(left_hash_old[:n],right_hash)
+      if left_hash_old is left_hash_new:
+        return hash_old, hash_old
+      return hash_old, self.hash_bytes(left_hash_new[:n],right_hash)
+    elif opcode == 0b01:
+      right_hash_old, right_hash_new = self.merklize_old_and_new_root((address_prefix<<1)|1, depth+1)
+      if self.back_references:
+        left_hash = self.get_next_proof_hash(n, (2<<depth)|(address_prefix<<1))
+      else:
+        left_hash = self.get_next_hash(n)
+      if self.next_known_hashes is not None:
+        self.record_known_hashes((2<<depth)|(address_prefix<<1), left_hash, right_hash_new[:n])
+      hash_old = self.hash_bytes(left_hash,right_hash_old[:n])
+      if right_hash_old is right_hash_new:
+        return hash_old, hash_old
+      return hash_old, self.hash_bytes(left_hash,right_hash_new[:n])
+    elif opcode == 0b00:
+      address_chunk_length, address_chunk = self.get_next_address_chunk()
+      return self.merklize_old_and_new_root((address_prefix<<address_chunk_length)|address_chunk, depth+address_chunk_length)
+
+  # the same as merklize_old_and_new_root() for a tree wider than binary, where the tree encoding has child bitmaps, see kary_bitmaps()
+  # a node's hash is the hash of its bitmap of present children followed by their hashes in order
+  def merklize_old_and_new_root_kary(self, address_prefix, depth):
+    # a leaf is the same as in the binary tree, which returns before reading the tree encoding
+    if depth == self.num_address_bits:
+      return self.merklize_old_and_new_root(address_prefix, depth)
+    present = self.get_next_bitmap()
+    if present == 0:
+      address_chunk_length, address_chunk = self.get_next_address_chunk()
+      return self.merklize_old_and_new_root_kary((address_prefix<<address_chunk_length)|address_chunk, depth+address_chunk_length)
+    visited = self.get_next_bitmap()
+    bits_per_level = self.tree_arity.bit_length()-1
+    n = self.hash_lengths[depth+bits_per_level]
+    hashes_old = [present.to_bytes((self.tree_arity+7)//8,'little')]
+    hashes_new = hashes_old[:]
+    dirty = False
+    # each present child in order, from the lowest bit
+    children = present
+    while children:
+      child = (children & -children).bit_length()-1
+      children &= children-1
+      if visited >> child & 1:
+        child_hash_old, child_hash_new = self.merklize_old_and_new_root_kary((address_prefix<<bits_per_level)|child, depth+bits_per_level)
+        dirty = dirty or child_hash_old is not child_hash_new
+        hashes_old.append(child_hash_old[:n])
+        hashes_new.append(child_hash_new[:n])
+      else:
+        child_hash = self.get_next_hash(n)
+        hashes_old.append(child_hash)
+        hashes_new.append(child_hash)
+    hash_old = self.hash_bytes(b''.join(hashes_old))
+    if not dirty:
+      return hash_old, hash_old
+    return hash_old, self.hash_bytes(b''.join(hashes_new))
+
+  # the top of the tree for verify_parallel(), down to levels 11 opcodes deep, below which are the subtrees merkleized concurrently
+  # in the pre-scan, results is None, each subtree's address prefix, depth, and cursors are appended to subproofs, and the subtree is skipped
+  # otherwise, results has each subtree's hashes, addresses, and cursors after it, from merklize_subproof(), and hashes are returned like merklize_old_and_new_root()
+  def merklize_top(self, address_prefix, depth, levels, subproofs, results):
+    if levels == 0 or depth == self.num_address_bits:
+      if results is None:
+        subproofs.append((address_prefix, depth, self.opcode_idx, self.addychunk_idx, self.hash_idx, self.old_balance_idx))
+        self.skip_subtree(depth)
+        return None, None
+      hash_old, hash_new, addresses, cursors = next(results)
+      self.recovered_addresses += addresses
+      self.opcode_idx, self.addychunk_idx, self.hash_idx, self.old_balance_idx = cursors
+      self.new_balance_idx = self.old_balance_idx
+      # an unchanged subtree's hash is sent once
+      if hash_new is None:
+        return hash_old, hash_old
+      return hash_old, hash_new
+    opcode = self.tree_encoding[self.opcode_idx]
+    self.opcode_idx+=1
+    n = self.hash_lengths[depth+1]
+    if opcode == 0b11:
+      left_hash_old, left_hash_new = self.merklize_top(address_prefix<<1, depth+1, levels-1, subproofs, results)
+      right_hash_old, right_hash_new = self.merklize_top((address_prefix<<1)|1, depth+1, levels-1, subproofs, results)
+      if results is None:
+        return None, None
+      hash_old = self.hash_bytes(left_hash_old[:n],right_hash_old[:n])
+      if left_hash_old is left_hash_new and right_hash_old is right_hash_new:
+        return hash_old, hash_old
+      return hash_old, self.hash_bytes(left_hash_new[:n],right_hash_new[:n])
+    elif opcode == 0b10:
+      left_hash_old, left_hash_new = self.merklize_top(address_prefix<<1, depth+1, levels, subproofs, results)
+      right_hash = self.get_next_hash(n)
+      if results is None:
+        return None, None
+      hash_old = self.hash_bytes(left_hash_old[:n],right_hash)
+      if left_hash_old is left_hash_new:
+        return hash_old, hash_old
+      return hash_old, self.hash_bytes(left_hash_new[:n],right_hash)
+    elif opcode == 0b01:
+      right_hash_old, right_hash_new = self.merklize_top((address_prefix<<1)|1, depth+1, levels, subproofs, results)
+      left_hash = self.get_next_hash(n)
+      if results is None:
+        return None, None
+      hash_old = self.hash_bytes(left_hash,right_hash_old[:n])
+      if right_hash_old is right_hash_new:
+        return hash_old, hash_old
+      return hash_old, self.hash_bytes(left_hash,right_hash_new[:n])
+    elif opcode == 0b00:
+      address_chunk_length, address_chunk = self.get_next_address_chunk()
+      return self.merklize_top((address_prefix<<address_chunk_length)|address_chunk, depth+address_chunk_length, levels, subproofs, results)
+
+  # advance the cursors past the subtree at depth, without hashing or recursion
+  # only the opcodes and address chunk lengths are read, then hash and balance cursors advance by the bytes of hashes and the number of leaves in the subtree
+  def skip_subtree(self, depth):
+    tree_encoding = self.tree_encoding
+    address_chunks = self.address_chunks
+    opcode_idx = self.opcode_idx
+    addychunk_idx = self.addychunk_idx
+    hash_lengths = self.hash_lengths
+    num_hash_bytes = 0
+    num_leaves = 0
+    # depths of right children still to visit
+    depths = [depth]
+    while depths:
+      depth = depths.pop()
+      while depth < self.num_address_bits:
+        opcode = tree_encoding[opcode_idx]
+        opcode_idx += 1
+        if opcode == 0b11:
+          depths.append(depth+1)
+        elif opcode == 0b00:
+          addychunk_bit_length = address_chunks[addychunk_idx]
+          addychunk_idx += 1+(addychunk_bit_length+7)//8
+          depth += addychunk_bit_length-1
+        else:
+          num_hash_bytes += hash_lengths[depth+1]
+        depth += 1
+      num_leaves += 1
+    self.opcode_idx = opcode_idx
+    self.addychunk_idx = addychunk_idx
+    self.hash_idx += num_hash_bytes
+    self.old_balance_idx += num_leaves*self.num_balance_bytes
+    self.new_balance_idx += num_leaves*self.num_balance_bytes
+
+  # verify all signatures for token transfers, against the recovered addresses, which are Ed25519 public keys
+  # each sender signs the pre-state root, the transaction's index in the block as four bytes little-endian, then the recipient and amount from the transaction
+  #   so a signature can't be replayed in another block, or at another index in the same block
+  def verify_signatures(self, pre_state_root):
+    if not self.signatures:
+      return
+    A = self.num_address_bytes
+    if A != 32:
+      raise ValueError("Ed25519 public keys need 256-bit addresses")
+    items = [(bytes(self.recovered_addresses[sender*A:(sender+1)*A]), pre_state_root+index.to_bytes(4,'little')+bytes(signed), bytes(signature))
+             for index, (sender, signed, signature) in enumerate(self.signatures)]
+    if not self.signature_verifier(items):
+      raise ValueError("invalid signature")
+
+  # apply balance transfer from each transaction, creating the new balances
+  # a transaction is 105 bytes:
+  #   1 byte sender index, in the sorted addresses of the witness
+  #   32 bytes recipient address, big-endian
+  #   8 bytes amount, little-endian
+  #   64 bytes Ed25519 signature by the sender
+  # addresses are not recovered yet, so senders are debited here by index, and credits are summed by recipient address, to be added when merkleization reaches them
+  # a sender must afford all of their transfers from their old balance
+  def execute_transactions(self):
+    self.signatures = []
+    self.credits = {}
+    if not self.transactions:
+      self.new_balances = self.balances
+      return
+    if numpy is not None and bulk_execution_threshold is not None and self.num_balance_bytes == 8 and len(self.transactions) >= bulk_execution_threshold*num_transaction_bytes:
+      self.execute_transactions_in_bulk()
+    else:
+      self.execute_transactions_one_by_one()
+
+  def execute_transactions_one_by_one(self):
+    B = self.num_balance_bytes
+    num_leaves = len(self.balances)//B
+    debits = {}
+    self.credits = {}
+    for idx in range(0, len(self.transactions), num_transaction_bytes):
+      transaction = self.transactions[idx:idx+num_transaction_bytes]
+      sender = transaction[0]
+      recipient = int.from_bytes(transaction[1:33],'big')
+      amount = int.from_bytes(transaction[33:41],'little')
+      if sender >= num_leaves:
+        raise ValueError("transaction sender is not in the witness")
+      if recipient >> self.num_address_bits:
+        raise ValueError("transaction recipient is not an address")
+      recipient = recipient.to_bytes(self.num_address_bytes,'big')
+      debits[sender] = debits.get(sender,0)+amount
+      self.credits[recipient] = self.credits.get(recipient,0)+amount
+    new_balances = bytearray(self.balances)
+    for sender, debit in debits.items():
+      balance = int.from_bytes(new_balances[sender*B:(sender+1)*B],'little')
+      if debit > balance:
+        raise ValueError("balance underflow")
+      new_balances[sender*B:(sender+1)*B] = (balance-debit).to_bytes(B,'little')
+    self.new_balances = new_balances
+    self.signatures = self.split_signatures()
+
+  # the same as execute_transactions_one_by_one() with numpy, each step is an array operation over all transactions, for 64-bit balances
+  # recipients are sorted and deduplicated, so there is one credit for each recipient
+  #   each recipient is viewed as one opaque value of A bytes, which sorts by comparing bytes, much faster than numpy.unique(axis=0) sorting rows column by column
+  def execute_transactions_in_bulk(self):
+    A = self.num_address_bytes
+    records = numpy.frombuffer(self.transactions, dtype=transaction_dtype)
+    balances = numpy.frombuffer(self.balances, dtype='<u8')
+    senders = records['sender']
+    recipients = records['recipient']
+    amounts = records['amount']
+    if senders.max() >= len(balances):
+      raise ValueError("transaction sender is not in the witness")
+    top_bits = self.num_address_bits-8*(A-1)	# bits used in the first byte of an address
+    if recipients[:,:32-A].any() or (top_bits < 8 and (recipients[:,32-A] >> top_bits).any()):
+      raise ValueError("transaction recipient is not an address")
+    debits, overflow = sum_amounts_by_index(senders, amounts, len(balances))
+    if (overflow | (debits > balances)).any():
+      raise ValueError("balance underflow")
+    recipients = numpy.ascontiguousarray(recipients[:,32-A:]).view(numpy.dtype((numpy.void, A))).reshape(-1)
+    recipients, recipient_indices = numpy.unique(recipients, return_inverse=True)
+    credits, overflow = sum_amounts_by_index(recipient_indices.reshape(-1), amounts, len(recipients))
+    if overflow.any():
+      raise ValueError("balance overflow")
+    self.new_balances = (balances-debits).astype('<u8').tobytes()
+    self.credits = {recipient.tobytes():int(credit) for recipient, credit in zip(recipients, credits)}
+    self.signatures = self.split_signatures()
+
+  # (sender index, signed part, signature) for each transaction
+  # a transaction repeated in the block is rejected here, before its signature, which is for one index only, is checked
+  def split_signatures(self):
+    transactions = self.transactions
+    records = [bytes(transactions[idx:idx+num_transaction_bytes]) for idx in range(0, len(transactions), num_transaction_bytes)]
+    if len(set(records)) != len(records):
+      raise ValueError("duplicate transaction")
+    return [(record[0], record[1:41], record[41:]) for record in records]
+
+  # returns the new balance after crediting what was transferred to address
+  def credit(self, balance, address):
+    balance = int.from_bytes(balance,'little')+self.credits[address]
+    if balance >> (8*self.num_balance_bytes):
+      raise ValueError("balance overflow")
+    return balance.to_bytes(self.num_balance_bytes,'little')
+
+  # each recipient must be in the witness, otherwise their credit was never added
+  def check_credits(self):
+    if not self.credits:
+      return
+    A = self.num_address_bytes
+    recovered_addresses = {bytes(self.recovered_addresses[i:i+A]) for i in range(0, len(self.recovered_addresses), A)}
+    for recipient in self.credits:
+      if recipient not in recovered_addresses:
+        raise ValueError("transaction recipient is not in the witness")
+
+
+# exact sums of uint64 amounts grouped by index with numpy, and whether each sum overflows 64 bits
+# the low and high 32 bits are summed separately, which can't overflow since a block has fewer than 2**32 transactions
+def sum_amounts_by_index(indices, amounts, size):
+  low = numpy.zeros(size, dtype=numpy.uint64)
+  high = numpy.zeros(size, dtype=numpy.uint64)
+  numpy.add.at(low, indices, amounts & 0xffffffff)
+  numpy.add.at(high, indices, amounts >> 32)
+  high += low >> 32
+  return (high << 32) | (low & 0xffffffff), (high >> 32) != 0
+
+
+# merkleizes a subtree for Verifier.verify_parallel() in a worker, given the calldata, the new balances and credits, where the subtree starts, and the verifier's constants
+# returns the old and new hashes, where the new hash is None if it is the old hash, the recovered addresses, and the cursors after the subtree
+def merklize_subproof(calldata, new_balances, credits, subproof, constants):
+  verifier = Verifier(constants=constants)
+  verifier.decode_calldata(calldata)
+  verifier.new_balances = new_balances
+  verifier.credits = credits
+  address_prefix, depth, verifier.opcode_idx, verifier.addychunk_idx, verifier.hash_idx, verifier.old_balance_idx = subproof
+  verifier.new_balance_idx = verifier.old_balance_idx
+  hash_old, hash_new = verifier.merklize_old_and_new_root(address_prefix, depth)
+  cursors = (verifier.opcode_idx, verifier.addychunk_idx, verifier.hash_idx, verifier.old_balance_idx)
+  return hash_old, None if hash_new is hash_old else hash_new, bytes(verifier.recovered_addresses), cursors
+
+
+# the contract entry point, verifies calldata against the stored state root and stores the new state root
+# independent blocks can instead each be verified with Verifier().verify(), e.g. in a thread or process pool
+# verifier is a Verifier to use instead of a new one, e.g. a merkle_token_profile.InstrumentedVerifier
+# with delta_witnesses, the hashes known from the last verified proof are kept with the state root, for the next block's back references
+def main(calldata, verifier=None):
   old_state_root = get_state_root()
-  if old_state_root == computed_hash_old:
-    set_state_root(computed_hash_new)
-  else:
-    print("ERROR ERROR ERROR ERROR ERROR ERROR stored root != verified root:")
-    print("stored root hash:", old_state_root)
-    print("verified root hash:",computed_hash_old)
-    print("computed new root hash",computed_hash_new)
-
+  verifier = verifier or Verifier()
+  if delta_witnesses:
+    verifier.known_hashes = get_known_hashes()
+    verifier.next_known_hashes = {}
+  try:
+    new_state_root = verifier.verify(calldata, old_state_root)
+  except ValueError as e:
+    print("ERROR ERROR ERROR ERROR ERROR ERROR", e)
+    return
+  set_state_root(new_state_root, verifier.next_known_hashes)
@@ -0,0 +1,213 @@
+# benchmark suite for the stages from random accounts to a verified block, with results saved as JSON, and a comparison of two saved runs to catch regressions
+#   python3 merkle_token_bench.py run results.json
+#   python3 merkle_token_bench.py compare old_results.json new_results.json
+
+import merkle_token
+import merkle_token_tools
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+
+
+# each stage is timed separately, in this order, and its ops are accounts for the first two stages, and accounts in the witness for the others
+stages = ['generate_accounts', 'build_merkle_tree', 'build_merkle_proof', 'encode_calldata', 'decode_calldata', 'main']
+
+# default sweep, each case is a tree size and a witness size
+default_num_accounts_total = [2**10, 2**14, 2**17]
+default_num_accounts_in_witness = [10, 100, 1000]
+
+# a stage regresses when its ops/s drops, or its RSS growth grows, by more than this fraction
+default_threshold = 0.1
+
+# least seconds per timed run of a stage, see time_stage()
+min_run_seconds = 0.02
+
+# RSS growth within this many kB is allocator noise, so small stages don't regress from a page or two
+rss_noise_kb = 256
+
+
+##############
+# Benchmarks #
+##############
+
+# current resident set size of this process in kB, or None where /proc is missing
+# the peak from getrusage() never goes down, so it would charge every stage with the largest earlier case, instead each stage records how much the current RSS grew while it ran
+def rss_kb():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')//1024
+  except (OSError, ValueError):
+    return None
+
+# the accounts are the same for the same seed, so every run of a stage, and every saved run with the same seed, sees the same tree
+def generate_accounts(num_accounts_total, seed):
+  rng = random.Random(seed)
+  num_address_bits = merkle_token.num_address_bits
+  return {bin(rng.getrandbits(num_address_bits))[2:].zfill(num_address_bits):rng.getrandbits(merkle_token.num_balance_bits) for i in range(num_accounts_total)}
+
+# returns the best seconds per call of stage over num_runs runs, the RSS growth in kB from before the first call to after the last, and the result of the last call
+# stages that take well under min_run_seconds are called repeatedly in each run, like timeit, since a single call is too short to time steadily
+# the RSS growth is mostly the memory held by the result, since the results of earlier calls are freed as they are replaced
+def time_stage(stage, num_runs):
+  gc.collect()
+  rss_start = rss_kb()
+  start = time.perf_counter()
+  result = stage()
+  elapsed = time.perf_counter()-start
+  num_calls = max(1, min(10000, int(min_run_seconds/elapsed) if elapsed else 10000))
+  best = float('inf')
+  for i in range(num_runs):
+    start = time.perf_counter()
+    for j in range(num_calls):
+      result = stage()
+    best = min(best, (time.perf_counter()-start)/num_calls)
+  gc.collect()
+  rss_end = rss_kb()
+  rss_growth = rss_end-rss_start if rss_start is not None and rss_end is not None else None
+  return best, rss_growth, result
+
+def stage_result(timing, num_ops):
+  seconds, rss_growth = timing
+  return {'seconds': seconds, 'ops': num_ops, 'ops_per_second': num_ops/seconds if seconds else None, 'rss_growth_kb': rss_growth}
+
+def benchmark_case(num_accounts_total, num_accounts_in_witness, seed, num_runs):
+  results = {}
+  seconds, rss, accounts = time_stage(lambda: generate_accounts(num_accounts_total, seed), num_runs)
+  results['generate_accounts'] = stage_result((seconds, rss), len(accounts))
+  sorted_accounts = sorted(accounts)
+  sorted_addresses = sorted(random.Random(seed+1).sample(sorted_accounts, min(num_accounts_in_witness, len(accounts))))
+
+  def build_tree():
+    merkle_tree = {}
+    merkle_token_tools.build_merkle_tree(0, sorted_accounts, accounts, merkle_tree)
+    return merkle_tree
+  seconds, rss, merkle_tree = time_stage(build_tree, num_runs)
+  results['build_merkle_tree'] = stage_result((seconds, rss), len(accounts))
+  root = merkle_tree[''][0]
+
+  def build_proof():
+    tree_encoding, address_chunks, balances, proof_hashes = [], [], [], []
+    merkle_token_tools.build_merkle_proof(0, sorted_addresses, accounts, merkle_tree, tree_encoding, address_chunks, balances, proof_hashes)
+    return tree_encoding, address_chunks, balances, proof_hashes
+  seconds, rss, (tree_encoding, address_chunks, balances, proof_hashes) = time_stage(build_proof, num_runs)
+  results['build_merkle_proof'] = stage_result((seconds, rss), len(sorted_addresses))
+
+  seconds, rss, calldata = time_stage(lambda: bytes(merkle_token_tools.encode_calldata([], balances, address_chunks, proof_hashes, tree_encoding, sorted_addresses=sorted_addresses)), num_runs)
+  results['encode_calldata'] = stage_result((seconds, rss), len(sorted_addresses))
+
+  seconds, rss, decoded = time_stage(lambda: merkle_token_tools.decode_calldata(calldata), num_runs)
+  results['decode_calldata'] = stage_result((seconds, rss), len(sorted_addresses))
+
+  # main() prints rather than raises on invalid calldata, so the stored root is checked afterwards, there are no transactions so it must be unchanged
+  def verify():
+    merkle_token.set_state_root(root)
+    merkle_token.main(calldata)
+    if merkle_token.get_state_root() != root:
+      raise ValueError("main() did not verify the benchmark calldata")
+  seconds, rss, _ = time_stage(verify, num_runs)
+  results['main'] = stage_result((seconds, rss), len(sorted_addresses))
+
+  return {'num_accounts_total': num_accounts_total, 'num_accounts_in_witness': len(sorted_addresses), 'seed': seed, \
+          'calldata_bytes': len(calldata), 'proof_hashes': len(proof_hashes), 'stages': results}
+
+def run_benchmarks(num_hash_bits=160, num_address_bits=160, num_accounts_total=default_num_accounts_total, num_accounts_in_witness=default_num_accounts_in_witness, seed=0, num_runs=3):
+  merkle_token.num_hash_bits = num_hash_bits
+  merkle_token.num_hash_bytes = (num_hash_bits+7)//8
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  cases = []
+  for numacctstotal in sorted(num_accounts_total):
+    for numacctsinwitness in num_accounts_in_witness:
+      # each case has its own seed, so adding a case to the sweep doesn't change the others
+      case = benchmark_case(numacctstotal, numacctsinwitness, seed*1000003 + numacctstotal*7919 + numacctsinwitness, num_runs)
+      cases.append(case)
+      print("accounts:", numacctstotal, "  accounts in witness:", case['num_accounts_in_witness'], "  calldata bytes:", case['calldata_bytes'])
+      for stage in stages:
+        result = case['stages'][stage]
+        print("  ", stage.ljust(20), "ms:", str(round(result['seconds']*1000, 3)).rjust(10), "  ops/s:", str(int(result['ops_per_second'] or 0)).rjust(10), "  RSS growth kB:", result['rss_growth_kb'])
+  return {'python': platform.python_version(), 'machine': platform.machine(), 'platform': platform.platform(), \
+          'num_hash_bits': num_hash_bits, 'num_address_bits': num_address_bits, 'tree_arity': merkle_token.tree_arity, \
+          'hash_length_schedule': merkle_token.hash_length_schedule, 'seed': seed, 'num_runs': num_runs, 'cases': cases}
+
+
+###########
+# Compare #
+###########
+
+# the settings that must match for two runs to be comparable, since they change the trees, the proofs, or the accounts
+comparable_settings = ['num_hash_bits', 'num_address_bits', 'tree_arity', 'hash_length_schedule', 'seed']
+
+# returns a list of regressions from old to new, each a readable string, for cases and stages in both runs
+# raises ValueError if the runs used different settings, since their numbers would differ for reasons other than the code
+# timings are noisy, so compare runs from the same machine, and rerun before trusting a regression near the threshold
+def compare_results(old, new, threshold=default_threshold):
+  mismatched = ["%s %r vs %r" % (setting, old.get(setting), new.get(setting)) for setting in comparable_settings if old.get(setting) != new.get(setting)]
+  if mismatched:
+    raise ValueError("runs used different settings: " + ", ".join(mismatched))
+  regressions = []
+  old_cases = {(case['num_accounts_total'], case['num_accounts_in_witness']): case for case in old['cases']}
+  for new_case in new['cases']:
+    key = (new_case['num_accounts_total'], new_case['num_accounts_in_witness'])
+    if key not in old_cases:
+      continue
+    old_case = old_cases[key]
+    name = "accounts %d witness %d" % key
+    if new_case['calldata_bytes'] > old_case['calldata_bytes']:
+      regressions.append("%s: calldata bytes %d -> %d" % (name, old_case['calldata_bytes'], new_case['calldata_bytes']))
+    for stage in stages:
+      if stage not in old_case['stages'] or stage not in new_case['stages']:
+        continue
+      old_stage, new_stage = old_case['stages'][stage], new_case['stages'][stage]
+      if old_stage['ops_per_second'] and new_stage['ops_per_second']:
+        change = new_stage['ops_per_second']/old_stage['ops_per_second'] - 1
+        print(name.ljust(28), stage.ljust(20), "ops/s:", str(int(old_stage['ops_per_second'])).rjust(10), "->", str(int(new_stage['ops_per_second'])).rjust(10), "  %+.1f%%" % (100*change))
+        if change < -threshold:
+          regressions.append("%s: %s ops/s %d -> %d (%+.1f%%)" % (name, stage, old_stage['ops_per_second'], new_stage['ops_per_second'], 100*change))
+      old_rss, new_rss = old_stage.get('rss_growth_kb'), new_stage.get('rss_growth_kb')
+      if old_rss is not None and new_rss is not None and new_rss > max(old_rss, 0)*(1+threshold) + rss_noise_kb:
+        regressions.append("%s: %s RSS growth kB %d -> %d" % (name, stage, old_rss, new_rss))
+  return regressions
+
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="benchmark the stages from random accounts to a verified block, or compare two saved runs")
+  commands = parser.add_subparsers(dest='command', required=True)
+  run = commands.add_parser('run', help="run the benchmarks and save the results as JSON")
+  run.add_argument('output')
+  run.add_argument('--num-hash-bits', type=int, default=160)
+  run.add_argument('--num-address-bits', type=int, default=160)
+  run.add_argument('--num-accounts-total', type=int, nargs='+', default=default_num_accounts_total)
+  run.add_argument('--num-accounts-in-witness', type=int, nargs='+', default=default_num_accounts_in_witness)
+  run.add_argument('--seed', type=int, default=0)
+  run.add_argument('--num-runs', type=int, default=3)
+  compare = commands.add_parser('compare', help="compare two saved runs, exits with status 1 if there are regressions")
+  compare.add_argument('old')
+  compare.add_argument('new')
+  compare.add_argument('--threshold', type=float, default=default_threshold)
+  args = parser.parse_args()
+
+  if args.command == 'run':
+    results = run_benchmarks(args.num_hash_bits, args.num_address_bits, args.num_accounts_total, args.num_accounts_in_witness, args.seed, args.num_runs)
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  else:
+    with open(args.old) as f:
+      old = json.load(f)
+    with open(args.new) as f:
+      new = json.load(f)
+    try:
+      regressions = compare_results(old, new, args.threshold)
+    except ValueError as e:
+      print("cannot compare:", e)
+      sys.exit(2)
+    for regression in regressions:
+      print("REGRESSION", regression)
+    sys.exit(1 if regressions else 0)
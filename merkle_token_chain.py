@@ -0,0 +1,264 @@
+# runs a chain of blocks through a pipeline, checking that each block's verified post-state root is the next block's pre-state root
+#   prove: in block order, build each block's calldata from the tree, then apply the block's balance updates, so the tree is in the next block's pre-state
+#   verify: Verifier().verify() of each block's calldata against its pre-state root, by worker threads, or in processes if an executor is given
+#   commit: in block order, check the chain of roots, and store each post-state root with merkle_token.set_state_root()
+# proving and tree updates need the tree in order, so they alternate in one thread, and both overlap the verification and commits of earlier blocks
+# the queues between stages are bounded, so proving waits when verification is queue_size blocks behind, and verification waits when commits are
+#   stats = PipelineStats()
+#   run_chain(tree, blocks, stats=stats)
+#   stats.report()
+
+import merkle_token
+import merkle_token_tools
+
+import collections
+import concurrent.futures
+import os
+import queue
+import random
+import threading
+import time
+
+
+# stages in the order each block goes through them
+stages = ['block', 'prove', 'update', 'verify', 'commit']
+
+# queues between stages, sampled each time a block is committed
+queues = ['proven', 'verified']
+
+
+#########
+# Stats #
+#########
+
+# totals over every run_chain() collecting into it
+class PipelineStats:
+  __slots__ = ('num_blocks', 'seconds', 'stage_seconds', 'queue_depth_sums', 'queue_depth_max', 'num_samples')
+
+  def __init__(self):
+    self.num_blocks = 0
+    self.seconds = 0			# end-to-end, from the first block until the last is committed
+    self.stage_seconds = collections.Counter()	# busy seconds of each stage, verify is summed over workers
+    self.queue_depth_sums = collections.Counter()
+    self.queue_depth_max = collections.Counter()
+    self.num_samples = 0
+
+  def sample_queues(self, depths):
+    self.num_samples += 1
+    for name, depth in zip(queues, depths):
+      self.queue_depth_sums[name] += depth
+      self.queue_depth_max[name] = max(self.queue_depth_max[name], depth)
+
+  def blocks_per_second(self):
+    return self.num_blocks/self.seconds if self.seconds else 0
+
+  def as_dict(self):
+    return {'num_blocks': self.num_blocks, 'seconds': self.seconds, 'blocks_per_second': self.blocks_per_second(), \
+            'stage_seconds': {stage: self.stage_seconds[stage] for stage in stages}, \
+            'queue_depths': {name: {'mean': self.queue_depth_sums[name]/self.num_samples if self.num_samples else 0, 'max': self.queue_depth_max[name]} for name in queues}}
+
+  def report(self):
+    print("blocks:", self.num_blocks, "  seconds:", round(self.seconds, 3), "  blocks/s:", round(self.blocks_per_second(), 2))
+    for stage in stages:
+      print("  ", stage.ljust(10), "ms per block:", round(self.stage_seconds[stage]*1000/max(self.num_blocks, 1), 3))
+    for name in queues:
+      print("  ", name.ljust(10), "queue depth mean:", round(self.queue_depth_sums[name]/max(self.num_samples, 1), 2), "  max:", self.queue_depth_max[name])
+
+
+############
+# Pipeline #
+############
+
+# a block is a function called with the tree in the block's pre-state, which returns the sorted addresses of its witness, its transactions,
+#   and its balance updates for MerkleTree.apply_block(), so transactions can be signed over the pre-state root
+# each block's post-state root, as verified, must be the tree's root after its updates, and the pre-state root of the next block
+# returns the last post-state root, or raises ValueError naming the first block which fails verification or breaks the chain
+#   blocks after it may have been proven and applied to the tree, so the tree is then ahead of the stored state root
+# executor is e.g. a concurrent.futures.ProcessPoolExecutor, which verification needs to run in parallel with proving, since threads share the GIL
+#   blocks are verified with the constants in merkle_token when run_chain() is called, which are sent with each block, since workers started by spawn or forkserver don't see constants set at runtime
+def run_chain(tree, blocks, num_workers=2, queue_size=4, executor=None, stats=None):
+  stats = stats or PipelineStats()
+  constants = merkle_token.current_constants()
+  proven = queue.Queue(queue_size)
+  verified = queue.Queue(queue_size)
+  stop = threading.Event()
+  errors = []
+
+  # wait for room in a queue, or for an item, unless the pipeline is stopping, then get() returns None like the end of the blocks
+  def put(q, item):
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def get(q):
+    while not stop.is_set():
+      try:
+        return q.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    return None
+
+  # an exception here ends the blocks, and is raised after the blocks before it are committed
+  def prove():
+    try:
+      for index, block in enumerate(blocks):
+        if stop.is_set():
+          return
+        start = time.perf_counter()
+        pre_root = tree.root_hash()
+        sorted_addresses, transactions, updates = block(tree)
+        block_end = time.perf_counter()
+        calldata = bytes(tree.build_calldata(sorted_addresses, transactions))
+        prove_end = time.perf_counter()
+        tree.apply_block(updates)
+        stats.stage_seconds['block'] += block_end-start
+        stats.stage_seconds['prove'] += prove_end-block_end
+        stats.stage_seconds['update'] += time.perf_counter()-prove_end
+        put(proven, (index, calldata, pre_root, tree.root_hash()))
+    except Exception as e:
+      errors.append(e)
+    finally:
+      for i in range(num_workers):
+        put(proven, None)
+
+  # results are (index, pre-state root, claimed post-state root, verified post-state root or the exception, seconds)
+  def verify():
+    while True:
+      item = get(proven)
+      if item is None:
+        put(verified, None)
+        return
+      index, calldata, pre_root, post_root = item
+      start = time.perf_counter()
+      try:
+        if executor is None:
+          result = merkle_token.Verifier(constants=constants).verify(calldata, pre_root)
+        else:
+          result = executor.submit(verify_block, calldata, pre_root, constants).result()
+      except Exception as e:
+        result = e
+      put(verified, (index, pre_root, post_root, result, time.perf_counter()-start))
+
+  threads = [threading.Thread(target=prove, daemon=True)] + [threading.Thread(target=verify, daemon=True) for i in range(num_workers)]
+  start = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  # commit in block order, holding results which are verified ahead of an earlier block
+  waiting = {}
+  next_index = 0
+  num_done = 0
+  try:
+    while num_done < num_workers:
+      item = get(verified)
+      if item is None:
+        num_done += 1
+        continue
+      waiting[item[0]] = item
+      while next_index in waiting:
+        commit_start = time.perf_counter()
+        index, pre_root, post_root, result, verify_seconds = waiting.pop(next_index)
+        stats.stage_seconds['verify'] += verify_seconds
+        if isinstance(result, Exception):
+          raise ValueError("block "+str(index)+": "+str(result))
+        if pre_root != merkle_token.get_state_root():
+          raise ValueError("block "+str(index)+": pre-state root "+pre_root+" is not the stored root "+merkle_token.get_state_root())
+        if result != post_root:
+          raise ValueError("block "+str(index)+": verified root "+result+" != tree root "+post_root)
+        merkle_token.set_state_root(result)
+        stats.sample_queues((proven.qsize(), verified.qsize()))
+        stats.num_blocks += 1
+        next_index += 1
+        stats.stage_seconds['commit'] += time.perf_counter()-commit_start
+    if errors:
+      raise errors[0]
+    return merkle_token.get_state_root()
+  finally:
+    # stages see stop within a tenth of a second
+    stop.set()
+    for thread in threads:
+      thread.join()
+    stats.seconds += time.perf_counter()-start
+
+# verifies a block in a worker process, with the constants from merkle_token.current_constants() in the caller
+def verify_block(calldata, pre_root, constants):
+  return merkle_token.Verifier(constants=constants).verify(calldata, pre_root)
+
+
+##########
+# Blocks #
+##########
+
+# block functions for run_chain(), each of random signed transfers among num_accounts_in_witness random accounts
+# secrets are from merkle_token_tools.generate_signing_accounts(), so addresses are 256 bits
+def random_transfer_blocks(secrets, num_blocks, num_accounts_in_witness, num_transactions, seed=0):
+  rng = random.Random(seed)
+  addresses = sorted(secrets)
+
+  def block(tree):
+    pre_root = tree.root_hash()
+    sorted_addresses = sorted(rng.sample(addresses, num_accounts_in_witness))
+    balances = {address:tree.get_balance(address) for address in sorted_addresses}
+    transactions = []
+    updates = {}
+    for i in range(num_transactions):
+      sender_index = rng.randrange(num_accounts_in_witness)
+      sender, recipient = sorted_addresses[sender_index], rng.choice(sorted_addresses)
+      amount = rng.randint(0, 2**20)
+      transactions.append(merkle_token_tools.make_transaction(secrets[sender], sender_index, recipient, amount, pre_root, i))
+      balances[sender] -= amount
+      balances[recipient] += amount
+      updates[sender] = balances[sender]
+      updates[recipient] = balances[recipient]
+    return sorted_addresses, transactions, updates
+
+  return [block]*num_blocks
+
+
+##############
+# Benchmarks #
+##############
+
+# blocks/s of a chain verified one block at a time, as main() would, and of the pipeline with threads, and with a process pool for verification
+# each run starts from the same accounts and signs the same transfers, so every run must end at the same root
+def benchmark_pipeline(num_accounts_total=2**10, num_blocks=12, num_accounts_in_witness=[16, 256], num_transactions=8, num_workers=None, queue_size=4):
+  merkle_token.num_address_bits = 256
+  merkle_token.num_address_bytes = 32
+  secrets, accounts = merkle_token_tools.generate_signing_accounts(num_accounts_total)
+  sorted_accounts = sorted((int(address,2), balance) for address, balance in accounts.items())
+  num_workers = num_workers or os.cpu_count() or 1
+  for numacctsinwitness in num_accounts_in_witness:
+    roots = []
+    # one block at a time, with the same stages in order
+    tree = merkle_token_tools.MerkleTree.from_sorted_accounts(sorted_accounts)
+    merkle_token.set_state_root(tree.root_hash())
+    start = time.perf_counter()
+    for block in random_transfer_blocks(secrets, num_blocks, numacctsinwitness, num_transactions):
+      sorted_addresses, transactions, updates = block(tree)
+      merkle_token.main(bytes(tree.build_calldata(sorted_addresses, transactions)))
+      tree.apply_block(updates)
+    seconds = time.perf_counter()-start
+    roots.append(merkle_token.get_state_root())
+    print("accounts in witness:", numacctsinwitness, "  transactions per block:", num_transactions)
+    print("  one at a time        blocks/s:", round(num_blocks/seconds, 2))
+    for workers in ('threads', 'processes'):
+      tree = merkle_token_tools.MerkleTree.from_sorted_accounts(sorted_accounts)
+      merkle_token.set_state_root(tree.root_hash())
+      stats = PipelineStats()
+      blocks = random_transfer_blocks(secrets, num_blocks, numacctsinwitness, num_transactions)
+      if workers == 'threads':
+        roots.append(run_chain(tree, blocks, num_workers, queue_size, stats=stats))
+      else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+          roots.append(run_chain(tree, blocks, num_workers, queue_size, executor, stats))
+      print("  pipeline with", workers.ljust(10), "blocks/s:", round(stats.blocks_per_second(), 2), "  ms per block,", \
+            ", ".join(stage+": "+str(round(stats.stage_seconds[stage]*1000/num_blocks, 1)) for stage in stages), \
+            "  mean queue depths,", ", ".join(name+": "+str(round(stats.queue_depth_sums[name]/stats.num_samples, 2)) for name in queues))
+    assert len(set(roots)) == 1
+
+
+
+if __name__ == "__main__":
+  benchmark_pipeline()
@@ -0,0 +1,191 @@
+# Ed25519 signatures in pure Python, following RFC 8032, for the contract written in Python
+# this is a reference for verification speed and correctness, it is not constant-time, so don't sign with keys that matter
+
+import hashlib
+import os
+
+
+# curve constants
+p = 2**255 - 19
+L = 2**252 + 27742317777372353535851937790883648493	# order of the base point
+d = -121665 * pow(121666, p-2, p) % p
+sqrt_m1 = pow(2, (p-1)//4, p)
+
+
+####################
+# Point Arithmetic #
+####################
+
+# points are in extended coordinates (X, Y, Z, T), where x=X/Z, y=Y/Z, and x*y=T/Z
+
+identity = (0, 1, 1, 0)
+
+def point_add(P, Q):
+  A = (P[1]-P[0]) * (Q[1]-Q[0]) % p
+  B = (P[1]+P[0]) * (Q[1]+Q[0]) % p
+  C = 2 * P[3] * Q[3] * d % p
+  D = 2 * P[2] * Q[2] % p
+  E, F, G, H = B-A, D-C, D+C, B+A
+  return (E*F % p, G*H % p, F*G % p, E*H % p)
+
+def point_double(P):
+  A = P[0]*P[0] % p
+  B = P[1]*P[1] % p
+  C = 2*P[2]*P[2] % p
+  H = A+B
+  E = H - (P[0]+P[1])*(P[0]+P[1])
+  G = A-B
+  F = C+G
+  return (E*F % p, G*H % p, F*G % p, E*H % p)
+
+def point_negate(P):
+  return (-P[0] % p, P[1], P[2], -P[3] % p)
+
+# whether 8*P is the identity, i.e. P is the identity up to the small subgroup
+def point_is_small_order(P):
+  P = point_double(point_double(point_double(P)))
+  return P[0] % p == 0 and (P[1]-P[2]) % p == 0
+
+# sum of scalars[i]*points[i], with Straus's method: the doublings are shared by all points, and each point adds a 4-bit window of its scalar
+def multiscalar_mul(scalars, points):
+  tables = []
+  for P in points:
+    table = [P]	# table[j] is (j+1)*P
+    for j in range(14):
+      table.append(point_add(table[-1], P))
+    tables.append(table)
+  Q = identity
+  for window in reversed(range((max(scalars).bit_length()+3)//4)):
+    if Q is not identity:
+      Q = point_double(point_double(point_double(point_double(Q))))
+    shift = 4*window
+    for scalar, table in zip(scalars, tables):
+      digit = (scalar >> shift) & 15
+      if digit:
+        Q = point_add(Q, table[digit-1])
+  return Q
+
+def scalar_mul(scalar, P):
+  return multiscalar_mul([scalar], [P])
+
+
+###################
+# Point Encodings #
+###################
+
+def recover_x(y, sign):
+  if y >= p:
+    return None
+  x2 = (y*y-1) * pow(d*y*y+1, p-2, p) % p
+  if x2 == 0:
+    return None if sign else 0
+  x = pow(x2, (p+3)//8, p)
+  if (x*x - x2) % p != 0:
+    x = x * sqrt_m1 % p
+  if (x*x - x2) % p != 0:
+    return None
+  if (x & 1) != sign:
+    x = p - x
+  return x
+
+# returns None if the encoding isn't a point
+def point_decompress(encoding):
+  if len(encoding) != 32:
+    return None
+  y = int.from_bytes(encoding, 'little')
+  sign = y >> 255
+  y &= (1 << 255) - 1
+  x = recover_x(y, sign)
+  if x is None:
+    return None
+  return (x, y, 1, x*y % p)
+
+def point_compress(P):
+  z_inverse = pow(P[2], p-2, p)
+  x = P[0] * z_inverse % p
+  y = P[1] * z_inverse % p
+  return (y | ((x & 1) << 255)).to_bytes(32, 'little')
+
+base_y = 4 * pow(5, p-2, p) % p
+base_x = recover_x(base_y, 0)
+base = (base_x, base_y, 1, base_x*base_y % p)
+
+
+#########################
+# Signing and Verifying #
+#########################
+
+def sha512_mod_L(*parts):
+  return int.from_bytes(hashlib.sha512(b''.join(parts)).digest(), 'little') % L
+
+def secret_to_scalar_and_prefix(secret):
+  h = hashlib.sha512(secret).digest()
+  a = int.from_bytes(h[:32], 'little')
+  a &= (1 << 254) - 8
+  a |= (1 << 254)
+  return a, h[32:]
+
+def public_key(secret):
+  a, prefix = secret_to_scalar_and_prefix(secret)
+  return point_compress(scalar_mul(a, base))
+
+def sign(secret, message):
+  a, prefix = secret_to_scalar_and_prefix(secret)
+  A = point_compress(scalar_mul(a, base))
+  r = sha512_mod_L(prefix, message)
+  R = point_compress(scalar_mul(r, base))
+  k = sha512_mod_L(R, A, message)
+  s = (r + k*a) % L
+  return R + s.to_bytes(32, 'little')
+
+# decodes a public key, message, and signature to the points A and R, and the scalars S and k, or returns None if an encoding is invalid
+def decode(public_key, message, signature):
+  if len(signature) != 64:
+    return None
+  A = point_decompress(public_key)
+  R = point_decompress(signature[:32])
+  S = int.from_bytes(signature[32:], 'little')
+  if A is None or R is None or S >= L:
+    return None
+  k = sha512_mod_L(signature[:32], public_key, message)
+  return A, R, S, k
+
+# the cofactored check 8*S*B == 8*R + 8*k*A, which is the check that batch verification can match exactly
+def verify(public_key, message, signature):
+  decoded = decode(public_key, message, signature)
+  if decoded is None:
+    return False
+  A, R, S, k = decoded
+  return point_is_small_order(point_add(multiscalar_mul([S, L-k], [base, A]), point_negate(R)))
+
+
+# the signature verifiers below can each be plugged into merkle_token.Verifier
+# each takes a list of (public key, message, signature) and returns whether they are all valid
+
+def verify_each(items):
+  return all(verify(*item) for item in items)
+
+# checks a random linear combination of the verification equations, which holds for all items if it holds, except with probability 2**-128
+# the sum is a single multiscalar multiplication, so doublings are shared, and the random scalars are half length, about 2x faster per signature for large batches
+def verify_batch(items):
+  if len(items) <= 1:
+    return verify_each(items)
+  scalars = [0]
+  points = [base]
+  for item in items:
+    decoded = decode(*item)
+    if decoded is None:
+      return False
+    A, R, S, k = decoded
+    z = int.from_bytes(os.urandom(16), 'little')
+    scalars[0] += z*S
+    scalars += [z, z*k % L]
+    points += [point_negate(R), point_negate(A)]
+  scalars[0] %= L
+  return point_is_small_order(multiscalar_mul(scalars, points))
+
+# verifies batches concurrently with executor, e.g. a concurrent.futures.ProcessPoolExecutor, for large blocks
+# to plug into merkle_token.Verifier, bind the executor with functools.partial(verify_batch_in_pool, executor=executor)
+def verify_batch_in_pool(items, executor, batch_size=64):
+  batches = [items[i:i+batch_size] for i in range(0, len(items), batch_size)]
+  return all(executor.map(verify_batch, batches))
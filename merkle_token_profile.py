@@ -0,0 +1,161 @@
+# instrumentation for the contract written in Python: phase timers, hash counters, an opcode histogram, and the deepest recursion, collected by InstrumentedVerifier
+# merkle_token.Verifier has no instrumentation in it, so verification costs nothing extra unless an InstrumentedVerifier is used instead
+#   stats = VerifierStats()
+#   merkle_token.main(calldata, InstrumentedVerifier(stats))
+#   stats.report()
+# profile_main() runs merkle_token.main() under cProfile, or with the perf trampoline so that Linux perf sees Python function names
+
+import merkle_token
+
+import collections
+import cProfile
+import pstats
+import sys
+import time
+
+
+# phases of Verifier.verify() in the order they run, addresses are recovered during merkleization, so recovery is timed as part of it
+phases = ['decode_calldata', 'execute_transactions', 'merkleize', 'verify_signatures', 'check_credits']
+
+
+##############
+# Collection #
+##############
+
+# totals over every verification by the InstrumentedVerifiers collecting into it
+class VerifierStats:
+  __slots__ = ('num_verifications', 'phase_seconds', 'num_hash_calls', 'num_bytes_hashed', 'opcodes', 'num_leaves', 'max_recursion_depth')
+
+  def __init__(self):
+    self.num_verifications = 0
+    self.phase_seconds = collections.Counter()
+    self.num_hash_calls = 0
+    self.num_bytes_hashed = 0
+    # binary opcodes as '11', '10', '01', '00', and for wider trees 'chunk' or the number of present children, e.g. 'present 3'
+    self.opcodes = collections.Counter()
+    self.num_leaves = 0
+    self.max_recursion_depth = 0	# deepest nesting of merkleization calls, at most the number of opcodes on a path plus one
+
+  def as_dict(self):
+    return {'num_verifications': self.num_verifications, 'phase_seconds': {phase: self.phase_seconds[phase] for phase in phases}, \
+            'num_hash_calls': self.num_hash_calls, 'num_bytes_hashed': self.num_bytes_hashed, 'opcodes': dict(sorted(self.opcodes.items())), \
+            'num_leaves': self.num_leaves, 'max_recursion_depth': self.max_recursion_depth}
+
+  def report(self):
+    print("verifications:", self.num_verifications)
+    for phase in phases:
+      print("  ", phase.ljust(20), "ms:", round(self.phase_seconds[phase]*1000, 3))
+    print("hash calls:", self.num_hash_calls, "  bytes hashed:", self.num_bytes_hashed, "  leaves:", self.num_leaves, "  max recursion depth:", self.max_recursion_depth)
+    print("opcodes:", dict(sorted(self.opcodes.items())))
+
+
+# a Verifier which collects into stats, and prints each node if merkle_token.verbose is set
+# for Verifier.verify_parallel(), only the top of the tree is counted, since the subtrees are merkleized by plain Verifiers in workers
+class InstrumentedVerifier(merkle_token.Verifier):
+  __slots__ = ('stats', 'recursion_depth')
+
+  def __init__(self, stats, signature_verifier=None):
+    merkle_token.Verifier.__init__(self, signature_verifier)
+    self.stats = stats
+    self.recursion_depth = 0
+
+  # calls method, adding the seconds it takes to phase
+  def timed(self, phase, method, *args):
+    start = time.perf_counter()
+    try:
+      return method(self, *args)
+    finally:
+      self.stats.phase_seconds[phase] += time.perf_counter()-start
+
+  def verify(self, calldata, pre_root):
+    self.stats.num_verifications += 1
+    return merkle_token.Verifier.verify(self, calldata, pre_root)
+
+  def verify_parallel(self, calldata, pre_root, executor, split_levels=2):
+    self.stats.num_verifications += 1
+    return merkle_token.Verifier.verify_parallel(self, calldata, pre_root, executor, split_levels)
+
+  def decode_calldata(self, calldata):
+    return self.timed('decode_calldata', merkle_token.Verifier.decode_calldata, calldata)
+
+  def execute_transactions(self):
+    return self.timed('execute_transactions', merkle_token.Verifier.execute_transactions)
+
+  def verify_signatures(self, pre_state_root):
+    return self.timed('verify_signatures', merkle_token.Verifier.verify_signatures, pre_state_root)
+
+  def check_credits(self):
+    return self.timed('check_credits', merkle_token.Verifier.check_credits)
+
+  def hash_bytes(self, left, right=b''):
+    self.stats.num_hash_calls += 1
+    self.stats.num_bytes_hashed += len(left)+len(right)
+    return merkle_token.Verifier.hash_bytes(self, left, right)
+
+  # counts a node, then merkleizes it with method, which is timed as a whole from the outermost call
+  def merklize_node(self, method, address_prefix, depth):
+    stats = self.stats
+    self.recursion_depth += 1
+    if self.recursion_depth > stats.max_recursion_depth:
+      stats.max_recursion_depth = self.recursion_depth
+    try:
+      if self.recursion_depth == 1:
+        return self.timed('merkleize', method, address_prefix, depth)
+      return method(self, address_prefix, depth)
+    finally:
+      self.recursion_depth -= 1
+
+  def merklize_old_and_new_root(self, address_prefix, depth):
+    if depth == self.num_address_bits:
+      self.stats.num_leaves += 1
+      if merkle_token.verbose: print("merklize_old_and_new_root(",depth,")  leaf")
+    elif self.tree_arity == 2:
+      opcode = self.tree_encoding[self.opcode_idx]
+      self.stats.opcodes[format(opcode, '02b')] += 1
+      if merkle_token.verbose: print("merklize_old_and_new_root(",depth,")  opcode",opcode)
+    return self.merklize_node(merkle_token.Verifier.merklize_old_and_new_root, address_prefix, depth)
+
+  def merklize_old_and_new_root_kary(self, address_prefix, depth):
+    if depth < self.num_address_bits:
+      present = int.from_bytes(self.tree_encoding[self.opcode_idx:self.opcode_idx+(self.tree_arity+7)//8],'little')
+      self.stats.opcodes['present '+str(bin(present).count('1')) if present else 'chunk'] += 1
+      if merkle_token.verbose: print("merklize_old_and_new_root_kary(",depth,")  bitmap",bin(present))
+    return self.merklize_node(merkle_token.Verifier.merklize_old_and_new_root_kary, address_prefix, depth)
+
+
+#############
+# Profiling #
+#############
+
+# runs merkle_token.main(calldata, verifier) under cProfile
+# with output, the profile is saved there for pstats, snakeviz, etc., otherwise the top limit functions are printed, sorted by sort
+# with perf, there is no cProfile, but Python frames show up in `perf record` of this process, which needs Python 3.12 or newer on Linux
+# the perf trampoline can also be on for a whole run, with `perf record -g python3 -X perf ...`
+def profile_main(calldata, verifier=None, output=None, sort='cumulative', limit=25, perf=False):
+  if perf:
+    if not hasattr(sys, 'activate_stack_trampoline'):
+      raise RuntimeError("the perf trampoline needs Python 3.12 or newer on Linux")
+    sys.activate_stack_trampoline('perf')
+    try:
+      merkle_token.main(calldata, verifier)
+    finally:
+      sys.deactivate_stack_trampoline()
+    return
+  profiler = cProfile.Profile()
+  profiler.runcall(merkle_token.main, calldata, verifier)
+  if output:
+    profiler.dump_stats(output)
+  else:
+    pstats.Stats(profiler).sort_stats(sort).print_stats(limit)
+
+
+
+if __name__ == "__main__":
+  import merkle_token_tools
+  merkle_tree, calldata = merkle_token_tools.generate_random_test(num_accounts_total=2**16, num_accounts_in_witness=1000)
+  calldata = bytes(calldata)
+  stats = VerifierStats()
+  merkle_token.main(calldata, InstrumentedVerifier(stats))
+  stats.report()
+  merkle_token.set_state_root(merkle_tree[''][0])
+  profile_main(calldata)
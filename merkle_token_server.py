@@ -0,0 +1,333 @@
+# a local proof server, which loads a MerkleTree once and answers requests for proofs of addresses against its root, over TCP on localhost or a Unix socket
+# requests and responses are JSON, one per line, and a connection may have up to max_requests_in_flight requests in flight, whose responses are matched by id
+#   request:  {"id": 1, "addresses": ["<hex address>", ...], "root": "<hex root>"}	the root is optional, and if given must be the tree's root
+#   response: {"id": 1, "root": "<hex root>", "calldata": "<hex calldata>"}, or {"id": 1, "error": "..."}
+#   {"id": 2, "stats": true} is answered with the server's latency percentiles and batch counts, see ProofServer.stats()
+# requests which arrive within coalesce_seconds of each other are built in one walk of the tree by MerkleTree.build_calldatas(), and identical requests share one proof
+#   python3 merkle_token_server.py serve --num-accounts-total 65536 --port 8545
+#   python3 merkle_token_server.py bench
+
+import merkle_token
+import merkle_token_tools
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import random
+import time
+
+
+# a line can hold the calldata of a large proof in hex
+max_line_bytes = 2**26
+
+# requests in flight on one connection, beyond which the server stops reading its requests until one is answered
+max_requests_in_flight = 256
+
+
+##########
+# Server #
+##########
+
+class ProofServer:
+  __slots__ = ('tree', 'coalesce_seconds', 'max_batch_requests', 'executor', 'pending', 'flush_handle', 'tasks', 'server', 'connections',
+               'latencies', 'num_requests', 'num_batches', 'num_builds')
+
+  # coalesce_seconds is how long the first request of a batch waits for others, 0 builds each request by itself
+  # a batch is built as soon as it has max_batch_requests requests
+  def __init__(self, tree, coalesce_seconds=0.002, max_batch_requests=256):
+    self.tree = tree
+    self.coalesce_seconds = coalesce_seconds
+    self.max_batch_requests = max_batch_requests
+    # the tree is only used from this one thread, so builds and updates never overlap, and the event loop keeps accepting requests meanwhile
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self.pending = []		# (sorted addresses, root, future) of requests waiting for the next batch
+    self.flush_handle = None	# the timer which builds the pending batch
+    self.tasks = set()		# batches being built, kept until they are done
+    self.server = None
+    self.connections = {}	# writer of each open connection, by the task handling it
+    self.latencies = merkle_token_tools.LatencyStats()	# from a request's arrival until its proof is ready
+    self.num_requests = 0
+    self.num_batches = 0
+    self.num_builds = 0		# distinct witnesses built, identical requests in a batch are built once
+
+  # listens on a Unix socket at path, or on TCP at host and port, port 0 picks a free one, returns the socket's address
+  async def start(self, host='127.0.0.1', port=0, path=None):
+    if path is not None:
+      self.server = await asyncio.start_unix_server(self.handle_connection, path, limit=max_line_bytes)
+    else:
+      self.server = await asyncio.start_server(self.handle_connection, host, port, limit=max_line_bytes)
+    return self.server.sockets[0].getsockname()
+
+  # stops listening, then closes open connections once their requests in flight are answered
+  async def close(self):
+    if self.server is not None:
+      self.server.close()
+      await self.server.wait_closed()
+    for writer in self.connections.values():
+      writer.close()
+    if self.connections:
+      await asyncio.wait(list(self.connections))
+    self.executor.shutdown()
+
+  # the proof of addresses, which are bit strings, against root, or against the tree's root if root is None
+  # returns the root and the calldata, raises ValueError for another root, and KeyError for an address which is not in the tree
+  async def request_proof(self, addresses, root=None):
+    start = time.perf_counter()
+    self.num_requests += 1
+    future = asyncio.get_running_loop().create_future()
+    self.pending.append((sorted(set(addresses)), root, future))
+    if not self.coalesce_seconds or len(self.pending) >= self.max_batch_requests:
+      self.flush()
+    elif self.flush_handle is None:
+      self.flush_handle = asyncio.get_running_loop().call_later(self.coalesce_seconds, self.flush)
+    try:
+      return await future
+    finally:
+      self.latencies.record(time.perf_counter()-start)
+
+  # applies a block of balance updates to the tree, see MerkleTree.apply_block(), after the batches already being built
+  async def apply_block(self, updates):
+    await asyncio.get_running_loop().run_in_executor(self.executor, self.tree.apply_block, updates)
+
+  def flush(self):
+    if self.flush_handle is not None:
+      self.flush_handle.cancel()
+      self.flush_handle = None
+    batch, self.pending = self.pending, []
+    if batch:
+      task = asyncio.ensure_future(self.build(batch))
+      self.tasks.add(task)
+      task.add_done_callback(self.tasks.discard)
+
+  async def build(self, batch):
+    self.num_batches += 1
+    try:
+      results = await asyncio.get_running_loop().run_in_executor(self.executor, self.build_batch, [(addresses, root) for addresses, root, future in batch])
+    except Exception as e:
+      results = [e]*len(batch)
+    for (addresses, root, future), result in zip(batch, results):
+      if future.done():
+        continue
+      if isinstance(result, Exception):
+        future.set_exception(result)
+      else:
+        future.set_result(result)
+
+  # in the executor's thread, returns (root, calldata) or an exception for each request
+  def build_batch(self, requests):
+    root = self.tree.root_hash()
+    witnesses = {}
+    for addresses, request_root in requests:
+      if request_root in (None, root):
+        witnesses.setdefault(tuple(addresses), None)
+    self.num_builds += len(witnesses)
+    try:
+      calldatas = self.tree.build_calldatas(list(witnesses))
+      for witness, calldata in zip(witnesses, calldatas):
+        witnesses[witness] = (root, bytes(calldata))
+    except (KeyError, ValueError):
+      # a witness which can't be built fails only the requests with it
+      for witness in witnesses:
+        try:
+          witnesses[witness] = (root, bytes(self.tree.build_calldata(witness)))
+        except KeyError as e:
+          witnesses[witness] = KeyError("address is not in the tree: "+hex(int(e.args[0],2)))
+        except ValueError as e:
+          witnesses[witness] = e
+    return [witnesses[tuple(addresses)] if request_root in (None, root) else ValueError("root "+str(request_root)+" is not the served root "+str(root))
+            for addresses, request_root in requests]
+
+  # build_latency is the time of each build_calldatas() call
+  def stats(self):
+    return {'requests': self.num_requests, 'batches': self.num_batches, 'builds': self.num_builds, 'latency': self.latencies.as_dict(),
+            'build_latency': self.tree.build_latencies.as_dict()}
+
+  async def handle_connection(self, reader, writer):
+    self.connections[asyncio.current_task()] = writer
+    lock = asyncio.Lock()
+    tasks = set()
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        if len(tasks) >= max_requests_in_flight:
+          await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.ensure_future(self.handle_request(line, writer, lock))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    except (ConnectionError, ValueError):
+      pass
+    finally:
+      if tasks:
+        await asyncio.wait(tasks)
+      writer.close()
+      del self.connections[asyncio.current_task()]
+
+  async def handle_request(self, line, writer, lock):
+    request_id = None
+    try:
+      request = json.loads(line)
+      request_id = request.get('id')
+      if request.get('stats'):
+        response = {'id': request_id, 'stats': self.stats()}
+      else:
+        num_address_bits = self.tree.num_address_bits
+        addresses = []
+        for address in request['addresses']:
+          value = int(address,16)
+          if not 0 <= value < 2**num_address_bits:
+            raise ValueError("address is not a "+str(num_address_bits)+" bit unsigned integer: "+address)
+          addresses.append(bin(value)[2:].zfill(num_address_bits))
+        root, calldata = await self.request_proof(addresses, request.get('root'))
+        response = {'id': request_id, 'root': root, 'calldata': calldata.hex()}
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+      response = {'id': request_id, 'error': str(e.args[0]) if e.args else type(e).__name__}
+    async with lock:
+      writer.write(json.dumps(response).encode()+b'\n')
+      await writer.drain()
+
+
+##########
+# Client #
+##########
+
+# a pool of up to pool_size connections to a ProofServer, each carrying one request at a time, which are reused by later requests
+class ProofClient:
+  __slots__ = ('host', 'port', 'path', 'pool_size', 'idle', 'num_open', 'next_id', 'latencies')
+
+  def __init__(self, host='127.0.0.1', port=None, path=None, pool_size=8):
+    self.host = host
+    self.port = port
+    self.path = path
+    self.pool_size = pool_size
+    self.idle = asyncio.Queue()	# open connections as (reader, writer)
+    self.num_open = 0
+    self.next_id = 0
+    self.latencies = merkle_token_tools.LatencyStats()	# from sending a request until its response is read, including waiting for a connection
+
+  async def connect(self):
+    if self.path is not None:
+      return await asyncio.open_unix_connection(self.path, limit=max_line_bytes)
+    return await asyncio.open_connection(self.host, self.port, limit=max_line_bytes)
+
+  async def acquire(self):
+    if self.idle.empty() and self.num_open < self.pool_size:
+      self.num_open += 1
+      try:
+        return await self.connect()
+      except BaseException:
+        self.num_open -= 1
+        raise
+    return await self.idle.get()
+
+  # returns the root and the calldata, raises ValueError with the server's error
+  async def get_proof(self, addresses, root=None):
+    start = time.perf_counter()
+    self.next_id += 1
+    request = {'id': self.next_id, 'addresses': [format(int(address,2), 'x') for address in addresses]}
+    if root is not None:
+      request['root'] = root
+    response = await self.call(request)
+    self.latencies.record(time.perf_counter()-start)
+    if 'error' in response:
+      raise ValueError(response['error'])
+    return response['root'], bytes.fromhex(response['calldata'])
+
+  async def get_stats(self):
+    self.next_id += 1
+    return (await self.call({'id': self.next_id, 'stats': True}))['stats']
+
+  async def call(self, request):
+    reader, writer = await self.acquire()
+    try:
+      writer.write(json.dumps(request).encode()+b'\n')
+      await writer.drain()
+      line = await reader.readline()
+      if not line:
+        raise ConnectionError("server closed the connection")
+    except BaseException:
+      self.num_open -= 1
+      writer.close()
+      raise
+    self.idle.put_nowait((reader, writer))
+    return json.loads(line)
+
+  async def close(self):
+    while not self.idle.empty():
+      reader, writer = self.idle.get_nowait()
+      writer.close()
+      await writer.wait_closed()
+      self.num_open -= 1
+
+
+##############
+# Benchmarks #
+##############
+
+# requests/s and latency percentiles seen by clients, with and without coalescing, for a server and clients in this process on localhost
+# each client sends its requests one after another, so the number of clients is the number of requests in flight
+# a hot fraction of the requests pick their addresses from a few hot accounts, like wallets polling popular contracts, the rest from all accounts
+def benchmark_server(num_address_bits=160, num_accounts_total=2**16, num_clients=[1, 16, 64], num_requests=1000, num_addresses_per_request=10,
+                     coalesce_seconds=[0, 0.002], hot_fraction=0.5, num_hot_accounts=256):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  sorted_accounts = sorted({random.randint(0,2**num_address_bits-1):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}.items())
+  addresses = [bin(address)[2:].zfill(num_address_bits) for address, balance in sorted_accounts]
+  hot = random.sample(addresses, num_hot_accounts)
+  requests = [random.sample(hot if random.random() < hot_fraction else addresses, num_addresses_per_request) for i in range(num_requests)]
+  tree = merkle_token_tools.MerkleTree.from_sorted_accounts(sorted_accounts)
+
+  async def run(numclients, coalesce):
+    server = ProofServer(tree, coalesce)
+    host, port = await server.start()
+    client = ProofClient(host, port, pool_size=numclients)
+    queue = collections.deque(requests)
+    async def work():
+      while queue:
+        root, calldata = await client.get_proof(queue.popleft())
+    start = time.perf_counter()
+    await asyncio.gather(*[work() for i in range(numclients)])
+    seconds = time.perf_counter()-start
+    stats = await client.get_stats()
+    await client.close()
+    await server.close()
+    latency = client.latencies.as_dict()
+    print("clients:", numclients, "  coalesce ms:", coalesce*1000, "  requests/s:", round(num_requests/seconds), \
+          "  latency ms p50:", round(latency['p50_ms'], 2), "p90:", round(latency['p90_ms'], 2), "p99:", round(latency['p99_ms'], 2), \
+          "  requests per batch:", round(stats['requests']/stats['batches'], 1), "  builds per batch:", round(stats['builds']/stats['batches'], 1))
+
+  for numclients in num_clients:
+    for coalesce in coalesce_seconds:
+      asyncio.run(run(numclients, coalesce))
+
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="serve Merkle proofs for a tree on this machine, or load test a server in this process")
+  commands = parser.add_subparsers(dest='command', required=True)
+  serve = commands.add_parser('serve', help="serve proofs until interrupted")
+  serve.add_argument('--snapshot', help="a snapshot from MerkleTree.save_snapshot(), otherwise random accounts")
+  serve.add_argument('--num-accounts-total', type=int, default=2**16)
+  serve.add_argument('--host', default='127.0.0.1')
+  serve.add_argument('--port', type=int, default=8545)
+  serve.add_argument('--unix', help="a Unix socket path to listen on instead of TCP")
+  serve.add_argument('--coalesce-ms', type=float, default=2)
+  commands.add_parser('bench', help="run benchmark_server()")
+  args = parser.parse_args()
+
+  if args.command == 'serve':
+    if args.snapshot:
+      tree = merkle_token_tools.MerkleTree.load_snapshot(args.snapshot)
+    else:
+      tree = merkle_token_tools.MerkleTree.from_sorted_accounts(sorted({random.getrandbits(merkle_token.num_address_bits):random.getrandbits(merkle_token.num_balance_bits) \
+                                                                        for i in range(args.num_accounts_total)}.items()))
+    async def serve_forever():
+      server = ProofServer(tree, args.coalesce_ms/1000)
+      print("serving root", tree.root_hash(), "on", await server.start(args.host, args.port, args.unix))
+      await server.server.serve_forever()
+    asyncio.run(serve_forever())
+  else:
+    benchmark_server()
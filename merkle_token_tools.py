@@ -4,9 +4,30 @@
 
 # import the token contract code, which has constants the hashing function
 import merkle_token
+import merkle_token_ed25519
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import csv
+import functools
+import hashlib
+import heapq
+import itertools
 import math
+import mmap
+import multiprocessing
+import os
 import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from multiprocessing import shared_memory
 
 
 # flip this flag if you want more printed
@@ -17,40 +38,101 @@ verbose = 0
 # Build Merkle Tree or Data for Merkle Proof #
 ##############################################
 
+# bytes per hash by depth for the current constants in merkle_token, see merkle_token.hash_length_schedule
+def current_hash_lengths():
+  return merkle_token.hash_lengths(merkle_token.hash_length_schedule, merkle_token.num_hash_bytes, merkle_token.num_address_bits)
+
+# with merkle_token.key_hash_salt, accounts are in the tree at their keys, see merkle_token.tree_key()
+# the key of an address, both as bit strings
+def tree_key(address):
+  key = merkle_token.tree_key(int(address,2).to_bytes(merkle_token.num_address_bytes,'big'), merkle_token.key_hash_salt, merkle_token.num_address_bits)
+  return bin(int.from_bytes(key,'big'))[2:].zfill(merkle_token.num_address_bits)
+
+# accounts at their keys, for build_merkle_tree() and build_merkle_proof()
+def keyed_accounts(accounts):
+  return {tree_key(address):balance for address, balance in accounts.items()}
+
+# the sorted keys of a witness's addresses for build_merkle_proof(), and the addresses in the order of their keys, for the addresses section of calldata
+def keyed_witness(addresses):
+  keys = {address:tree_key(address) for address in addresses}
+  addresses = sorted(addresses, key=keys.get)
+  return [keys[address] for address in addresses], addresses
+
+# a leaf's hash is of its big-endian address followed by its little-endian balance, like merkle_token.hash_bytes() with a copy of the parameterized blake2b state
+def leaf_digest(hash_state, address_as_bytes, balance, num_balance_bytes):
+  h = hash_state.copy()
+  h.update(address_as_bytes)
+  h.update(balance.to_bytes(num_balance_bytes, 'little'))
+  return h.digest()
+
+# leaf subtrees for merkleize_sorted() from (address, balance) pairs with int addresses in increasing order, which may be a generator
+#   new_leaf(i, address, balance, address_as_bytes, digest) stores the i-th leaf, and returns its node
+def hash_leaves(sorted_accounts, num_address_bytes, num_balance_bytes, hash_state, new_leaf):
+  for i, (address, balance) in enumerate(sorted_accounts):
+    address_as_bytes = address.to_bytes(num_address_bytes, 'big')
+    digest = leaf_digest(hash_state, address_as_bytes, balance, num_balance_bytes)
+    yield new_leaf(i, address, balance, address_as_bytes, digest), digest, address, address
+
+# the binary tree over subtrees in increasing order of address, built bottom-up in one pass, without recursion or copying lists
+#   subtrees are (node, digest, first address, last address) with int addresses and whole digests, usually leaves from hash_leaves(), which may be a generator
+#   neighbouring subtrees first differ at the depth where their lowest common ancestor branches
+#   a stack holds finished subtrees whose right sibling is not finished yet, each with the branch depth to its right, at most one per depth
+#   a subtree is finished once the next branch depth to its right is shallower than the one on top of the stack
+#   each child's hash is truncated to the bytes per hash where its edge starts, one below where its parent branches, see merkle_token.hash_length_schedule
+#   new_node(branch_depth, left, right, digest) stores each internal node, in depth-first post-order, and returns its node
+#   finished(node, digest, start), if given, is called for each node once the depth where its edge starts is known, also in depth-first post-order
+# returns the root and its whole digest, or None and None if there are no subtrees
+def merkleize_sorted(subtrees, num_address_bits, hash_state, hash_lengths, new_node, finished=None):
+  stack = [] # (node, digest, branch depth to the right)
+  pending = None # the previous subtree, waiting for the next one to know its branch depth to the right
+  for subtree in itertools.chain(subtrees, [None]):
+    if pending is not None:
+      node, digest, first, last = pending
+      right_gap = num_address_bits - (last ^ subtree[2]).bit_length() if subtree is not None else -1
+      # internal nodes which are finished by this subtree
+      while stack and stack[-1][2] > right_gap:
+        left, left_digest, branch_depth = stack.pop()
+        if finished:
+          finished(node, digest, branch_depth+1)
+        n = hash_lengths[branch_depth+1]
+        h = hash_state.copy()
+        h.update(left_digest[:n])
+        h.update(digest[:n])
+        digest = h.digest()
+        node = new_node(branch_depth, left, node, digest)
+      # a node's edge starts one below its parent, which branches at the deeper of the two branch depths on either side of it
+      if finished:
+        finished(node, digest, (stack[-1][2] if stack and stack[-1][2] > right_gap else right_gap)+1)
+      stack.append((node, digest, right_gap))
+    pending = subtree
+  return stack[0][:2] if stack else (None, None)
+
 # the merkle tree is stored as a dictionary
 #   keys are address prefix which correspond to nodes
 #   values are the hash of that node (as a merkle tree), and the edge label (as a radix tree)
+# the tree is built with merkleize_sorted(), and nodes are added to merkle_tree in depth-first post-order
+# each hash is truncated to the bytes per hash where the node's edge starts, see merkle_token.hash_length_schedule, so it is stored as proofs and parents use it
 def build_merkle_tree(depth,sorted_addresses,accounts,merkle_tree):
   assert len(sorted_addresses)>0 # sorted_addresses is a nonempty list of addresses, also must be sorted
-  assert (depth==0 and len(merkle_tree)==0) or depth>0 # merkle_tree is empty when this func is first called at depth 0
-  # if leaf
-  if len(sorted_addresses) == 1:
-    addr = sorted_addresses[0]
-    addr_as_bytes = int(addr,2).to_bytes(merkle_token.num_address_bytes, byteorder='big')
-    balance_as_bits = bin(accounts[addr])[2:].zfill(merkle_token.num_balance_bits) #bin(int.from_bytes((accounts[addr]).to_bytes(merkle_token.num_balance_bytes, byteorder='little'), "big")[2:].zfill(merkle_token.num_balance_bits),2)
-    balance_as_bytes = int(balance_as_bits,2).to_bytes(merkle_token.num_balance_bytes, byteorder='little')
-    if verbose: print("going to hash addr balance",addr,accounts[addr],(addr_as_bytes+balance_as_bytes).hex())
-    if verbose: print("num_address_bytes",merkle_token.num_address_bytes)
-    current_hash = merkle_token.hash_(addr_as_bytes+balance_as_bytes)
-    merkle_tree[addr[:depth]] = (current_hash, addr[depth:])
-  else: # not leaf
-    # find common address chunk for sorted addresses
-    for d in range(depth,len(sorted_addresses[0])):
-      if sorted_addresses[0][d] != sorted_addresses[-1][d]:
-        break
-    address_prefix = sorted_addresses[0][:depth]
-    address_chunk = sorted_addresses[0][depth:d]
-    # split sorted_addresses where they diverge
-    for idx, address in enumerate(sorted_addresses):
-      if address[d] != '0':
-        break
-    # recurse left and right
-    left_hash = build_merkle_tree(d+1, sorted_addresses[:idx], accounts, merkle_tree)
-    right_hash = build_merkle_tree(d+1, sorted_addresses[idx:], accounts, merkle_tree)
-    hash_as_bytes = int(left_hash+right_hash,16).to_bytes(merkle_token.num_hash_bytes*2, byteorder='big')
-    current_hash = merkle_token.hash_(hash_as_bytes)
-    merkle_tree[address_prefix] = ( current_hash, address_chunk )
-  return current_hash
+  assert depth==0 and len(merkle_tree)==0 # merkle_tree is empty, and built from the root
+  if merkle_token.tree_arity != 2:
+    return build_kary_merkle_tree(depth,sorted_addresses,accounts,merkle_tree)
+  merkle_token.init_hash_state()
+  hash_state = merkle_token.hash_state
+  num_address_bits = merkle_token.num_address_bits
+  hash_lengths = current_hash_lengths()
+  # a node is the index of its first address, and the depth where its edge ends
+  def new_leaf(i, address, balance, address_as_bytes, digest):
+    return i, num_address_bits
+  def new_node(branch_depth, left, right, digest):
+    return left[0], branch_depth
+  def finished(node, digest, start):
+    first, end = node
+    addr = sorted_addresses[first]
+    merkle_tree[addr[:start]] = (digest[:hash_lengths[start]].hex(), addr[start:end])
+  leaves = hash_leaves(((int(addr,2), accounts[addr]) for addr in sorted_addresses), merkle_token.num_address_bytes, merkle_token.num_balance_bytes, hash_state, new_leaf)
+  root, digest = merkleize_sorted(leaves, num_address_bits, hash_state, hash_lengths, new_node, finished)
+  return digest[:hash_lengths[0]].hex()
 
 
 
@@ -59,6 +141,8 @@ def build_merkle_proof(depth,sorted_addresses,accounts,merkle_tree,tree_encoding
   #if verbose: print("build_merkle_proof(",depth,")")
   assert len(merkle_tree)>0 # the merkle tree exists, also built with build_merkle_tree() and contains the addresses in sorted_addresses
   assert len(sorted_addresses)>0 # sorted_addresses is a nonempty list of addresses, also must be sorted
+  if merkle_token.tree_arity != 2:
+    return build_kary_merkle_proof(depth,sorted_addresses,accounts,merkle_tree,tree_encoding,address_chunks,balances,proof_hashes)
   # get prefix of address at this depth
   address_prefix = sorted_addresses[0][:depth]
   # this function handles all proof hashes; traverses radix tree edges with labels longer than just '0' or '1'
@@ -128,6 +212,1078 @@ def build_merkle_proof(depth,sorted_addresses,accounts,merkle_tree,tree_encoding
     proof_hashes += reversed(proof_hashes_for_chunk)
 
 
+# build_merkle_tree() for a tree wider than binary, see merkle_token.tree_arity, recursively over ranges of the sorted addresses
+#   internal nodes branch at multiples of the bits per level, and a node's hash is the hash of its bitmap of present children followed by their hashes in order
+#   the dictionary has the same keys and values, so a node's children are at its key and edge label followed by each child's index as bits
+def build_kary_merkle_tree(depth,sorted_addresses,accounts,merkle_tree):
+  merkle_token.init_hash_state()
+  hash_state = merkle_token.hash_state
+  num_address_bits = merkle_token.num_address_bits
+  num_address_bytes = merkle_token.num_address_bytes
+  num_balance_bytes = merkle_token.num_balance_bytes
+  bits_per_level = merkle_token.tree_arity.bit_length()-1
+  bitmap_bytes = (merkle_token.tree_arity+7)//8
+  def build(depth, lo, hi):
+    first, last = sorted_addresses[lo], sorted_addresses[hi-1]
+    # the edge ends at the first level where the first and last addresses differ
+    end = depth
+    while end < num_address_bits and first[end:end+bits_per_level] == last[end:end+bits_per_level]:
+      end += bits_per_level
+    if end == num_address_bits: # leaf
+      digest = leaf_digest(hash_state, int(first,2).to_bytes(num_address_bytes, byteorder='big'), accounts[first], num_balance_bytes)
+    else:
+      h = hash_state.copy()
+      present = 0
+      child_hashes = []
+      for child, group in itertools.groupby(range(lo,hi), key=lambda i: sorted_addresses[i][end:end+bits_per_level]):
+        group = list(group)
+        present |= 1 << int(child,2)
+        child_hashes.append(build(end+bits_per_level, group[0], group[-1]+1))
+      h.update(present.to_bytes(bitmap_bytes, byteorder='little'))
+      for child_hash in child_hashes:
+        h.update(child_hash)
+      digest = h.digest()
+    merkle_tree[first[:depth]] = (digest.hex(), first[depth:end])
+    return digest
+  return build(depth, 0, len(sorted_addresses)).hex()
+
+# build_merkle_proof() for a tree wider than binary, with child bitmaps instead of opcodes, see merkle_token.kary_bitmaps()
+# proof hashes are in the order the verifier reaches them, each node's children in order, depth-first
+def build_kary_merkle_proof(depth,sorted_addresses,accounts,merkle_tree,tree_encoding,address_chunks,balances,proof_hashes):
+  bits_per_level = merkle_token.tree_arity.bit_length()-1
+  address_prefix = sorted_addresses[0][:depth]
+  _, edge_label = merkle_tree[address_prefix]
+  if len(edge_label)>0:
+    tree_encoding += [0]
+    address_chunks += [edge_label]
+  address_prefix += edge_label
+  end = depth+len(edge_label)
+  if end == merkle_token.num_address_bits: # leaf
+    balances += [accounts[sorted_addresses[0]]]
+    return
+  children = [format(child,'0'+str(bits_per_level)+'b') for child in range(merkle_token.tree_arity)]
+  present = 0
+  for child in range(merkle_token.tree_arity):
+    if address_prefix+children[child] in merkle_tree:
+      present |= 1 << child
+  # split the witness by child
+  witness_children = {}
+  for address in sorted_addresses:
+    witness_children.setdefault(int(address[end:end+bits_per_level],2), []).append(address)
+  visited = sum(1 << child for child in witness_children)
+  tree_encoding += [present, visited]
+  for child in range(merkle_token.tree_arity):
+    if child in witness_children:
+      build_kary_merkle_proof(end+bits_per_level,witness_children[child],accounts,merkle_tree,tree_encoding,address_chunks,balances,proof_hashes)
+    elif present >> child & 1:
+      proof_hashes += [merkle_tree[address_prefix+children[child]][0]]
+
+
+###########################
+# Incremental Merkle Tree #
+###########################
+
+# a persistent merkle tree which is updated in place, rehashing only the paths from changed leaves to the root
+#   internal nodes have ids 0,1,2,..., and each has a hash, the depth where it branches (i.e. where its edge ends), and two children
+#   leaves have ids -1,-2,-3,... so that ~leaf is its index into the leaf arrays, and each has a hash, an address, and a balance
+#   edge labels are not stored, they are read from the address of any leaf below the node, since all leaves below share that path
+#   hashes do not depend on edge labels, so the root matches build_merkle_tree() over the same accounts
+# everything is stored in flat arrays, with raw digests and addresses concatenated in bytearrays, which takes about a tenth of the memory of the dictionaries
+# the arrays can be saved to a snapshot file, which load_snapshot() maps into memory instead of rebuilding, and checkpoint() journals changes to it after each block
+class MerkleTree:
+  __slots__ = ('num_address_bits', 'num_address_bytes', 'num_hash_bytes',
+               'digests', 'ends', 'lefts', 'rights', 'leaf_digests', 'leaf_addresses', 'leaf_balances',
+               'free_nodes', 'free_leaves', 'root', 'hash_state', 'hash_lengths',
+               'snapshot', 'snapshot_id', 'changed', 'build_latencies')
+
+  def __init__(self, accounts=None):
+    if merkle_token.tree_arity != 2:
+      raise ValueError("MerkleTree is a binary tree, use build_merkle_tree() for wider trees")
+    self.num_address_bits = merkle_token.num_address_bits
+    self.num_address_bytes = merkle_token.num_address_bytes
+    self.num_hash_bytes = merkle_token.num_hash_bytes
+    self.digests = bytearray()		# raw hash of each internal node, num_hash_bytes each
+    self.ends = array.array('H')	# depth where each internal node branches
+    self.lefts = array.array('i')	# left child of each internal node
+    self.rights = array.array('i')	# right child of each internal node
+    self.leaf_digests = bytearray()	# raw hash of each leaf, num_hash_bytes each
+    self.leaf_addresses = bytearray()	# big-endian address of each leaf, num_address_bytes each
+    self.leaf_balances = array.array('Q')	# balance of each leaf
+    self.free_nodes = []	# deleted internal nodes, reused before appending new ones
+    self.free_leaves = []	# deleted leaves, reused before appending new ones
+    self.root = None	# None is the empty tree
+    self.hash_state = hashlib.blake2b(digest_size=self.num_hash_bytes)
+    self.hash_lengths = current_hash_lengths()	# digests are stored whole, and truncated where they are used
+    self.snapshot = None	# memory map of the snapshot the arrays are views into, until they need to grow, see load_snapshot()
+    self.snapshot_id = None	# random id of the last snapshot saved or loaded, which its journal records must have
+    self.changed = set()	# nodes rehashed since the last snapshot or checkpoint
+    self.build_latencies = LatencyStats()	# seconds per call of build_calldata() or build_calldatas()
+    self._build((int(address,2), accounts[address]) for address in sorted(accounts or {}))
+
+  # build from (address, balance) pairs with int addresses in increasing order, which may be a generator
+  @classmethod
+  def from_sorted_accounts(cls, sorted_accounts):
+    tree = cls()
+    tree._build(sorted_accounts)
+    return tree
+
+  def __len__(self):
+    return len(self.ends) - len(self.free_nodes) + len(self.leaf_balances) - len(self.free_leaves)
+
+  def root_hash(self):
+    return self.digest(self.root)[:self.hash_lengths[0]].hex() if self.root is not None else None
+
+  def digest(self, node):
+    H = self.num_hash_bytes
+    if node < 0:
+      return bytes(self.leaf_digests[~node*H:(~node+1)*H])
+    return bytes(self.digests[node*H:(node+1)*H])
+
+  def end(self, node):
+    return self.ends[node] if node >= 0 else self.num_address_bits
+
+  # edge label as (bit length, int), where start is the depth where the edge starts, one more than the parent's end
+  def edge_label(self, node, start):
+    end = self.end(node)
+    address = self._address(self._first_leaf(node))
+    return end-start, (address >> (self.num_address_bits-end)) & ((1 << (end-start)) - 1)
+
+  # lookup like merkle_tree[address_prefix] for a dictionary from build_merkle_tree(), so build_merkle_proof() can use this tree
+  def __getitem__(self, address_prefix):
+    node, start = self._find(address_prefix)
+    return self.digest(node)[:self.hash_lengths[start]].hex(), self._bits(node)[start:self.end(node)]
+
+  def get_balance(self, address):
+    return self.leaf_balances[~self._leaf(int(address,2))]
+
+  def set_balance(self, address, balance):
+    address = int(address,2)
+    path = self._path(address)
+    if not path or self._address(path[-1]) != address:
+      raise KeyError(address)
+    self.leaf_balances[~path[-1]] = balance
+    self._rehash_path(path)
+
+  def insert(self, address, balance):
+    address = int(address,2)
+    self._insert(address, balance)
+    self._rehash_path(self._path(address))
+
+  def delete(self, address):
+    address = int(address,2)
+    self._delete(address)
+    self._rehash_path(self._path(address))
+
+  # apply all balance changes of a block, then rehash each node on the union of changed paths exactly once
+  #   updates is a dictionary from address to new balance, a balance of None deletes the account, and unknown addresses are inserted
+  #   the whole block is checked before anything changes, so a bad update raises with the tree as it was
+  def apply_block(self, updates):
+    changes = []
+    for address, balance in updates.items():
+      address = int(address,2)
+      if address >> self.num_address_bits:
+        raise ValueError("not an address: "+bin(address)[2:])
+      if balance is None:
+        self._leaf(address)
+      elif not 0 <= balance < 2**merkle_token.num_balance_bits:
+        raise ValueError("balance out of range: "+str(balance))
+      changes.append((address, balance))
+    touched = []
+    for address, balance in changes:
+      if balance is None:
+        self._delete(address)
+      else:
+        path = self._path(address)
+        if path and self._address(path[-1]) == address:
+          self.leaf_balances[~path[-1]] = balance
+        else:
+          self._insert(address, balance)
+      touched.append(address)
+    dirty = set()
+    for address in touched:
+      dirty.update(self._path(address))
+    # children end deeper than their parents, so deepest first rehashes children before parents
+    for node in sorted(dirty, key=self.end, reverse=True):
+      self._rehash(node)
+
+  # the nodes and their edge labels in depth-first post-order, same keys and values as the dictionary from build_merkle_tree()
+  def items(self):
+    if self.root is None:
+      return
+    stack = [(self.root, 0, False)]
+    while stack:
+      node, start, children_done = stack.pop()
+      if node < 0 or children_done:
+        bits = self._bits(node)
+        yield bits[:start], (self.digest(node)[:self.hash_lengths[start]].hex(), bits[start:self.end(node)])
+      else:
+        stack.append((node, start, True))
+        stack.append((self.rights[node], self.ends[node]+1, False))
+        stack.append((self.lefts[node], self.ends[node]+1, False))
+
+  # builds tree_encoding, address_chunks, balances, and proof_hashes for the given sorted addresses
+  def build_proof(self, sorted_addresses):
+    accounts = {address:self.get_balance(address) for address in sorted_addresses}
+    tree_encoding = []
+    address_chunks = []
+    balances = []
+    proof_hashes = []
+    build_merkle_proof(0,sorted_addresses,accounts,self,tree_encoding,address_chunks,balances,proof_hashes)
+    return tree_encoding, address_chunks, balances, proof_hashes
+
+  # builds binary calldata for the given sorted addresses, the same bytes as encode_calldata() with the lists from build_proof(), including packing if packed_calldata_encoding_flag is set
+  #   the tree is walked only along the paths to the witness addresses, splitting them at each branch by bisection, so the cost is independent of the number of accounts
+  #   the walk records node ids, opcodes, and address chunks, see _walk(), then each section is copied from the tree's arrays into one calldata buffer of exactly the right size by _calldata()
+  #   include_addresses defaults to addresses_calldata_encoding_flag
+  #   raises ValueError with merkle_token.key_hash_salt set, see _check_unsalted()
+  #   each call's seconds are recorded in build_latencies
+  def build_calldata(self, sorted_addresses, transactions=[], include_addresses=None):
+    self._check_unsalted()
+    build_start = time.perf_counter()
+    if include_addresses is None:
+      include_addresses = addresses_calldata_encoding_flag
+    proof, = self._walk([sorted_addresses])
+    calldata = self._calldata(*proof, transactions, include_addresses)
+    if packed_calldata_encoding_flag:
+      calldata = pack_calldata(calldata)
+    self.build_latencies.record(time.perf_counter()-build_start)
+    return calldata
+
+  # the walk of build_calldata() and build_calldatas(), along the union of the paths to the addresses of each of several lists of sorted addresses
+  #   nodes on the paths of several witnesses are visited and their address chunks encoded once, and the addresses below each node are split at its branch by bisection
+  #   returns for each witness the sections for _calldata(): its opcodes, address chunks, nodes whose hashes are proof hashes, where their edges start, and leaves
+  #   raises KeyError with the first address below a node that isn't in the tree
+  def _walk(self, witnesses):
+    num_address_bits = self.num_address_bits
+    addresses = [[int(address,2) for address in sorted_addresses] for sorted_addresses in witnesses]
+    # opcodes, address chunks, nodes whose hash is in proof hashes, depths where their edges start, and leaves, for each witness
+    proofs = [(bytearray(), bytearray(), array.array('i'), array.array('H'), array.array('i')) for witness in witnesses]
+    ends, lefts, rights = self.ends, self.lefts, self.rights
+    # groups are (witness index, lo, hi) for each witness with addresses below the node, in its addresses[lo:hi]
+    def visit(node, start, groups):
+      i, lo, hi = groups[0]
+      if len(groups) == 1 and hi-lo == 1:
+        if not self._visit_path(node, start, addresses[i][lo], proofs[i]):
+          raise KeyError(witnesses[i][lo])
+        return
+      end = ends[node] if node >= 0 else num_address_bits
+      address = addresses[i][lo]
+      if start < end:
+        chunk_length = end-start
+        chunk = (address >> (num_address_bits-end)) & ((1 << chunk_length) - 1)
+        encoded = bytes([chunk_length]) + chunk.to_bytes((chunk_length+7)//8, 'big')
+        for i, lo, hi in groups:
+          proofs[i][0].append(0b00)
+          proofs[i][1].extend(encoded)
+      if node < 0:
+        leaf_address = self._address(node)
+        for i, lo, hi in groups:
+          if hi-lo != 1 or addresses[i][lo] != leaf_address:
+            raise KeyError(witnesses[i][lo])
+          proofs[i][4].append(node)
+        return
+      mid_address = ((address >> (num_address_bits-end)) << 1 | 1) << (num_address_bits-end-1)
+      left_groups, right_groups, left_only, right_only = [], [], [], []
+      for group in groups:
+        i, lo, hi = group
+        mid = bisect.bisect_left(addresses[i], mid_address, lo, hi)
+        if lo < mid < hi:
+          proofs[i][0].append(0b11)
+          left_groups.append((i, lo, mid))
+          right_groups.append((i, mid, hi))
+        elif mid == hi:
+          proofs[i][0].append(0b10)
+          left_groups.append(group)
+          left_only.append(i)
+        else:
+          proofs[i][0].append(0b01)
+          right_groups.append(group)
+          right_only.append(i)
+      # in depth-first post-order, a sibling's hash is after the subtree next to it
+      if left_groups:
+        visit(lefts[node], end+1, left_groups)
+      for i in left_only:
+        proofs[i][2].append(rights[node])
+        proofs[i][3].append(end+1)
+      if right_groups:
+        visit(rights[node], end+1, right_groups)
+      for i in right_only:
+        proofs[i][2].append(lefts[node])
+        proofs[i][3].append(end+1)
+    groups = [(i, 0, len(witness)) for i, witness in enumerate(addresses) if witness]
+    if groups:
+      visit(self.root, 0, groups)
+    return proofs
+
+  # below a node with one witness address there are no more 11 opcodes, so the path down to its leaf is followed by the bits of the address, without bisection
+  # appends the path's opcodes, address chunks, nodes whose hashes are proof hashes and where their edges start, and the leaf, to the lists of proof
+  # returns False if the address is not in the tree
+  def _visit_path(self, node, start, address, proof):
+    opcodes, chunks, hash_nodes, hash_starts, leaves = proof
+    num_address_bits = self.num_address_bits
+    ends, lefts, rights = self.ends, self.lefts, self.rights
+    siblings = []	# nodes off the path, and where their edges start, whose hashes come after the path in depth-first post-order
+    while True:
+      end = ends[node] if node >= 0 else num_address_bits
+      if start < end:
+        chunk_length = end-start
+        chunk = (address >> (num_address_bits-end)) & ((1 << chunk_length) - 1)
+        opcodes.append(0b00)
+        chunks.append(chunk_length)
+        chunks.extend(chunk.to_bytes((chunk_length+7)//8, 'big'))
+      if node < 0:
+        if self._address(node) != address:
+          return False
+        leaves.append(node)
+        break
+      if (address >> (num_address_bits-1-end)) & 1:
+        opcodes.append(0b01)
+        siblings.append((lefts[node], end+1))
+        node = rights[node]
+      else:
+        opcodes.append(0b10)
+        siblings.append((rights[node], end+1))
+        node = lefts[node]
+      start = end+1
+    for sibling, sibling_start in reversed(siblings):
+      hash_nodes.append(sibling)
+      hash_starts.append(sibling_start)
+    return True
+
+  # with merkle_token.key_hash_salt, a tree of keyed_accounts() has keys at its leaves, but calldata needs the addresses behind them, which the tree doesn't store
+  def _check_unsalted(self):
+    if merkle_token.key_hash_salt is not None:
+      raise ValueError("MerkleTree can't build calldata with merkle_token.key_hash_salt set, since it doesn't store the addresses behind its keys, "
+                       "use build_proof() with the keys from keyed_witness(), then encode_calldata() with its addresses")
+
+  # builds calldata for each of several lists of sorted addresses, the same bytes as build_calldata() for each, without transactions
+  #   the tree is walked once along the union of their paths, so nodes on the paths of several witnesses are visited and their address chunks encoded once
+  #   e.g. for proof requests coalesced by merkle_token_server
+  def build_calldatas(self, witnesses, include_addresses=None):
+    self._check_unsalted()
+    build_start = time.perf_counter()
+    if include_addresses is None:
+      include_addresses = addresses_calldata_encoding_flag
+    proofs = self._walk(witnesses)
+    calldatas = []
+    for opcodes, chunks, hash_nodes, hash_starts, leaves in proofs:
+      calldata = self._calldata(opcodes, chunks, hash_nodes, hash_starts, leaves, [], include_addresses)
+      calldatas.append(pack_calldata(calldata) if packed_calldata_encoding_flag else calldata)
+    self.build_latencies.record(time.perf_counter()-build_start)
+    return calldatas
+
+  # allocates the calldata for a walk of build_calldata(), then fills in each section from the tree's arrays
+  def _calldata(self, opcodes, chunks, hash_nodes, hash_starts, leaves, transactions, include_addresses):
+    H = self.num_hash_bytes
+    A = self.num_address_bytes
+    B = merkle_token.num_balance_bytes
+    T = merkle_token.num_transaction_bytes
+    hash_lengths = [self.hash_lengths[start] for start in hash_starts]
+    section_lengths = [sum(hash_lengths), len(leaves)*A if include_addresses else 0, len(leaves)*B, len(transactions)*T, len(opcodes), len(chunks)]
+    calldata = bytearray(4 + 4*len(section_lengths) + sum(section_lengths))
+    out = memoryview(calldata)
+    out[0:4] = H.to_bytes(4, 'little')
+    idx = 4
+    offsets = []
+    for length in section_lengths:
+      out[idx:idx+4] = length.to_bytes(4, 'little')
+      offsets.append(idx+4)
+      idx += 4+length
+    idx = offsets[0]
+    digests = memoryview(self.digests)
+    leaf_digests = memoryview(self.leaf_digests)
+    for node, n in zip(hash_nodes, hash_lengths):
+      if node < 0:
+        out[idx:idx+n] = leaf_digests[~node*H:~node*H+n]
+      else:
+        out[idx:idx+n] = digests[node*H:node*H+n]
+      idx += n
+    leaf_addresses = memoryview(self.leaf_addresses)
+    if include_addresses:
+      idx = offsets[1]
+      for leaf in leaves:
+        out[idx:idx+A] = leaf_addresses[~leaf*A:(~leaf+1)*A]
+        idx += A
+    idx = offsets[2]
+    for leaf in leaves:
+      out[idx:idx+B] = self.leaf_balances[~leaf].to_bytes(B, 'little')
+      idx += B
+    idx = offsets[3]
+    for t in transactions:
+      out[idx:idx+T] = t if type(t)==bytes else t.to_bytes(T, 'little')
+      idx += T
+    out[offsets[4]:offsets[4]+len(opcodes)] = opcodes
+    out[offsets[5]:offsets[5]+len(chunks)] = chunks
+    digests.release()
+    leaf_digests.release()
+    leaf_addresses.release()
+    out.release()
+    return calldata
+
+  # save the tree to path as a snapshot, which load_snapshot() maps into memory without rebuilding anything
+  #   the snapshot is a header, then the hash lengths, the free lists, and each array of the tree as a fixed-width section, see _snapshot_layout()
+  def save_snapshot(self, path):
+    sections = {'addresses': self.leaf_addresses, 'balances': self.leaf_balances, 'leaf_digests': self.leaf_digests,
+                'digests': self.digests, 'ends': self.ends, 'lefts': self.lefts, 'rights': self.rights}
+    self.snapshot_id = _write_snapshot(path, self.num_address_bits, self.num_hash_bytes, self.root, len(self.leaf_balances), len(self.ends),
+                                       self.free_nodes, self.free_leaves, self.hash_lengths, sections)
+    self.changed = set()
+
+  # a tree whose arrays are views into a private memory map of the snapshot at path, so nothing is read until it is used
+  #   the journal next to the snapshot is replayed, so the tree is as of the last checkpoint()
+  #   updates are written to the memory map, and not to the file, until the arrays need to grow for an insert, when they are copied out, see _detach()
+  #   the constants in merkle_token must be the ones the snapshot was saved with
+  @classmethod
+  def load_snapshot(cls, path):
+    tree = cls()
+    with open(path, 'rb') as f:
+      snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if len(snapshot) < snapshot_header.size or snapshot[:len(snapshot_magic)] != snapshot_magic:
+      raise ValueError("not a MerkleTree snapshot, or saved on a machine with another byte order: "+path)
+    magic, snapshot_id, num_address_bits, num_hash_bytes, num_balance_bytes, has_root, root, num_leaves, num_nodes, num_free_nodes, num_free_leaves = snapshot_header.unpack_from(snapshot)
+    if (num_address_bits, num_hash_bytes, num_balance_bytes) != (tree.num_address_bits, tree.num_hash_bytes, merkle_token.num_balance_bytes):
+      raise ValueError("snapshot has "+str(num_address_bits)+" address bits, "+str(num_hash_bytes)+" bytes per hash, and "+str(num_balance_bytes)+" bytes per balance, which differ from merkle_token")
+    layout, size = _snapshot_layout(num_leaves, num_nodes, num_free_nodes, num_free_leaves, len(tree.hash_lengths), tree.num_address_bytes, tree.num_hash_bytes)
+    if len(snapshot) != size:
+      raise ValueError("snapshot has "+str(len(snapshot))+" bytes, expected "+str(size))
+    views = _shared_tree_views(memoryview(snapshot), layout)
+    if bytes(views['hash_lengths']) != bytes(tree.hash_lengths):
+      raise ValueError("snapshot was saved with another hash length schedule")
+    tree.free_nodes = views['free_nodes'].tolist()
+    tree.free_leaves = views['free_leaves'].tolist()
+    tree.leaf_addresses, tree.leaf_balances, tree.leaf_digests = views['addresses'], views['balances'], views['leaf_digests']
+    tree.digests, tree.ends, tree.lefts, tree.rights = views['digests'], views['ends'], views['lefts'], views['rights']
+    tree.root = root if has_root else None
+    tree.snapshot = snapshot
+    tree.snapshot_id = snapshot_id
+    tree._replay_journal(path+'.journal')
+    return tree
+
+  # append the nodes changed since the last snapshot or checkpoint to the journal next to the snapshot at path, e.g. after each block
+  #   a journal record is a header, the free lists, each changed internal node and leaf, then a checksum, see journal_header, journal_node, journal_leaf, and journal_checksum
+  #   records are appended and synced, so a crash loses at most the record being written, which replay cuts off the journal so the next record follows the last complete one
+  #   save_snapshot() folds the journal into a new snapshot, which keeps restarts fast
+  def checkpoint(self, path):
+    if self.snapshot_id is None:
+      raise ValueError("save a snapshot before checkpointing")
+    H = self.num_hash_bytes
+    A = self.num_address_bytes
+    nodes = sorted(node for node in self.changed if node >= 0)
+    leaves = sorted(~node for node in self.changed if node < 0)
+    record = bytearray(journal_header.size)
+    record += array.array('i', self.free_nodes)
+    record += array.array('i', self.free_leaves)
+    for node in nodes:
+      record += journal_node.pack(node, self.ends[node], self.lefts[node], self.rights[node])
+      record += self.digests[node*H:(node+1)*H]
+    for leaf in leaves:
+      record += journal_leaf.pack(leaf, self.leaf_balances[leaf])
+      record += self.leaf_addresses[leaf*A:(leaf+1)*A]
+      record += self.leaf_digests[leaf*H:(leaf+1)*H]
+    journal_header.pack_into(record, 0, len(record)+journal_checksum.size, self.snapshot_id, self.root is not None, self.root or 0, len(self.leaf_balances), len(self.ends),
+                             len(self.free_nodes), len(self.free_leaves), len(nodes), len(leaves))
+    record += journal_checksum.pack(zlib.crc32(record))
+    with open(path+'.journal', 'ab') as f:
+      f.write(record)
+      f.flush()
+      os.fsync(f.fileno())
+    self.changed = set()
+
+
+  # helpers, addresses are ints from here on
+
+  def _bit(self, address, depth):
+    return (address >> (self.num_address_bits-1-depth)) & 1
+
+  def _address(self, leaf):
+    A = self.num_address_bytes
+    return int.from_bytes(self.leaf_addresses[~leaf*A:(~leaf+1)*A], 'big')
+
+  def _first_leaf(self, node):
+    while node >= 0:
+      node = self.lefts[node]
+    return node
+
+  # the address of some leaf below the node, as a bit string, which starts with the path to the node
+  def _bits(self, node):
+    return bin(self._address(self._first_leaf(node)))[2:].zfill(self.num_address_bits)
+
+  # nodes from the root down, following the bits of address at each branch, ending at a leaf which may have another address
+  def _path(self, address):
+    path = []
+    node = self.root
+    if node is None:
+      return path
+    while node >= 0:
+      path.append(node)
+      node = self.rights[node] if self._bit(address, self.ends[node]) else self.lefts[node]
+    path.append(node)
+    return path
+
+  def _leaf(self, address):
+    path = self._path(address)
+    if not path or self._address(path[-1]) != address:
+      raise KeyError(address)
+    return path[-1]
+
+  # the node whose path is address_prefix, and the depth where its edge starts
+  def _find(self, address_prefix):
+    node = self.root
+    start = 0
+    while node is not None and node >= 0 and start < len(address_prefix):
+      end = self.ends[node]
+      if end >= len(address_prefix):
+        break
+      node = self.rights[node] if address_prefix[end]=='1' else self.lefts[node]
+      start = end+1
+    if node is None or start != len(address_prefix) or not self._bits(node).startswith(address_prefix):
+      raise KeyError(address_prefix)
+    return node, start
+
+  def _new_node(self, end, left, right):
+    if self.free_nodes:
+      node = self.free_nodes.pop()
+      self.ends[node] = end
+      self.lefts[node] = left
+      self.rights[node] = right
+    else:
+      if self.snapshot is not None:
+        self._detach()
+      node = len(self.ends)
+      self.digests += bytes(self.num_hash_bytes)
+      self.ends.append(end)
+      self.lefts.append(left)
+      self.rights.append(right)
+    return node
+
+  def _new_leaf(self, address, balance):
+    A = self.num_address_bytes
+    address_as_bytes = address.to_bytes(A, 'big')
+    if self.free_leaves:
+      leaf = self.free_leaves.pop()
+      self.leaf_addresses[~leaf*A:(~leaf+1)*A] = address_as_bytes
+      self.leaf_balances[~leaf] = balance
+    else:
+      if self.snapshot is not None:
+        self._detach()
+      leaf = ~len(self.leaf_balances)
+      self.leaf_digests += bytes(self.num_hash_bytes)
+      self.leaf_addresses += address_as_bytes
+      self.leaf_balances.append(balance)
+    return leaf
+
+  def _free_node(self, node):
+    if node < 0:
+      self.free_leaves.append(node)
+    else:
+      self.free_nodes.append(node)
+
+  # replace the child of parent, or the root if parent is None
+  def _replace_child(self, parent, old_child, new_child):
+    if parent is None:
+      self.root = new_child
+    elif self.lefts[parent] == old_child:
+      self.lefts[parent] = new_child
+    else:
+      self.rights[parent] = new_child
+
+  # structural insert, hashes on the new path are left stale
+  def _insert(self, address, balance):
+    path = self._path(address)
+    if not path:
+      self.root = self._new_leaf(address, balance)
+      return
+    other = self._address(path[-1])
+    if other == address:
+      raise ValueError("address already in tree: "+bin(address)[2:].zfill(self.num_address_bits))
+    leaf = self._new_leaf(address, balance)
+    # split the edge which contains the first bit where the addresses differ
+    depth = self.num_address_bits - (address ^ other).bit_length()
+    idx = 0
+    while self.end(path[idx]) < depth:
+      idx += 1
+    node = path[idx]
+    if self._bit(address, depth):
+      branch = self._new_node(depth, node, leaf)
+    else:
+      branch = self._new_node(depth, leaf, node)
+    self._replace_child(path[idx-1] if idx else None, node, branch)
+
+  # structural delete, hashes on the old path are left stale
+  def _delete(self, address):
+    path = self._path(address)
+    if not path or self._address(path[-1]) != address:
+      raise KeyError(address)
+    leaf = path[-1]
+    if len(path) == 1:
+      self.root = None
+    else:
+      # the sibling takes the place of the parent, its edge now starts where the parent's edge started
+      parent = path[-2]
+      sibling = self.rights[parent] if self.lefts[parent] == leaf else self.lefts[parent]
+      self._replace_child(path[-3] if len(path)>2 else None, parent, sibling)
+      self._free_node(parent)
+    self._free_node(leaf)
+
+  def _rehash(self, node):
+    self.changed.add(node)
+    H = self.num_hash_bytes
+    if node < 0:
+      A = self.num_address_bytes
+      self.leaf_digests[~node*H:(~node+1)*H] = leaf_digest(self.hash_state, self.leaf_addresses[~node*A:(~node+1)*A], self.leaf_balances[~node], merkle_token.num_balance_bytes)
+    else:
+      n = self.hash_lengths[self.ends[node]+1]
+      self.digests[node*H:(node+1)*H] = self._hash(self.digest(self.lefts[node])[:n], self.digest(self.rights[node])[:n])
+
+  # rehash from the bottom of the path up to the root
+  def _rehash_path(self, path):
+    for node in reversed(path):
+      self._rehash(node)
+
+  # apply the records of the journal at path which belong to this tree's snapshot
+  # records of another snapshot are from before a crash between saving a snapshot and removing the old journal, and are already in the snapshot
+  # a record that is cut short or fails its checksum is from a crash during checkpoint(), records are only appended so it is the last one, and the journal is truncated before it
+  def _replay_journal(self, path):
+    if not os.path.exists(path):
+      return
+    H = self.num_hash_bytes
+    A = self.num_address_bytes
+    with open(path, 'rb') as f:
+      journal = f.read()
+    idx = 0
+    while idx+journal_header.size <= len(journal):
+      record_length, snapshot_id, has_root, root, num_leaves, num_nodes, num_free_nodes, num_free_leaves, num_changed_nodes, num_changed_leaves = journal_header.unpack_from(journal, idx)
+      if record_length < journal_header.size+journal_checksum.size or idx+record_length > len(journal):
+        break
+      checksum_idx = idx+record_length-journal_checksum.size
+      if journal_checksum.unpack_from(journal, checksum_idx)[0] != zlib.crc32(journal[idx:checksum_idx]):
+        break
+      if snapshot_id == self.snapshot_id:
+        self._grow(num_leaves, num_nodes)
+        pos = idx+journal_header.size
+        self.free_nodes = array.array('i', journal[pos:pos+4*num_free_nodes]).tolist()
+        pos += 4*num_free_nodes
+        self.free_leaves = array.array('i', journal[pos:pos+4*num_free_leaves]).tolist()
+        pos += 4*num_free_leaves
+        for i in range(num_changed_nodes):
+          node, self.ends[node], self.lefts[node], self.rights[node] = journal_node.unpack_from(journal, pos)
+          pos += journal_node.size
+          self.digests[node*H:(node+1)*H] = journal[pos:pos+H]
+          pos += H
+        for i in range(num_changed_leaves):
+          leaf, self.leaf_balances[leaf] = journal_leaf.unpack_from(journal, pos)
+          pos += journal_leaf.size
+          self.leaf_addresses[leaf*A:(leaf+1)*A] = journal[pos:pos+A]
+          pos += A
+          self.leaf_digests[leaf*H:(leaf+1)*H] = journal[pos:pos+H]
+          pos += H
+        self.root = root if has_root else None
+      idx += record_length
+    if idx < len(journal):
+      os.truncate(path, idx)
+
+  # copy the arrays out of the snapshot's memory map into the tree's own, so they can grow
+  def _detach(self):
+    self.digests = bytearray(self.digests)
+    self.leaf_digests = bytearray(self.leaf_digests)
+    self.leaf_addresses = bytearray(self.leaf_addresses)
+    for name, typecode in [('ends', 'H'), ('lefts', 'i'), ('rights', 'i'), ('leaf_balances', 'Q')]:
+      copy = array.array(typecode)
+      copy.frombytes(getattr(self, name).cast('B'))
+      setattr(self, name, copy)
+    self.snapshot = None
+
+  # append zeroed leaves and internal nodes up to num_leaves and num_nodes
+  def _grow(self, num_leaves, num_nodes):
+    num_new_leaves = num_leaves-len(self.leaf_balances)
+    num_new_nodes = num_nodes-len(self.ends)
+    if num_new_leaves <= 0 and num_new_nodes <= 0:
+      return
+    if self.snapshot is not None:
+      self._detach()
+    if num_new_leaves > 0:
+      self.leaf_digests += bytes(num_new_leaves*self.num_hash_bytes)
+      self.leaf_addresses += bytes(num_new_leaves*self.num_address_bytes)
+      self.leaf_balances.frombytes(bytes(8*num_new_leaves))
+    if num_new_nodes > 0:
+      self.digests += bytes(num_new_nodes*self.num_hash_bytes)
+      self.ends.frombytes(bytes(2*num_new_nodes))
+      self.lefts.frombytes(bytes(4*num_new_nodes))
+      self.rights.frombytes(bytes(4*num_new_nodes))
+
+  def _hash(self, left, right):
+    h = self.hash_state.copy()
+    h.update(left)
+    h.update(right)
+    return h.digest()
+
+  # build an empty tree from (address, balance) pairs in increasing order of address, with merkleize_sorted() like build_merkle_tree(), so accounts may be streamed
+  def _build(self, sorted_accounts):
+    digests, ends, lefts, rights = self.digests, self.ends, self.lefts, self.rights
+    leaf_digests, leaf_addresses, leaf_balances = self.leaf_digests, self.leaf_addresses, self.leaf_balances
+    def new_leaf(i, address, balance, address_as_bytes, digest):
+      leaf_digests.extend(digest)
+      leaf_addresses.extend(address_as_bytes)
+      leaf_balances.append(balance)
+      return ~i
+    def new_node(branch_depth, left, right, digest):
+      digests.extend(digest)
+      ends.append(branch_depth)
+      lefts.append(left)
+      rights.append(right)
+      return len(ends)-1
+    leaves = hash_leaves(sorted_accounts, self.num_address_bytes, merkle_token.num_balance_bytes, self.hash_state, new_leaf)
+    self.root, digest = merkleize_sorted(leaves, self.num_address_bits, self.hash_state, self.hash_lengths, new_node)
+
+
+# latencies kept for percentiles, the most recent ones
+max_latency_samples = 2**16
+
+# latencies in seconds, with percentiles by nearest rank
+class LatencyStats:
+  __slots__ = ('samples', 'count')
+
+  def __init__(self):
+    self.samples = collections.deque(maxlen=max_latency_samples)
+    self.count = 0
+
+  def record(self, seconds):
+    self.samples.append(seconds)
+    self.count += 1
+
+  def percentile(self, p, ordered=None):
+    ordered = ordered or sorted(self.samples)
+    if not ordered:
+      return None
+    return ordered[min(len(ordered)-1, max(0, -(-p*len(ordered)//100)-1))]
+
+  def as_dict(self, ps=(50, 90, 99)):
+    ordered = sorted(self.samples)
+    return dict({'count': self.count, 'max_ms': ordered[-1]*1000 if ordered else None}, **{'p'+str(p)+'_ms': self.percentile(p, ordered)*1000 if ordered else None for p in ps})
+
+
+
+#######################
+# Parallel Tree Build #
+#######################
+
+# build a MerkleTree from (address, balance) pairs with int addresses in increasing order, using a pool of processes
+#   accounts are split into partitions by the top num_partition_bits of their address, and each partition's subtree is built by a worker
+#   the upper levels are built here from the partition roots, like build_merkle_tree() with each partition root as a leaf
+#     every branch depth between partitions is shallower than num_partition_bits, and within a partition is deeper, so the stitched tree is the same as a serial build
+#     the edge from a stitched node down to a partition root may start above num_partition_bits, i.e. cross the partition boundary
+#   addresses, balances, and all output arrays are in one shared memory block, so workers read their account range and write their nodes in place
+#     node ids are known in advance: the leaves of a partition of accounts lo..hi-1 are ~lo..~(hi-1),
+#     its internal nodes come after the lo-j internal nodes of the j partitions before it, and the stitched internal nodes come last
+def build_merkle_tree_parallel(sorted_accounts, num_workers=None, num_partition_bits=None):
+  num_workers = num_workers or os.cpu_count()
+  addresses = []
+  balances = array.array('Q')
+  for address, balance in sorted_accounts:
+    addresses.append(address)
+    balances.append(balance)
+  n = len(addresses)
+  if n < 2:
+    return MerkleTree.from_sorted_accounts(zip(addresses, balances))
+  num_address_bits = merkle_token.num_address_bits
+  num_address_bytes = merkle_token.num_address_bytes
+  num_hash_bytes = merkle_token.num_hash_bytes
+  hash_lengths = current_hash_lengths()
+  # about four partitions per worker, so workers finish at about the same time
+  if num_partition_bits is None:
+    num_partition_bits = min(num_address_bits, max(1, (4*num_workers-1).bit_length()))
+  layout, size = _shared_tree_layout(n, num_address_bytes, num_hash_bytes)
+  shm = shared_memory.SharedMemory(create=True, size=size)
+  views = _shared_tree_views(shm.buf, layout)
+  try:
+    views['addresses'][:] = b''.join([address.to_bytes(num_address_bytes, 'big') for address in addresses])
+    views['balances'][:] = balances
+    # partition boundaries, skipping empty partitions
+    shift = num_address_bits - num_partition_bits
+    bounds = sorted(set([bisect.bisect_left(addresses, prefix << shift) for prefix in range(2**num_partition_bits)] + [n]))
+    if bounds[0] != 0:
+      bounds.insert(0, 0)
+    partitions = list(zip(bounds[:-1], bounds[1:]))
+    args = (shm.name, n, num_address_bits, num_address_bytes, num_hash_bytes, merkle_token.hash_length_schedule)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+      futures = [executor.submit(_build_partition, *args, lo, hi, lo-j) for j, (lo, hi) in enumerate(partitions)]
+      roots = [future.result() for future in futures]
+    # stitch partition roots together, new internal nodes are numbered after all partitions' internal nodes
+    next_node = n - len(partitions)
+    def new_node(branch_depth, left, right, digest):
+      nonlocal next_node
+      views['digests'][next_node*num_hash_bytes:(next_node+1)*num_hash_bytes] = digest
+      views['ends'][next_node] = branch_depth
+      views['lefts'][next_node] = left
+      views['rights'][next_node] = right
+      next_node += 1
+      return next_node-1
+    subtrees = ((node, digest, addresses[lo], addresses[hi-1]) for (node, digest), (lo, hi) in zip(roots, partitions))
+    root, digest = merkleize_sorted(subtrees, num_address_bits, hashlib.blake2b(digest_size=num_hash_bytes), hash_lengths, new_node)
+    # copy out of shared memory into the tree's own arrays
+    tree = MerkleTree()
+    tree.root = root
+    tree.leaf_addresses[:] = views['addresses']
+    tree.leaf_balances.frombytes(views['balances'].cast('B'))
+    tree.leaf_digests[:] = views['leaf_digests']
+    tree.digests[:] = views['digests']
+    tree.ends.frombytes(views['ends'].cast('B'))
+    tree.lefts.frombytes(views['lefts'].cast('B'))
+    tree.rights.frombytes(views['rights'].cast('B'))
+  finally:
+    for view in views.values():
+      view.release()
+    shm.close()
+    shm.unlink()
+  return tree
+
+# offset, size in bytes, and item type of each array in the shared memory block for n accounts, and the total size
+def _shared_tree_layout(n, num_address_bytes, num_hash_bytes):
+  return _layout(_tree_arrays(n, n-1, num_address_bytes, num_hash_bytes))
+
+# snapshot and journal formats for MerkleTree.save_snapshot() and MerkleTree.checkpoint(), all little-endian except the tree's arrays, which are saved as they are in memory
+# the last byte of the magic is 1 for little-endian arrays, so a snapshot isn't loaded on a machine with the other byte order
+snapshot_magic = b'mtsnap' + bytes([1, sys.byteorder == 'little'])
+# magic, snapshot id, address bits, bytes per hash, bytes per balance, whether there is a root, root, leaves, internal nodes, free internal nodes, free leaves
+snapshot_header = struct.Struct('<8s8sHHHHiIIII')
+# record length, snapshot id, whether there is a root, root, leaves, internal nodes, free internal nodes, free leaves, changed internal nodes, changed leaves
+journal_header = struct.Struct('<I8sHiIIIIII')
+# internal node, where it branches, left child, right child, then its digest
+journal_node = struct.Struct('<IHii')
+# leaf index, balance, then its address and digest
+journal_leaf = struct.Struct('<IQ')
+# CRC-32 of the record up to here, which ends each record
+journal_checksum = struct.Struct('<I')
+
+# offset, size in bytes, and item type of each section of a snapshot, and its total size
+def _snapshot_layout(num_leaves, num_nodes, num_free_nodes, num_free_leaves, num_hash_lengths, num_address_bytes, num_hash_bytes):
+  return _layout([('hash_lengths', num_hash_lengths, 'B'), ('free_nodes', 4*num_free_nodes, 'i'), ('free_leaves', 4*num_free_leaves, 'i')]
+                 + _tree_arrays(num_leaves, num_nodes, num_address_bytes, num_hash_bytes), snapshot_header.size + (-snapshot_header.size % 8))
+
+# writes a snapshot for MerkleTree.save_snapshot() or build_snapshot_from_sorted_accounts(), and returns its id
+#   sections has each array of the tree, see _tree_arrays(), as bytes or as a file to copy from its start
+#   it is written next to path then renamed over it, so a crash leaves the previous snapshot, then the previous snapshot's journal is removed, see MerkleTree.checkpoint()
+def _write_snapshot(path, num_address_bits, num_hash_bytes, root, num_leaves, num_nodes, free_nodes, free_leaves, hash_lengths, sections):
+  snapshot_id = os.urandom(8)
+  layout, size = _snapshot_layout(num_leaves, num_nodes, len(free_nodes), len(free_leaves), len(hash_lengths), (num_address_bits+7)//8, num_hash_bytes)
+  sections = dict(sections, hash_lengths=bytes(hash_lengths), free_nodes=array.array('i', free_nodes), free_leaves=array.array('i', free_leaves))
+  with open(path+'.tmp', 'wb') as f:
+    f.write(snapshot_header.pack(snapshot_magic, snapshot_id, num_address_bits, num_hash_bytes, merkle_token.num_balance_bytes,
+                                 root is not None, root or 0, num_leaves, num_nodes, len(free_nodes), len(free_leaves)))
+    for name, (offset, length, fmt) in layout.items():
+      f.seek(offset)
+      section = sections[name]
+      if hasattr(section, 'read'):
+        section.seek(0)
+        shutil.copyfileobj(section, f)
+      else:
+        f.write(section)
+    f.truncate(size)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(path+'.tmp', path)
+  if os.path.exists(path+'.journal'):
+    os.remove(path+'.journal')
+  return snapshot_id
+
+# name, size in bytes, and item type of each array of a MerkleTree with num_leaves leaves and num_nodes internal nodes
+def _tree_arrays(num_leaves, num_nodes, num_address_bytes, num_hash_bytes):
+  return [('addresses', num_leaves*num_address_bytes, 'B'), ('balances', 8*num_leaves, 'Q'), ('leaf_digests', num_leaves*num_hash_bytes, 'B'),
+          ('digests', num_nodes*num_hash_bytes, 'B'), ('ends', 2*num_nodes, 'H'), ('lefts', 4*num_nodes, 'i'), ('rights', 4*num_nodes, 'i')]
+
+# offset, size in bytes, and item type of each of arrays, laid out one after another from offset, and the offset after the last one
+def _layout(arrays, offset=0):
+  layout = {}
+  for name, size, fmt in arrays:
+    layout[name] = (offset, size, fmt)
+    offset += size + (-size % 8) # keep arrays aligned
+  return layout, offset
+
+def _shared_tree_views(buf, layout):
+  return {name: buf[offset:offset+size].cast(fmt) for name, (offset, size, fmt) in layout.items()}
+
+# worker: build the subtree of accounts lo..hi-1 and write it into shared memory with global node ids, returns the subtree's root and its digest
+def _build_partition(shm_name, n, num_address_bits, num_address_bytes, num_hash_bytes, hash_length_schedule, lo, hi, node_offset):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = num_address_bytes
+  merkle_token.num_hash_bytes = num_hash_bytes
+  merkle_token.num_hash_bits = num_hash_bytes*8
+  merkle_token.hash_length_schedule = hash_length_schedule
+  shm = shared_memory.SharedMemory(name=shm_name)
+  layout, _ = _shared_tree_layout(n, num_address_bytes, num_hash_bytes)
+  views = _shared_tree_views(shm.buf, layout)
+  try:
+    A = num_address_bytes
+    H = num_hash_bytes
+    addresses = views['addresses']
+    balances = views['balances']
+    subtree = MerkleTree.from_sorted_accounts((int.from_bytes(addresses[i*A:(i+1)*A], 'big'), balances[i]) for i in range(lo, hi))
+    # leaves ~j become ~(lo+j), and internal nodes i become node_offset+i
+    views['leaf_digests'][lo*H:hi*H] = subtree.leaf_digests
+    num_internal = len(subtree.ends)
+    views['digests'][node_offset*H:(node_offset+num_internal)*H] = subtree.digests
+    views['ends'][node_offset:node_offset+num_internal] = subtree.ends
+    lefts = views['lefts']
+    rights = views['rights']
+    for i in range(num_internal):
+      left = subtree.lefts[i]
+      right = subtree.rights[i]
+      lefts[node_offset+i] = left+node_offset if left >= 0 else left-lo
+      rights[node_offset+i] = right+node_offset if right >= 0 else right-lo
+    root = subtree.root+node_offset if subtree.root >= 0 else subtree.root-lo
+    digest = subtree.digest(subtree.root)
+  finally:
+    for view in views.values():
+      view.release()
+    shm.close()
+  return root, digest
+
+
+
+
+##########################
+# Streaming State Import #
+##########################
+
+# account dumps bigger than memory are imported in streaming steps, where memory is bounded by the chunk of accounts sorted at a time, e.g.
+#   build_snapshot_from_sorted_accounts(external_sort_accounts(read_accounts_csv('accounts.csv')), 'merkle_tree.snapshot')
+#   tree = MerkleTree.load_snapshot('merkle_tree.snapshot')
+# accounts are (address, balance) pairs with int addresses, like MerkleTree.from_sorted_accounts() takes
+
+# accounts from a CSV file with rows of hex address and decimal balance, a first row which isn't an account is taken as a header and skipped
+# rows which aren't an account raise ValueError with their line number
+def read_accounts_csv(path):
+  with open(path, newline='') as f:
+    reader = csv.reader(f)
+    for row_number, row in enumerate(reader):
+      if not row:
+        continue
+      if len(row) < 2:
+        raise ValueError("expected an address and a balance on CSV line "+str(reader.line_num))
+      if row_number == 0 and not row[1].strip().isdigit():
+        continue
+      try:
+        address, balance = int(row[0], 16), int(row[1])
+      except ValueError:
+        raise ValueError("account is not a hex address and a decimal balance on CSV line "+str(reader.line_num)) from None
+      if address >> merkle_token.num_address_bits or not 0 <= balance < 2**merkle_token.num_balance_bits:
+        raise ValueError("account out of range on CSV line "+str(reader.line_num))
+      yield address, balance
+
+# accounts from a binary file of records, each a big-endian address of num_address_bytes followed by a little-endian balance, like a leaf is hashed
+def read_accounts_binary(path, records_per_read=2**14):
+  A = merkle_token.num_address_bytes
+  R = A+merkle_token.num_balance_bytes
+  with open(path, 'rb') as f:
+    while True:
+      records = f.read(R*records_per_read)
+      if not records:
+        return
+      if len(records) % R:
+        raise ValueError("binary account file ends with a partial record")
+      for idx in range(0, len(records), R):
+        yield int.from_bytes(records[idx:idx+A], 'big'), int.from_bytes(records[idx+A:idx+R], 'little')
+
+# writes accounts, which may be a generator, in the format read_accounts_binary() reads
+def write_accounts_binary(path, accounts):
+  A = merkle_token.num_address_bytes
+  B = merkle_token.num_balance_bytes
+  with open(path, 'wb') as f:
+    records = bytearray()
+    for address, balance in accounts:
+      records += address.to_bytes(A, 'big')
+      records += balance.to_bytes(B, 'little')
+      if len(records) >= 2**20:
+        f.write(records)
+        del records[:]
+    f.write(records)
+
+# accounts in increasing order of address, sorted chunk_size accounts at a time into runs in temporary binary files, then merged
+# at most fan_in runs are merged at once, bigger imports first merge runs into longer runs, so the number of open files is bounded too
+def external_sort_accounts(accounts, chunk_size=2**18, fan_in=64, tmpdir=None):
+  accounts = iter(accounts)
+  runs = []
+  try:
+    while True:
+      chunk = sorted(itertools.islice(accounts, chunk_size))
+      if not chunk:
+        break
+      runs.append(_write_run(chunk, tmpdir))
+      del chunk
+    while len(runs) > fan_in:
+      merged = []
+      for i in range(0, len(runs), fan_in):
+        merged.append(_write_run(heapq.merge(*[read_accounts_binary(run) for run in runs[i:i+fan_in]]), tmpdir))
+      for run in runs:
+        os.remove(run)
+      runs = merged
+    yield from heapq.merge(*[read_accounts_binary(run) for run in runs])
+  finally:
+    for run in runs:
+      if os.path.exists(run):
+        os.remove(run)
+
+def _write_run(accounts, tmpdir):
+  fd, run = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+  os.close(fd)
+  write_accounts_binary(run, accounts)
+  return run
+
+# build a snapshot at path, see MerkleTree.save_snapshot(), from accounts in increasing order of address, with merkleize_sorted() like MerkleTree._build() and with the same node ids
+#   each array of the tree is buffered for up to buffer_size leaves, then appended to a temporary file next to path, and the files are copied into the snapshot at the end
+#   so memory doesn't depend on the number of accounts, and the snapshot can be loaded with MerkleTree.load_snapshot()
+def build_snapshot_from_sorted_accounts(sorted_accounts, path, buffer_size=2**16):
+  num_address_bits = merkle_token.num_address_bits
+  num_address_bytes = merkle_token.num_address_bytes
+  num_hash_bytes = merkle_token.num_hash_bytes
+  num_balance_bytes = merkle_token.num_balance_bytes
+  hash_lengths = current_hash_lengths()
+  hash_state = hashlib.blake2b(digest_size=num_hash_bytes)
+  leaf_addresses, leaf_balances, leaf_digests = bytearray(), array.array('Q'), bytearray()
+  digests, ends, lefts, rights = bytearray(), array.array('H'), array.array('i'), array.array('i')
+  arrays = {'addresses': leaf_addresses, 'balances': leaf_balances, 'leaf_digests': leaf_digests, 'digests': digests, 'ends': ends, 'lefts': lefts, 'rights': rights}
+  files = {name: tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path))) for name in arrays}
+  try:
+    # accounts are checked as they are hashed, since a stream can't be checked before
+    def checked(sorted_accounts):
+      previous = None
+      for address, balance in sorted_accounts:
+        if address >> num_address_bits:
+          raise ValueError("address has more than num_address_bits bits: "+hex(address))
+        if previous is not None and address <= previous:
+          raise ValueError("accounts are not in strictly increasing order of address at "+hex(previous))
+        previous = address
+        yield address, balance
+    num_leaves = 0
+    def new_leaf(i, address, balance, address_as_bytes, digest):
+      nonlocal num_leaves
+      num_leaves = i+1
+      if len(leaf_balances) >= buffer_size:
+        for name, buffered in arrays.items():
+          files[name].write(buffered)
+          del buffered[:]
+      leaf_digests.extend(digest)
+      leaf_addresses.extend(address_as_bytes)
+      leaf_balances.append(balance)
+      return ~i
+    num_nodes = 0
+    def new_node(branch_depth, left, right, digest):
+      nonlocal num_nodes
+      digests.extend(digest)
+      ends.append(branch_depth)
+      lefts.append(left)
+      rights.append(right)
+      num_nodes += 1
+      return num_nodes-1
+    leaves = hash_leaves(checked(sorted_accounts), num_address_bytes, num_balance_bytes, hash_state, new_leaf)
+    root, digest = merkleize_sorted(leaves, num_address_bits, hash_state, hash_lengths, new_node)
+    for name, buffered in arrays.items():
+      files[name].write(buffered)
+    _write_snapshot(path, num_address_bits, num_hash_bytes, root, num_leaves, num_nodes, [], [], hash_lengths, files)
+  finally:
+    for f in files.values():
+      f.close()
+
 
 
 ##########################
@@ -136,6 +1292,12 @@ def build_merkle_proof(depth,sorted_addresses,accounts,merkle_tree,tree_encoding
 
 binary_calldata_encoding_flag = 1
 
+# flip this flag to encode binary calldata in the packed format, see pack_calldata()
+packed_calldata_encoding_flag = 0
+
+# flip this flag to leave the addresses section of binary calldata empty, verifiers then recover addresses from the tree encoding and address chunks while merkleizing
+addresses_calldata_encoding_flag = 1
+
 def encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_encoding, sorted_addresses=[]):
  if not binary_calldata_encoding_flag:
   # calldata is a dictionary for prototyping, will later encode everything as a bytearray
@@ -156,7 +1318,7 @@ def encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_e
    nonlocal calldata
    calldata+=len(chunk).to_bytes(4, byteorder='little')
    calldata+=chunk
-  # encode number of bits per hash
+  # encode number of bytes per hash
   calldata+=merkle_token.num_hash_bytes.to_bytes(4, byteorder='little')
   # encode hashes as concatenation
   hashes_bytes = bytearray([])
@@ -165,6 +1327,9 @@ def encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_e
   encode_chunk(hashes_bytes)
   # encode sorted addresses, may be empty
   addresses_bytes = bytearray([])
+  # verifiers need the addresses to check them against their tree keys
+  if not addresses_calldata_encoding_flag and merkle_token.key_hash_salt is None:
+    sorted_addresses = []
   for addy in sorted_addresses:
     addy_as_bytes = int(addy,2).to_bytes(merkle_token.num_address_bytes, 'big')
     addresses_bytes += addy_as_bytes
@@ -179,8 +1344,10 @@ def encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_e
   # encode transactions
   transaction_bytes = bytearray([])
   for t in transactions:
-    transaction_bytes += t.to_bytes(merkle_token.num_transaction_bytes, byteorder='little')
-    if verbose: print("transaction:",t.to_bytes(merkle_token.num_transaction_bytes, byteorder='little').hex())
+    if type(t)!=bytes:
+      t = t.to_bytes(merkle_token.num_transaction_bytes, byteorder='little')
+    transaction_bytes += t
+    if verbose: print("transaction:",t.hex())
   #if verbose: print("transaction_bytes",transaction_bytes.hex())
   encode_chunk(transaction_bytes)
   # encode tree encoding
@@ -191,8 +1358,12 @@ def encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_e
   #tree_encoding_int = int(tree_encoding_concat, 2)
   #tree_encoding_bytes += tree_encoding_int.to_bytes((tree_encoding_int.bit_length()+7)//8, byteorder='little')
   # this is naive, but don't want to bit twiddle yet
+  # trees wider than binary have child bitmaps instead of opcodes, see merkle_token.kary_bitmaps()
   for e in tree_encoding:
-    tree_encoding_bytes += bytearray([int(e, 2)])
+    if merkle_token.tree_arity == 2:
+      tree_encoding_bytes += bytearray([int(e, 2)])
+    else:
+      tree_encoding_bytes += e.to_bytes((merkle_token.tree_arity+7)//8, byteorder='little')
   encode_chunk(tree_encoding_bytes)
   # encode address chunks
   address_chunks_bytes = bytearray([])
@@ -202,77 +1373,207 @@ def encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_e
     address_chunks_bytes += bytearray([addy_chunk_bits_length]) + addy_chunk_encoding_int.to_bytes((addy_chunk_bits_length+7)//8, byteorder='big')
   encode_chunk(address_chunks_bytes)
   # done
+  if packed_calldata_encoding_flag:
+    return pack_calldata(calldata)
   return calldata
   
   
 
+# lightweight views over the sections of binary calldata, items are only decoded when they are accessed
+
+# fixed-width items such as hashes, addresses, or transactions, each item is a memoryview slice of the calldata
+class RecordsView:
+  __slots__ = ('section', 'width')
+
+  def __init__(self, section, width):
+    self.section = section
+    self.width = width
+
+  def __len__(self):
+    return len(self.section)//self.width
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("record index out of range")
+    return self.section[i*self.width:(i+1)*self.width]
+
+  def __iter__(self):
+    section, width = self.section, self.width
+    for idx in range(0, len(section), width):
+      yield section[idx:idx+width]
+
+# address chunks, each item is (bit length, int)
+class AddressChunksView:
+  __slots__ = ('section',)
+
+  def __init__(self, section):
+    self.section = section
+
+  def __len__(self):
+    return sum(1 for chunk in self)
+
+  def __iter__(self):
+    section = self.section
+    idx = 0
+    while idx < len(section):
+      bit_length = section[idx]
+      byte_length = (bit_length+7)//8
+      yield bit_length, int.from_bytes(section[idx+1:idx+1+byte_length],'big')
+      idx += 1+byte_length
+
+# all sections of decoded calldata, balances are a sequence of ints and the tree encoding is a sequence of opcodes, both without copying
+# proof hashes are fixed-width, unless merkle_token.hash_length_schedule varies, then they are a list of memoryview slices sized by their depths
+# back references are the bitmap of left out proof hashes, see delta_calldata(), and proof hashes are only those in the calldata
+class CalldataView:
+  __slots__ = ('num_hash_bytes', 'proof_hashes', 'addresses', 'balances', 'transactions', 'tree_encoding', 'address_chunks', 'back_references')
+
+  def __init__(self, num_hash_bytes, proof_hashes, addresses, balances, transactions, tree_encoding, address_chunks, back_references=b''):
+    self.num_hash_bytes = num_hash_bytes
+    hash_lengths = merkle_token.hash_lengths(merkle_token.hash_length_schedule, num_hash_bytes, merkle_token.num_address_bits)
+    if min(hash_lengths) == max(hash_lengths) == num_hash_bytes:
+      self.proof_hashes = RecordsView(proof_hashes, num_hash_bytes)
+    else:
+      self.proof_hashes = []
+      idx = 0
+      for i, depth in enumerate(merkle_token.proof_hash_depths(tree_encoding, address_chunks, merkle_token.num_address_bits)):
+        if back_references and back_references[i>>3] >> (i&7) & 1:
+          continue
+        self.proof_hashes.append(proof_hashes[idx:idx+hash_lengths[depth]])
+        idx += hash_lengths[depth]
+    self.addresses = RecordsView(addresses, merkle_token.num_address_bytes)
+    # balances are little-endian, so a cast is only a view on little-endian machines
+    if sys.byteorder == 'little':
+      self.balances = balances.cast('Q')
+    else:
+      self.balances = array.array('Q', balances.tobytes())
+      self.balances.byteswap()
+    self.transactions = RecordsView(transactions, merkle_token.num_transaction_bytes)
+    self.tree_encoding = tree_encoding
+    self.address_chunks = AddressChunksView(address_chunks)
+    self.back_references = back_references
+
+# merkle_token.parse_calldata() with the constants in merkle_token
+def parse_calldata(calldata):
+  return merkle_token.parse_calldata(calldata, merkle_token.hash_length_schedule, merkle_token.num_address_bits, merkle_token.num_balance_bytes, merkle_token.tree_arity)
+
+# the sections are validated by merkle_token.parse_calldata(), which raises ValueError on malformed calldata
+# the number of bytes per hash is read from the calldata, and the constants in merkle_token are left as they are
 def decode_calldata(calldata):
  if not binary_calldata_encoding_flag:
   pass
  else:
+  num_hash_bytes, sections = parse_calldata(calldata)
+  calldata = CalldataView(num_hash_bytes, *sections)
+  if verbose:
+    print("proof hashes: ",[h.hex() for h in calldata.proof_hashes])
+    print("addresses",[a.hex() for a in calldata.addresses])
+    print("balances",list(calldata.balances))
+    print("transactions",[t.hex() for t in calldata.transactions])
+    print("tree encoding ",list(calldata.tree_encoding))
+    print("address chunks: ",list(calldata.address_chunks))
+    print("back references: ",calldata.back_references.hex())
+  return calldata
+
+
+
+
+
+
+# packed calldata, which merkle_token.parse_calldata() and the C contract also accept, is:
+#   a zero byte, the version byte, the number of bytes per hash as a varint,
+#   then each section as a varint length followed by the section, in the same order as above
+#   opcodes are two bits each instead of a byte, and address chunks are bit-contiguous instead of padded to bytes, see pack_opcodes() and pack_address_chunks()
+#   all varints are unsigned LEB128
+
+def encode_varint(value):
+  varint = bytearray()
+  while value >= 0x80:
+    varint.append((value&0x7f)|0x80)
+    value >>= 7
+  varint.append(value)
+  return varint
+
+# opcodes, given one per byte, become a varint number of opcodes followed by the opcodes packed four per byte, first opcode in the highest bits
+def pack_opcodes(opcodes):
+  # in hex, each one-byte opcode is a 0 followed by the opcode, so every second hex digit is a base 4 digit
+  digits = opcodes.hex()[1::2]
+  digits += '0'*(-len(digits)%4)
+  packed = int(digits,4).to_bytes(len(digits)//4,'big') if digits else b''
+  return encode_varint(len(opcodes)) + packed
+
+# address chunks, given in the legacy layout, become a varint for each chunk of num_address_bits minus its bit length
+#   followed by the bits of all chunks back to back, big-endian, padded with zeros to a byte
+# leaf chunks are the most common and the longest, so their varint is usually a single byte
+def pack_address_chunks(address_chunks):
+  lengths = bytearray()
+  bits = []
+  for bit_length, chunk in AddressChunksView(address_chunks):
+    lengths += encode_varint(merkle_token.num_address_bits-bit_length)
+    bits.append(bin(chunk|(1<<bit_length))[3:])
+  bits = ''.join(bits)
+  bits += '0'*(-len(bits)%8)
+  return lengths + (int(bits,2).to_bytes(len(bits)//8,'big') if bits else b'')
+
+# converts binary calldata to the packed format, hashes, addresses, balances, and transactions are copied as is
+def pack_calldata(calldata):
+  num_hash_bytes, sections = parse_calldata(calldata)
+  # child bitmaps of trees wider than binary are copied as is
+  if merkle_token.tree_arity == 2:
+    sections[4] = pack_opcodes(sections[4])
+  sections[5] = pack_address_chunks(sections[5])
+  # a full proof has no back references section
+  if not sections[6]:
+    del sections[6]
+  packed = bytearray([0, merkle_token.packed_calldata_version]) + encode_varint(num_hash_bytes)
+  for section in sections:
+    packed += encode_varint(len(section))
+    packed += section
+  return packed
+
+
+# delta witnesses leave out the proof hashes which the verifier knows from the last verified proof, with merkle_token.delta_witnesses set
+#   the prover keeps the keys of the nodes known after each block's proof, and passes them to delta_calldata() for the next block's proof
+#   the verifier only knows hashes from the last proof it verified, so a block whose proof wasn't verified, or a state root set by hand, needs a full proof
+
+# the keys of the nodes whose hashes a verifier knows after verifying calldata, see merkle_token.proof_hash_keys()
+def known_hash_keys(calldata):
+  num_hash_bytes, sections = parse_calldata(calldata)
+  return merkle_token.proof_hash_keys(sections[4], sections[5], merkle_token.num_address_bits)[1]
+
+# the calldata with each proof hash whose key is in known_keys replaced by a bit in the back references section, in the same format, legacy or packed
+# falls back to the full proof, i.e. calldata as is, when no proof hash is known
+def delta_calldata(calldata, known_keys):
+  num_hash_bytes, sections = parse_calldata(calldata)
+  if merkle_token.tree_arity != 2:
+    raise ValueError("delta witnesses are only for binary trees")
+  if sections[6]:
+    raise ValueError("calldata already has back references")
+  hash_lengths = merkle_token.hash_lengths(merkle_token.hash_length_schedule, num_hash_bytes, merkle_token.num_address_bits)
+  keys = merkle_token.proof_hash_keys(sections[4], sections[5], merkle_token.num_address_bits)[0]
+  proof_hashes = bytearray()
+  back_references = bytearray((len(keys)+7)//8)
   idx = 0
-  # decode number of bits per hash
-  merkle_token.num_hash_bits = int.from_bytes(calldata[idx:idx+4],'little')
-  idx+=4
-  merkle_token.num_hash_bytes = (merkle_token.num_hash_bits+7)//8
-  # decode proof hashes
-  proof_hashes = []
-  proof_hashes_length=int.from_bytes(calldata[idx:idx+4],'little')
-  idx+=4
-  for i in range(proof_hashes_length//merkle_token.num_hash_bytes):
-    proof_hashes += [calldata[idx:idx+merkle_token.num_hash_bytes].hex()]
-    idx+=merkle_token.num_hash_bytes
-  if verbose: print("proof hashes: ",proof_hashes)
-  # decode sorted addresses, may be empty
-  addresses = []
-  addresses_length=int.from_bytes(calldata[idx:idx+4],'little')
-  idx+=4
-  addresses_end = idx + addresses_length
-  while idx < addresses_end:
-    addresses += [bin(int.from_bytes(calldata[idx:idx+merkle_token.num_address_bytes],'big'))[2:].zfill(merkle_token.num_address_bits)]
-    idx += merkle_token.num_address_bytes
-  if verbose: print("addresses",addresses)
-  # decode balances
-  balances = []
-  balances_length=int.from_bytes(calldata[idx:idx+4],'little')
-  idx+=4
-  balance_bytes_end = idx + balances_length
-  while idx < balance_bytes_end:
-    balances += [int.from_bytes(calldata[idx:idx+merkle_token.num_balance_bytes],'little')]
-    idx+=merkle_token.num_balance_bytes
-  if verbose: print("balances",balances)
-  # decode transactions
-  transactions = []
-  transactions_length=int.from_bytes(calldata[idx:idx+4],'little')
-  idx+=4
-  transaction_bytes_end = idx + transactions_length
-  while idx < transaction_bytes_end:
-    transaction += [int.from_bytes(calldata[idx:idx+merkle_token.num_transaction_bytes],'little')]
-    idx+=merkle_token.num_transaction_bytes
-  if verbose: print("transactions",transactions)
-  # decode tree encoding
-  tree_encoding = []
-  tree_encoding_length=int.from_bytes(calldata[idx:idx+4],'little')
-  idx+=4
-  tree_encoding_bytes_end = idx + tree_encoding_length
-  while idx < tree_encoding_bytes_end:
-    tree_encoding += [bin(int.from_bytes(calldata[idx:idx+1],'little'))[2:].zfill(2)]
-    idx+=1
-  if verbose: print("tree encoding ",tree_encoding)
-  # decode address chunks or addresses
-  address_chunks = []
-  address_chunks_length=int.from_bytes(calldata[idx:idx+4],'little')
-  idx+=4
-  address_chunks_end = idx+address_chunks_length
-  while idx < address_chunks_end:
-    addy_chunk_bits_length = int.from_bytes(calldata[idx:idx+1],'little')
-    idx += 1
-    addy_chunk_bytes_length = (addy_chunk_bits_length+7)//8
-    address_chunks += [bin(int.from_bytes(calldata[idx:idx+addy_chunk_bytes_length],'big'))[2:].zfill(addy_chunk_bits_length)]
-    idx += addy_chunk_bytes_length
-  if verbose: print("address chunks: ",address_chunks)
-  #if verbose: print( proof_hashes, balances, tree_encoding, address_chunks)
-  return proof_hashes, balances, tree_encoding, address_chunks
+  for i, key in enumerate(keys):
+    # a key's highest bit is at the depth where its node's edge starts
+    length = hash_lengths[key.bit_length()-1]
+    if key in known_keys:
+      back_references[i>>3] |= 1 << (i&7)
+    else:
+      proof_hashes += sections[0][idx:idx+length]
+    idx += length
+  if not any(back_references):
+    return calldata
+  sections[0] = proof_hashes
+  sections[6] = back_references
+  delta = bytearray(num_hash_bytes.to_bytes(4,'little'))
+  for section in sections:
+    delta += len(section).to_bytes(4,'little')
+    delta += section
+  if calldata[0] == 0:
+    return pack_calldata(delta)
+  return delta
 
 
 
@@ -332,9 +1633,15 @@ def generate_random_test(num_hash_bits=160, num_address_bits=160, num_accounts_t
   transactions = []
 
   # get addresses appearing in transactions, but for now just choose some randomly
-  sorted_addresses = sorted(random.sample(accounts.keys(), num_accounts_in_witness))
+  sorted_addresses = sorted(random.sample(sorted(accounts), num_accounts_in_witness))
   if verbose: print(sorted_addresses)
 
+  # with tree keys, the tree and proof are over the keys, and the addresses section has the addresses in the order of their keys
+  witness_addresses = sorted_addresses
+  if merkle_token.key_hash_salt is not None:
+    accounts = keyed_accounts(accounts)
+    sorted_addresses, witness_addresses = keyed_witness(sorted_addresses)
+
   # build merkle tree
   merkle_tree = {}
   build_merkle_tree(0, sorted(accounts), accounts, merkle_tree)
@@ -370,7 +1677,7 @@ def generate_random_test(num_hash_bits=160, num_address_bits=160, num_accounts_t
                   "  total", length_of_tree_encoding_bytes+length_of_address_chunks_bytes+length_of_balances_bytes+length_of_hashes_bytes)
 
   # encode calldata
-  calldata = encode_calldata(transactions, balances, address_chunks,proof_hashes,tree_encoding,sorted_addresses=sorted_addresses)
+  calldata = encode_calldata(transactions, balances, address_chunks,proof_hashes,tree_encoding,sorted_addresses=witness_addresses)
   #if verbose: print("calldata has length",len(calldata),calldata.hex())
   #if verbose: print("merkle_root",merkle_tree[''][0])
 
@@ -380,18 +1687,38 @@ def generate_random_test(num_hash_bits=160, num_address_bits=160, num_accounts_t
   return merkle_tree, calldata
 
 
+# random accounts, plus an attacker's accounts chosen to make deep paths in the tree, see Depth Attacks in the README, also returns the attacked targets
+# each of num_targets random targets gets num_attack_accounts addresses, the i-th is the target with bit i flipped, which branches off the target's path at depth i+1
+#   so each target's path has at least num_attack_accounts branches, each with a proof hash
+# with merkle_token.key_hash_salt, the attacker can't choose keys, so these accounts are at random keys
+#   to get a key which shares its first i bits with a target's key, the attacker would instead try about 2**i addresses
+def generate_depth_attack_accounts(num_accounts_total, num_attack_accounts, num_targets=1):
+  num_address_bits = merkle_token.num_address_bits
+  accounts = {bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}
+  targets = []
+  for t in range(num_targets):
+    target = random.randint(0,2**num_address_bits-1)
+    targets.append(bin(target)[2:].zfill(num_address_bits))
+    for address in [target]+[target ^ (1<<(num_address_bits-1-i)) for i in range(num_attack_accounts)]:
+      accounts[bin(address)[2:].zfill(num_address_bits)] = random.randint(0, 2**merkle_token.num_balance_bits-1)
+  return accounts, targets
+
+
 
 #def generate_various_scout_tests(num_hash_bits=[160,256], num_address_bits=[160,256], num_accounts_total=[2**5], num_accounts_in_witness=[2]):
-def generate_various_scout_tests(num_hash_bits=[160,256], num_address_bits=[256], num_accounts_total=[1000, 10000, 100000, 1000000, 4000000], num_accounts_in_witness=[10,20,40,80,160]):
+# also reports the calldata bytes each of hash_length_schedules would save, see merkle_token.hash_length_schedule, the tests themselves have full-length hashes
+def generate_various_scout_tests(num_hash_bits=[160,256], num_address_bits=[256], num_accounts_total=[1000, 10000, 100000, 1000000, 4000000], num_accounts_in_witness=[10,20,40,80,160],
+                                 hash_length_schedules=[[(0,16),(16,20)], [(0,12),(8,16),(16,20)], [(0,16)]]):
   for numhashbits in num_hash_bits:
     for numaddybits in num_address_bits:
       for numacctstotal in num_accounts_total:
         for numacctsinwitness in num_accounts_in_witness:
           print("generating test for:",numhashbits,numaddybits, numacctstotal, numacctsinwitness)
           merkle_tree, calldata = generate_scout_test_yaml(num_hash_bits=numhashbits, num_address_bits=numaddybits, num_accounts_total=numacctstotal, num_accounts_in_witness=numacctsinwitness)
-          num_hash_bytes_total = int.from_bytes(calldata[4:8],'little')
+          decoded = decode_calldata(calldata)
+          num_hash_bytes_total = len(decoded.proof_hashes)*merkle_token.num_hash_bytes
           num_transaction_bytes_total = (numacctsinwitness//2) * merkle_token.num_transaction_bytes
-          num_account_bytes_total = merkle_token.num_address_bytes*numacctsinwitness
+          num_account_bytes_total = merkle_token.num_address_bytes*numacctsinwitness if addresses_calldata_encoding_flag else 0
           num_balance_bytes_total = merkle_token.num_balance_bytes*numacctsinwitness
           calldata_size = len(calldata) - num_account_bytes_total + num_transaction_bytes_total
           naive_calldata_size = merkle_token.num_hash_bytes*math.log(numacctstotal,2)*numacctsinwitness + len(calldata) - num_hash_bytes_total - num_account_bytes_total + num_transaction_bytes_total
@@ -399,9 +1726,405 @@ def generate_various_scout_tests(num_hash_bits=[160,256], num_address_bits=[256]
           print("hashes as percent of calldata", num_hash_bytes_total/calldata_size)
           num_non_hash_acct_tx_bytes = calldata_size-num_hash_bytes_total-num_account_bytes_total-num_transaction_bytes_total-num_balance_bytes_total
           print("tree encoding bytes: ",num_non_hash_acct_tx_bytes, "ratio",num_non_hash_acct_tx_bytes/calldata_size)
+          packed_calldata = pack_calldata(calldata)
+          print("calldata bytes:", len(calldata), "packed:", len(packed_calldata), "packed savings:", (len(calldata)-len(packed_calldata))/len(calldata))
+          depths = merkle_token.proof_hash_depths(decoded.tree_encoding, decoded.address_chunks.section, merkle_token.num_address_bits)
+          for schedule in hash_length_schedules:
+            hash_lengths = merkle_token.hash_lengths(schedule, merkle_token.num_hash_bytes, numaddybits)
+            saved = num_hash_bytes_total - sum(hash_lengths[depth] for depth in depths)
+            print("hash length schedule:", schedule, "calldata bytes saved:", saved, "savings:", saved/len(calldata), "packed savings:", saved/len(packed_calldata))
           print("\n")
 
 
+# memory retained by the accounts and merkle_tree dictionaries for build_merkle_tree() and build_merkle_proof(), versus a MerkleTree which holds both
+def benchmark_merkle_tree_memory(num_address_bits=160, num_accounts_total=[2**10, 2**14, 2**17]):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  for numacctstotal in num_accounts_total:
+    tracemalloc.start()
+    accounts = {bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(numacctstotal)}
+    accounts_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    merkle_tree = {}
+    build_merkle_tree(0, sorted(accounts), accounts, merkle_tree)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    tree = MerkleTree(accounts)
+    tree_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert tree.root_hash() == merkle_tree[''][0]
+    num_accounts = len(accounts)
+    print("accounts:", num_accounts, \
+          "  bytes per account:  merkle_tree dict", dict_bytes//num_accounts, \
+          "  accounts dict", accounts_bytes//num_accounts, \
+          "  MerkleTree", tree_bytes//num_accounts, \
+          "  ratio", (dict_bytes+accounts_bytes)/tree_bytes)
+    del accounts, merkle_tree, tree
+
+
+# throughput of the contract written in Python, in tree nodes per second, where nodes are opcodes and leaves in the merkle proof
+def benchmark_merkleization(num_hash_bits=160, num_address_bits=160, num_accounts_total=2**14, num_accounts_in_witness=[10, 100, 1000], num_runs=5):
+  for numacctsinwitness in num_accounts_in_witness:
+    merkle_tree, calldata = generate_random_test(num_hash_bits, num_address_bits, num_accounts_total, numacctsinwitness)
+    decoded = decode_calldata(calldata)
+    num_nodes = len(decoded.tree_encoding) + len(decoded.balances)
+    best = float('inf')
+    for i in range(num_runs):
+      merkle_token.set_state_root(merkle_tree[''][0])
+      start = time.perf_counter()
+      merkle_token.main(calldata)
+      best = min(best, time.perf_counter()-start)
+    print("accounts in witness:", numacctsinwitness, "  nodes:", num_nodes, "  nodes/s:", int(num_nodes/best))
+
+
+# time to build a MerkleTree with build_merkle_tree_parallel() for 1 up to all cores, versus a serial MerkleTree.from_sorted_accounts()
+def benchmark_parallel_build(num_address_bits=160, num_accounts_total=2**18, num_workers=None):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  num_workers = num_workers or range(1, os.cpu_count()+1)
+  sorted_accounts = sorted({random.randint(0,2**num_address_bits-1):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}.items())
+  start = time.perf_counter()
+  tree = MerkleTree.from_sorted_accounts(sorted_accounts)
+  serial_time = time.perf_counter()-start
+  print("accounts:", len(sorted_accounts), "  serial seconds:", serial_time)
+  for numworkers in num_workers:
+    start = time.perf_counter()
+    parallel_tree = build_merkle_tree_parallel(sorted_accounts, num_workers=numworkers)
+    parallel_time = time.perf_counter()-start
+    assert parallel_tree.root_hash() == tree.root_hash()
+    print("workers:", numworkers, "  seconds:", parallel_time, "  speedup:", serial_time/parallel_time)
+
+
+# time to build calldata for a witness, with build_merkle_proof() and encode_calldata() on the dictionary, versus MerkleTree.build_calldata()
+def benchmark_proof_generation(num_address_bits=160, num_accounts_total=[2**10, 2**14, 2**18], num_accounts_in_witness=[10, 100, 1000]):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  for numacctstotal in num_accounts_total:
+    accounts = {bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(numacctstotal)}
+    merkle_tree = {}
+    build_merkle_tree(0, sorted(accounts), accounts, merkle_tree)
+    tree = MerkleTree(accounts)
+    for numacctsinwitness in num_accounts_in_witness:
+      sorted_addresses = sorted(random.sample(sorted(accounts), min(numacctsinwitness, len(accounts))))
+      start = time.perf_counter()
+      tree_encoding, address_chunks, balances, proof_hashes = [], [], [], []
+      build_merkle_proof(0,sorted_addresses,accounts,merkle_tree,tree_encoding,address_chunks,balances,proof_hashes)
+      calldata = encode_calldata([], balances, address_chunks, proof_hashes, tree_encoding, sorted_addresses=sorted_addresses)
+      dict_time = time.perf_counter()-start
+      start = time.perf_counter()
+      tree_calldata = tree.build_calldata(sorted_addresses)
+      tree_time = time.perf_counter()-start
+      assert tree_calldata == calldata
+      print("accounts:", numacctstotal, "  accounts in witness:", len(sorted_addresses), \
+            "  build_merkle_proof+encode_calldata ms:", round(dict_time*1000, 2), \
+            "  MerkleTree.build_calldata ms:", round(tree_time*1000, 2))
+
+
+
+# time to restart from a snapshot, versus rebuilding the tree from the accounts, then to checkpoint each block of updates and replay the journal
+# loading only maps the file, so the first proof after a restart pays for reading just the pages along its paths
+def benchmark_snapshot(num_address_bits=160, num_accounts_total=2**18, num_accounts_in_witness=100, num_blocks=10, num_updates_per_block=1000, path='merkle_tree.snapshot'):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  sorted_accounts = sorted({random.randint(0,2**num_address_bits-1):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}.items())
+  start = time.perf_counter()
+  tree = MerkleTree.from_sorted_accounts(sorted_accounts)
+  build_time = time.perf_counter()-start
+  start = time.perf_counter()
+  tree.save_snapshot(path)
+  save_time = time.perf_counter()-start
+  start = time.perf_counter()
+  loaded = MerkleTree.load_snapshot(path)
+  load_time = time.perf_counter()-start
+  sorted_addresses = [bin(address)[2:].zfill(num_address_bits) for address, balance in sorted(random.sample(sorted_accounts, num_accounts_in_witness))]
+  start = time.perf_counter()
+  calldata = loaded.build_calldata(sorted_addresses)
+  first_proof_time = time.perf_counter()-start
+  assert loaded.root_hash() == tree.root_hash() and calldata == tree.build_calldata(sorted_addresses)
+  print("accounts:", len(sorted_accounts), "  snapshot bytes:", os.path.getsize(path), "  build ms:", round(build_time*1000, 1), "  save ms:", round(save_time*1000, 1), \
+        "  load ms:", round(load_time*1000, 3), "  first proof after load ms:", round(first_proof_time*1000, 2))
+  checkpoint_time = 0
+  for i in range(num_blocks):
+    updates = {bin(address)[2:].zfill(num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for address, balance in random.sample(sorted_accounts, num_updates_per_block)}
+    loaded.apply_block(updates)
+    start = time.perf_counter()
+    loaded.checkpoint(path)
+    checkpoint_time += time.perf_counter()-start
+  start = time.perf_counter()
+  restarted = MerkleTree.load_snapshot(path)
+  replay_time = time.perf_counter()-start
+  assert restarted.root_hash() == loaded.root_hash()
+  print("blocks:", num_blocks, "  updates per block:", num_updates_per_block, "  journal bytes:", os.path.getsize(path+'.journal'), \
+        "  checkpoint ms per block:", round(checkpoint_time*1000/num_blocks, 2), "  load with journal ms:", round(replay_time*1000, 1))
+  del loaded, restarted
+  os.remove(path)
+  os.remove(path+'.journal')
+
+
+
+# time and peak traced memory to import a binary account dump with external_sort_accounts() and build_snapshot_from_sorted_accounts(),
+# versus sorting it in memory and building a MerkleTree, for which memory grows with the number of accounts
+def benchmark_streaming_import(num_address_bits=160, num_accounts_total=[2**16, 2**18, 2**20], chunk_size=2**16, path='merkle_tree.snapshot'):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  for numacctstotal in num_accounts_total:
+    write_accounts_binary('accounts.bin', ((random.randint(0,2**num_address_bits-1), random.randint(0, 2**merkle_token.num_balance_bits-1)) for i in range(numacctstotal)))
+    tracemalloc.start()
+    start = time.perf_counter()
+    build_snapshot_from_sorted_accounts(external_sort_accounts(read_accounts_binary('accounts.bin'), chunk_size), path)
+    streaming_time = time.perf_counter()-start
+    streaming_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree = MerkleTree.from_sorted_accounts(sorted(read_accounts_binary('accounts.bin')))
+    in_memory_time = time.perf_counter()-start
+    in_memory_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert MerkleTree.load_snapshot(path).root_hash() == tree.root_hash()
+    print("accounts:", numacctstotal, "  streaming seconds:", round(streaming_time, 2), "  peak MB:", round(streaming_bytes/2**20, 1), \
+          "  in memory seconds:", round(in_memory_time, 2), "  peak MB:", round(in_memory_bytes/2**20, 1))
+    del tree
+  os.remove('accounts.bin')
+  os.remove(path)
+
+
+# MerkleTree.build_calldata() latency from build_latencies, mean, p50, and p99 ms
+#   blocks: each block's witness repeats repeat_fraction of the last block's accounts, and the block updates the balances of its witness and inserts a few accounts
+#   polling: between blocks, each of num_polls requests asks again for the proof of a few hot accounts, like wallets polling a proof server, and the tree doesn't change
+def benchmark_build_latency(num_address_bits=160, num_accounts_total=2**18, num_accounts_in_witness=1000, repeat_fractions=[0, 0.9], num_blocks=20,
+                            num_polls=1000, num_hot_accounts=256, num_accounts_per_poll=10):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  sorted_accounts = sorted({random.randint(0,2**num_address_bits-1):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}.items())
+  addresses = [bin(address)[2:].zfill(num_address_bits) for address, balance in sorted_accounts]
+  def report(name, tree):
+    latencies = tree.build_latencies.as_dict()
+    print(name.ljust(24), "build ms mean:", round(sum(tree.build_latencies.samples)*1000/latencies['count'], 3), \
+          "  p50:", round(latencies['p50_ms'], 3), "  p99:", round(latencies['p99_ms'], 3))
+  for repeat_fraction in repeat_fractions:
+    tree = MerkleTree.from_sorted_accounts(sorted_accounts)
+    witness = []
+    for block in range(num_blocks):
+      num_repeats = round(repeat_fraction*len(witness))
+      witness = sorted(set(random.sample(witness, num_repeats) + random.sample(addresses, num_accounts_in_witness-num_repeats)))
+      updates = {address:random.randint(0, 2**merkle_token.num_balance_bits-1) for address in witness}
+      updates.update({bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits):1 for i in range(10)})
+      tree.build_calldata(witness)
+      tree.apply_block(updates)
+    report("blocks, repeat "+str(repeat_fraction), tree)
+  tree = MerkleTree.from_sorted_accounts(sorted_accounts)
+  hot = random.sample(addresses, num_hot_accounts)
+  for i in range(num_polls):
+    tree.build_calldata(sorted(random.sample(hot, num_accounts_per_poll)))
+  report("polling", tree)
+
+# calldata bytes of back-to-back blocks with full proofs and with delta witnesses, each block's witness repeats some fraction of the last block's accounts
+# each delta witness is verified by merkle_token.main(), with every balance in the witness incremented, and the tree is updated the same way for the next block
+def benchmark_delta_witnesses(num_address_bits=160, num_accounts_total=2**16, num_accounts_in_witness=[10, 100, 1000], repeat_fractions=[0, 0.5, 0.9], num_blocks=10):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  sorted_accounts = sorted({random.randint(0,2**num_address_bits-1):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}.items())
+  addresses = [bin(address)[2:].zfill(num_address_bits) for address, balance in sorted_accounts]
+  delta_witnesses = merkle_token.delta_witnesses
+  merkle_token.delta_witnesses = 1
+  try:
+    for numacctsinwitness in num_accounts_in_witness:
+      for repeat_fraction in repeat_fractions:
+        tree = MerkleTree.from_sorted_accounts(sorted_accounts)
+        merkle_token.set_state_root(tree.root_hash())
+        witness = []
+        known_keys = set()
+        full_bytes, delta_bytes = 0, 0
+        for block in range(num_blocks):
+          num_repeats = round(repeat_fraction*len(witness))
+          witness = sorted(set(random.sample(witness, num_repeats) + random.sample(addresses, numacctsinwitness-num_repeats)))
+          calldata = tree.build_calldata(witness)
+          delta = delta_calldata(calldata, known_keys)
+          full_bytes += len(calldata)
+          delta_bytes += len(delta)
+          merkle_token.main(delta, _ChangingVerifier(range(len(witness))))
+          tree.apply_block({address:(tree.get_balance(address)+1)%2**merkle_token.num_balance_bits for address in witness})
+          if merkle_token.get_state_root() != tree.root_hash():
+            raise ValueError("main() did not verify the delta witness")
+          known_keys = known_hash_keys(calldata)
+        print("accounts in witness:", numacctsinwitness, "  repeat fraction:", repeat_fraction, "  full bytes per block:", full_bytes//num_blocks, \
+              "  delta bytes per block:", delta_bytes//num_blocks, "  saved:", str(round(100*(1-delta_bytes/full_bytes), 1))+"%")
+  finally:
+    merkle_token.delta_witnesses = delta_witnesses
+
+
+
+# throughput of decode_calldata() in MB/s, both for decoding alone and for decoding then reading every item like a consumer would
+def benchmark_calldata_decoding(num_address_bits=160, num_accounts_total=2**16, num_accounts_in_witness=[100, 1000, 10000], num_runs=5):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  accounts = {bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}
+  tree = MerkleTree(accounts)
+  for numacctsinwitness in num_accounts_in_witness:
+    sorted_addresses = sorted(random.sample(sorted(accounts), min(numacctsinwitness, len(accounts))))
+    transactions = [random.randint(0, 2**merkle_token.num_transaction_bits-1) for i in range(len(sorted_addresses))]
+    calldata = bytes(tree.build_calldata(sorted_addresses, transactions))
+    decode_best, consume_best = float('inf'), float('inf')
+    for i in range(num_runs):
+      start = time.perf_counter()
+      decoded = decode_calldata(calldata)
+      decode_best = min(decode_best, time.perf_counter()-start)
+      start = time.perf_counter()
+      decoded = decode_calldata(calldata)
+      for section in (decoded.proof_hashes, decoded.addresses, decoded.transactions, decoded.address_chunks):
+        for item in section:
+          pass
+      sum(decoded.balances)
+      sum(decoded.tree_encoding)
+      consume_best = min(consume_best, time.perf_counter()-start)
+    megabytes = len(calldata)/10**6
+    print("accounts in witness:", len(sorted_addresses), "  calldata bytes:", len(calldata), \
+          "  decode MB/s:", round(megabytes/decode_best, 1), "  decode and read all items MB/s:", round(megabytes/consume_best, 1))
+
+
+
+# hash calls and time to merkleize, when balances change for some fraction of the accounts in the witness
+# when they all change, every node is hashed twice, which is what merkleization always did before unchanged subtrees were hashed once
+def benchmark_unchanged_subtrees(num_hash_bits=160, num_address_bits=160, num_accounts_total=2**16, num_accounts_in_witness=[10,20,40,80,160], changed_fractions=[0, 0.1, 0.5, 1], num_runs=5):
+  for numacctsinwitness in num_accounts_in_witness:
+    merkle_tree, calldata = generate_random_test(num_hash_bits, num_address_bits, num_accounts_total, numacctsinwitness)
+    for changed_fraction in changed_fractions:
+      changed_leaves = random.sample(range(numacctsinwitness), round(changed_fraction*numacctsinwitness))
+      counting_verifier = _CountingVerifier(changed_leaves)
+      counting_verifier.verify(calldata, merkle_tree[''][0])
+      best = float('inf')
+      for i in range(num_runs):
+        verifier = _ChangingVerifier(changed_leaves)
+        start = time.perf_counter()
+        verifier.verify(calldata, merkle_tree[''][0])
+        best = min(best, time.perf_counter()-start)
+      print("accounts in witness:", numacctsinwitness, "  changed:", len(changed_leaves), "  hash calls:", counting_verifier.num_hash_calls, "  ms:", round(best*1000, 3))
+
+# a Verifier which, instead of executing transactions, increments the balances of the given leaves, by index in the witness
+class _ChangingVerifier(merkle_token.Verifier):
+  __slots__ = ('changed_leaves',)
+
+  def __init__(self, changed_leaves):
+    merkle_token.Verifier.__init__(self)
+    self.changed_leaves = changed_leaves
+
+  def execute_transactions(self):
+    B = self.num_balance_bytes
+    new_balances = bytearray(self.balances)
+    for leaf in self.changed_leaves:
+      balance = int.from_bytes(new_balances[leaf*B:(leaf+1)*B],'little')
+      new_balances[leaf*B:(leaf+1)*B] = ((balance+1)%(1<<(8*B))).to_bytes(B,'little')
+    self.new_balances = new_balances
+
+# also counts calls to the hash function
+class _CountingVerifier(_ChangingVerifier):
+  __slots__ = ('num_hash_calls',)
+
+  def __init__(self, changed_leaves):
+    _ChangingVerifier.__init__(self, changed_leaves)
+    self.num_hash_calls = 0
+
+  def hash_bytes(self, left, right=b''):
+    self.num_hash_calls += 1
+    return _ChangingVerifier.hash_bytes(self, left, right)
+
+
+
+# proof hashes, hash calls, calldata bytes, and verification time for each tree arity, see merkle_token.tree_arity, with the same accounts and witness for each
+# wider trees have fewer levels, so fewer hash calls, but more sibling hashes per level, so bigger proofs
+def benchmark_tree_arity(num_hash_bits=160, num_address_bits=160, num_accounts_total=2**16, num_accounts_in_witness=[10, 100, 1000], arities=[2, 4, 16, 256], num_runs=3):
+  merkle_token.num_hash_bits = num_hash_bits
+  merkle_token.num_hash_bytes = (num_hash_bits+7)//8
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  accounts = {bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}
+  witnesses = [sorted(random.sample(sorted(accounts), numacctsinwitness)) for numacctsinwitness in num_accounts_in_witness]
+  try:
+    for arity in arities:
+      merkle_token.tree_arity = arity
+      merkle_tree = {}
+      root = build_merkle_tree(0, sorted(accounts), accounts, merkle_tree)
+      for sorted_addresses in witnesses:
+        tree_encoding, address_chunks, balances, proof_hashes = [], [], [], []
+        build_merkle_proof(0, sorted_addresses, accounts, merkle_tree, tree_encoding, address_chunks, balances, proof_hashes)
+        calldata = bytes(encode_calldata([], balances, address_chunks, proof_hashes, tree_encoding, sorted_addresses=sorted_addresses))
+        counting_verifier = _CountingVerifier([])
+        counting_verifier.verify(calldata, root)
+        best = float('inf')
+        for i in range(num_runs):
+          start = time.perf_counter()
+          merkle_token.Verifier().verify(calldata, root)
+          best = min(best, time.perf_counter()-start)
+        print("arity:", arity, "  accounts in witness:", len(sorted_addresses), "  proof hashes:", len(proof_hashes), \
+              "  hash calls:", counting_verifier.num_hash_calls, "  calldata bytes:", len(calldata), "  ms:", round(best*1000, 2))
+  finally:
+    merkle_token.tree_arity = 2
+
+
+
+# proof hashes, calldata bytes, and verification time under a depth attack, see generate_depth_attack_accounts(), with addresses as keys and with hashed keys, see merkle_token.key_hash_salt
+# the witness is the attacked targets, so with addresses as keys its proof grows with the attack, and with hashed keys it stays about log2 of the number of accounts deep
+def benchmark_depth_attack(num_hash_bits=160, num_address_bits=160, num_accounts_total=2**14, num_attack_accounts=[0, 40, 159], num_targets=10, num_runs=3):
+  merkle_token.num_hash_bits = num_hash_bits
+  merkle_token.num_hash_bytes = (num_hash_bits+7)//8
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  try:
+    for numattackaccts in num_attack_accounts:
+      accounts, targets = generate_depth_attack_accounts(num_accounts_total, numattackaccts, num_targets)
+      for salt in (None, os.urandom(16)):
+        merkle_token.key_hash_salt = salt
+        if salt is None:
+          tree_accounts, sorted_keys, witness_addresses = accounts, sorted(targets), sorted(targets)
+        else:
+          tree_accounts = keyed_accounts(accounts)
+          sorted_keys, witness_addresses = keyed_witness(targets)
+        merkle_tree = {}
+        root = build_merkle_tree(0, sorted(tree_accounts), tree_accounts, merkle_tree)
+        # a target's proof alone has one hash per branch on its path
+        target_proof_hashes = []
+        build_merkle_proof(0, sorted_keys[:1], tree_accounts, merkle_tree, [], [], [], target_proof_hashes)
+        tree_encoding, address_chunks, balances, proof_hashes = [], [], [], []
+        build_merkle_proof(0, sorted_keys, tree_accounts, merkle_tree, tree_encoding, address_chunks, balances, proof_hashes)
+        calldata = bytes(encode_calldata([], balances, address_chunks, proof_hashes, tree_encoding, sorted_addresses=witness_addresses))
+        best = float('inf')
+        for i in range(num_runs):
+          start = time.perf_counter()
+          assert merkle_token.Verifier().verify(calldata, root) == root
+          best = min(best, time.perf_counter()-start)
+        print("attack accounts per target:", numattackaccts, "  keys:", "addresses" if salt is None else "hashed", "  target proof hashes:", len(target_proof_hashes), \
+              "  witness proof hashes:", len(proof_hashes), "  calldata bytes:", len(calldata), "  ms:", round(best*1000, 2))
+  finally:
+    merkle_token.key_hash_salt = None
+
+
+# time for Verifier.verify_parallel() with a process pool, versus the serial Verifier.verify(), checking that the post-state roots are identical
+# the top split_levels levels of 11 opcodes are split off, which gives up to 2**split_levels subproofs, by default about twice the number of workers
+def benchmark_parallel_merkleization(num_hash_bits=160, num_address_bits=160, num_accounts_total=2**16, num_accounts_in_witness=[10, 100, 1000, 4000], num_workers=None, split_levels=None, num_runs=3):
+  num_workers = num_workers or os.cpu_count()
+  split_levels = split_levels or num_workers.bit_length()+1
+  for numacctsinwitness in num_accounts_in_witness:
+    merkle_tree, calldata = generate_random_test(num_hash_bits, num_address_bits, num_accounts_total, numacctsinwitness)
+    calldata = bytes(calldata)
+    pre_root = merkle_tree[''][0]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+      merkle_token.Verifier().verify_parallel(calldata, pre_root, executor, split_levels)
+      serial_time, parallel_time = float('inf'), float('inf')
+      for i in range(num_runs):
+        start = time.perf_counter()
+        serial_root = merkle_token.Verifier().verify(calldata, pre_root)
+        serial_time = min(serial_time, time.perf_counter()-start)
+        start = time.perf_counter()
+        parallel_root = merkle_token.Verifier().verify_parallel(calldata, pre_root, executor, split_levels)
+        parallel_time = min(parallel_time, time.perf_counter()-start)
+        assert parallel_root == serial_root
+    print("accounts in witness:", numacctsinwitness, "  workers:", num_workers, "  serial ms:", round(serial_time*1000, 2), \
+          "  parallel ms:", round(parallel_time*1000, 2), "  speedup:", round(serial_time/parallel_time, 2))
+
+
 
 #####################
 # Handwritten Tests #
@@ -515,11 +2238,340 @@ def test_handwritten(case):
   decode_calldata(calldata)
   
   # call the contract written in python
-  #merkle_token.main(calldata)
+  merkle_token.main(calldata)
+  print("state root after contract call:", merkle_token.get_state_root())
+
+
+# random balance updates, inserts, and deletes applied to a MerkleTree, checking against a tree rebuilt from scratch after each block
+def test_incremental_merkle_tree(num_address_bits=160, num_accounts_total=2**10, num_blocks=10, num_updates_per_block=20):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  accounts = {bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}
+  tree = MerkleTree(accounts)
+  for block in range(num_blocks):
+    updates = {}
+    for address in random.sample(sorted(accounts), num_updates_per_block):
+      updates[address] = random.choice([None, random.randint(0, 2**merkle_token.num_balance_bits-1)])
+    for i in range(num_updates_per_block):
+      updates[bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits)] = random.randint(0, 2**merkle_token.num_balance_bits-1)
+    for address in updates:
+      if updates[address] is None:
+        del accounts[address]
+      else:
+        accounts[address] = updates[address]
+    tree.apply_block(updates)
+    merkle_tree = {}
+    build_merkle_tree(0, sorted(accounts), accounts, merkle_tree)
+    assert tree.root_hash() == merkle_tree[''][0]
+    assert dict(tree.items()) == merkle_tree
+    print("block",block,"root",tree.root_hash())
+  # each build_calldata() and build_calldatas() call records its latency
+  witness = sorted(random.sample(sorted(accounts), 8))
+  assert tree.build_calldatas([witness, witness[:4]]) == [tree.build_calldata(witness), tree.build_calldata(witness[:4])]
+  assert tree.build_latencies.count == 3 and tree.build_latencies.as_dict()['p50_ms'] is not None
+  # a block which deletes a missing account, or sets a balance out of range, raises and leaves the tree unchanged
+  root = tree.root_hash()
+  address = sorted(accounts)[0]
+  missing = bin(random.randint(0,2**num_address_bits-1))[2:].zfill(num_address_bits)
+  for updates in ({address:None, missing:None}, {address:1, missing:2**merkle_token.num_balance_bits}):
+    try:
+      tree.apply_block(updates)
+      assert False, "bad block was applied"
+    except (KeyError, ValueError):
+      pass
+    assert tree.root_hash() == root and dict(tree.items()) == merkle_tree
+  print("bad blocks rejected")
+
+
+# a checkpoint torn by a crash, or garbled, is dropped when the snapshot is loaded, and checkpoints after it load as if it had never been written
+def test_snapshot_journal(num_accounts_total=2**10, num_updates_per_block=20, path=None):
+  if path is None:
+    path = os.path.join(tempfile.mkdtemp(), 'merkle_tree.snapshot')
+  accounts = {bin(random.randint(0,2**merkle_token.num_address_bits-1))[2:].zfill(merkle_token.num_address_bits):random.randint(0, 2**merkle_token.num_balance_bits-1) for i in range(num_accounts_total)}
+  tree = MerkleTree(accounts)
+  tree.save_snapshot(path)
+  def random_block():
+    updates = {address:random.randint(0, 2**merkle_token.num_balance_bits-1) for address in random.sample(sorted(accounts), num_updates_per_block)}
+    updates[bin(random.randint(0,2**merkle_token.num_address_bits-1))[2:].zfill(merkle_token.num_address_bits)] = random.randint(0, 2**merkle_token.num_balance_bits-1)
+    return updates
+  tree.apply_block(random_block())
+  tree.checkpoint(path)
+  complete_length = os.path.getsize(path+'.journal')
+  complete_root = tree.root_hash()
+  for damage in ('torn', 'garbled'):
+    # the next checkpoint is written by a tree which then crashes, leaving part of the record, or all of it with a byte flipped
+    crashed = MerkleTree.load_snapshot(path)
+    crashed.apply_block(random_block())
+    crashed.checkpoint(path)
+    with open(path+'.journal', 'r+b') as f:
+      if damage == 'torn':
+        f.truncate(complete_length+(os.path.getsize(path+'.journal')-complete_length)//2)
+      else:
+        f.seek(complete_length+journal_header.size)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0]^1]))
+    del crashed
+    loaded = MerkleTree.load_snapshot(path)
+    assert loaded.root_hash() == complete_root and os.path.getsize(path+'.journal') == complete_length
+    # a checkpoint after the restart follows the last complete record, so the next load replays it
+    loaded.apply_block(random_block())
+    loaded.checkpoint(path)
+    reloaded = MerkleTree.load_snapshot(path)
+    assert reloaded.root_hash() == loaded.root_hash() and dict(reloaded.items()) == dict(loaded.items())
+    complete_length = os.path.getsize(path+'.journal')
+    complete_root = loaded.root_hash()
+    del loaded, reloaded
+    print(damage, "checkpoint dropped on load")
+  os.remove(path)
+  os.remove(path+'.journal')
+
+
+
 
 
 
+# packed calldata with a padding bit set, after the opcodes or after the address chunk bits, or with a varint longer than needed, is rejected
+# the address chunk section is last in packed calldata, so its padding is in the last byte, and the opcode padding is in the byte before the chunk section's length
+def test_packed_calldata_padding(num_accounts_total=2**10):
+  # a witness whose opcodes and address chunk bits both end mid-byte
+  while True:
+    merkle_tree, calldata = generate_random_test(merkle_token.num_hash_bits, merkle_token.num_address_bits, num_accounts_total, random.randint(1, 20))
+    num_hash_bytes, sections = parse_calldata(bytes(calldata))
+    num_chunk_bits = sum(bit_length for bit_length, chunk in AddressChunksView(sections[5]))
+    if len(sections[4])%4 and num_chunk_bits%8:
+      break
+  root = merkle_tree[''][0]
+  packed = pack_calldata(bytes(calldata))
+  assert merkle_token.Verifier().verify(packed, root) == root
+  address_chunks = pack_address_chunks(sections[5])
+  last_opcode_byte = len(packed)-len(address_chunks)-len(encode_varint(len(address_chunks)))-1
+  for idx in (len(packed)-1, last_opcode_byte):
+    bad_packed = bytearray(packed)
+    bad_packed[idx] |= 1
+    try:
+      merkle_token.Verifier().verify(bytes(bad_packed), root)
+      assert False, "nonzero padding bits were accepted"
+    except ValueError as e:
+      assert "padding" in str(e)
+  # the number of bytes per hash as a two byte varint
+  bad_packed = packed[:2]+bytes([packed[2]|0x80, 0])+packed[3:]
+  try:
+    merkle_token.Verifier().verify(bytes(bad_packed), root)
+    assert False, "a long varint was accepted"
+  except ValueError as e:
+    assert str(e) == "varint is longer than needed"
+  print("packed calldata padding rejected")
+
+# verifies independent blocks at once with a Verifier each, in a thread pool and a process pool, checking the post-state roots
+def test_concurrent_verification(num_blocks=16, num_accounts_total=2**12, num_accounts_in_witness=20, num_workers=None):
+  blocks = []
+  for i in range(num_blocks):
+    merkle_tree, calldata = generate_random_test(merkle_token.num_hash_bits, merkle_token.num_address_bits, num_accounts_total, num_accounts_in_witness)
+    blocks.append((bytes(calldata), merkle_tree[''][0]))
+  calldatas = [calldata for calldata, pre_root in blocks]
+  pre_roots = [pre_root for calldata, pre_root in blocks]
+  # transactions are not executed yet, so each post-state root is the pre-state root
+  for executor_class in (concurrent.futures.ThreadPoolExecutor, concurrent.futures.ProcessPoolExecutor):
+    with executor_class(max_workers=num_workers) as executor:
+      post_roots = list(executor.map(_verify_block, calldatas, pre_roots, [merkle_token.current_constants()]*num_blocks))
+    assert post_roots == pre_roots
+    print(executor_class.__name__, "verified", len(post_roots), "blocks")
+
+def _verify_block(calldata, pre_root, constants):
+  return merkle_token.Verifier(constants=constants).verify(calldata, pre_root)
+
+# Verifier.verify_parallel() with workers started by spawn, which don't see constants set at runtime, so they must get the verifier's
+def test_parallel_merkleization(num_accounts_total=2**12, num_accounts_in_witness=200, num_workers=2):
+  hash_length_schedule = merkle_token.hash_length_schedule
+  merkle_token.hash_length_schedule = [(0, 12), (16, 20)]
+  try:
+    merkle_tree, calldata = generate_random_test(160, 256, num_accounts_total, num_accounts_in_witness)
+    calldata = bytes(calldata)
+    pre_root = merkle_tree[''][0]
+    serial_root = merkle_token.Verifier().verify(calldata, pre_root)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+      assert merkle_token.Verifier().verify_parallel(calldata, pre_root, executor) == serial_root
+  finally:
+    merkle_token.hash_length_schedule = hash_length_schedule
+  print("parallel merkleization in spawned workers ok")
+
+
+
+#######################
+# Signed Transactions #
+#######################
+
+# a transaction record for merkle_token.Verifier.execute_transactions(), signed with the sender's Ed25519 secret
+#   sender_index is the sender's index in the sorted addresses of the witness, recipient is an address as a bit string, pre_root is the pre-state root as hex
+#   index is the transaction's index in the block, which is signed, see merkle_token.Verifier.verify_signatures()
+def make_transaction(secret, sender_index, recipient, amount, pre_root, index):
+  signed = int(recipient,2).to_bytes(32,'big') + amount.to_bytes(8,'little')
+  return bytes([sender_index]) + signed + merkle_token_ed25519.sign(secret, bytes.fromhex(pre_root)+index.to_bytes(4,'little')+signed)
+
+# random accounts whose addresses are Ed25519 public keys, so 256-bit addresses
+# returns the secrets by address, and the accounts
+def generate_signing_accounts(num_accounts):
+  secrets = {}
+  for i in range(num_accounts):
+    secret = os.urandom(32)
+    address = int.from_bytes(merkle_token_ed25519.public_key(secret),'big')
+    secrets[bin(address)[2:].zfill(256)] = secret
+  accounts = {address:random.randint(2**40, 2**48) for address in secrets}
+  return secrets, accounts
+
+# random transfers among accounts of the witness, checking the post-state root against MerkleTree.apply_block(), and that a bad signature or overspending fails
+def test_signed_transactions(num_accounts_total=64, num_accounts_in_witness=8, num_transactions=12, num_blocks=3):
+  merkle_token.num_address_bits = 256
+  merkle_token.num_address_bytes = 32
+  secrets, accounts = generate_signing_accounts(num_accounts_total)
+  tree = MerkleTree(accounts)
+  for block in range(num_blocks):
+    pre_root = tree.root_hash()
+    sorted_addresses = sorted(random.sample(sorted(accounts), num_accounts_in_witness))
+    transactions = []
+    updates = {}
+    for i in range(num_transactions):
+      sender_index = random.randrange(num_accounts_in_witness)
+      sender, recipient = sorted_addresses[sender_index], random.choice(sorted_addresses)
+      amount = random.randint(0, 2**20)
+      transactions.append(make_transaction(secrets[sender], sender_index, recipient, amount, pre_root, i))
+      updates[sender] = updates.get(sender, accounts[sender]) - amount
+      updates[recipient] = updates.get(recipient, accounts[recipient]) + amount
+    calldata = bytes(tree.build_calldata(sorted_addresses, transactions))
+    post_root = merkle_token.Verifier().verify(calldata, pre_root)
+    tree.apply_block(updates)
+    accounts.update(updates)
+    assert post_root == tree.root_hash()
+    # flip a bit of the last signature
+    bad_calldata = bytes(_replace_transaction(calldata, transactions[-1], transactions[-1][:-1]+bytes([transactions[-1][-1]^1])))
+    try:
+      merkle_token.Verifier().verify(bad_calldata, pre_root)
+      assert False, "bad signature was accepted"
+    except ValueError as e:
+      assert str(e) == "invalid signature"
+    print("block",block,"transactions",len(transactions),"post-state root",post_root)
+  # overspending, signed correctly
+  sender = sorted_addresses[0]
+  overspend = make_transaction(secrets[sender], 0, sender, accounts[sender]+1, tree.root_hash(), 0)
+  calldata = bytes(tree.build_calldata(sorted_addresses, [overspend]))
+  try:
+    merkle_token.Verifier().verify(calldata, tree.root_hash())
+    assert False, "overspending was accepted"
+  except ValueError as e:
+    assert str(e) == "balance underflow"
+  # a signed transfer repeated in the block, or moved to another index, would debit the sender again
+  pre_root = tree.root_hash()
+  transfer = make_transaction(secrets[sender], 0, sorted_addresses[1], 1, pre_root, 0)
+  other = make_transaction(secrets[sorted_addresses[1]], 1, sender, 1, pre_root, 0)
+  assert merkle_token.Verifier().verify(bytes(tree.build_calldata(sorted_addresses, [transfer])), pre_root)
+  for transactions, error in (([transfer, transfer], "duplicate transaction"), ([other, transfer], "invalid signature")):
+    calldata = bytes(tree.build_calldata(sorted_addresses, transactions))
+    try:
+      merkle_token.Verifier().verify(calldata, pre_root)
+      assert False, "replayed transaction was accepted"
+    except ValueError as e:
+      assert str(e) == error
+  print("bad signature, overspending, and replays rejected")
+
+# with merkle_token.key_hash_salt, signed transfers in a tree of keyed_accounts(), checking the post-state root against MerkleTree.apply_block() at the keys
+# calldata with the wrong salt, without the addresses section, or with its addresses out of the order of their keys fails, and MerkleTree.build_calldata() refuses to build it
+def test_key_hashing(num_accounts_total=64, num_accounts_in_witness=8, num_transactions=6):
+  merkle_token.num_address_bits = 256
+  merkle_token.num_address_bytes = 32
+  salt = merkle_token.key_hash_salt
+  merkle_token.key_hash_salt = os.urandom(16)
+  try:
+    secrets, accounts = generate_signing_accounts(num_accounts_total)
+    keyed = keyed_accounts(accounts)
+    tree = MerkleTree(keyed)
+    merkle_tree = {}
+    pre_root = tree.root_hash()
+    assert build_merkle_tree(0, sorted(keyed), keyed, merkle_tree) == pre_root
+    keys, sorted_addresses = keyed_witness(random.sample(sorted(accounts), num_accounts_in_witness))
+    transactions = []
+    updates = {}
+    for i in range(num_transactions):
+      sender_index = random.randrange(num_accounts_in_witness)
+      sender, recipient = sorted_addresses[sender_index], random.choice(sorted_addresses)
+      amount = random.randint(0, 2**20)
+      transactions.append(make_transaction(secrets[sender], sender_index, recipient, amount, pre_root, i))
+      updates[sender] = updates.get(sender, accounts[sender]) - amount
+      updates[recipient] = updates.get(recipient, accounts[recipient]) + amount
+    tree_encoding, address_chunks, balances, proof_hashes = tree.build_proof(keys)
+    calldata = bytes(encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_encoding, sorted_addresses=sorted_addresses))
+    post_root = merkle_token.Verifier().verify(calldata, pre_root)
+    tree.apply_block({tree_key(address):balance for address, balance in updates.items()})
+    assert post_root == tree.root_hash()
+    print("transactions", len(transactions), "post-state root", post_root)
+    bad_calldatas = [bytes(encode_calldata(transactions, balances, address_chunks, proof_hashes, tree_encoding, sorted_addresses=addresses)) for addresses in ([], sorted_addresses[::-1])]
+    for bad_salt, bad_calldata in ((os.urandom(16), calldata), (None, bad_calldatas[0]), (None, bad_calldatas[1])):
+      verifier = merkle_token.Verifier(constants=merkle_token.current_constants()[:-1]+(bad_salt or merkle_token.key_hash_salt,))
+      try:
+        verifier.verify(bad_calldata, pre_root)
+        assert False, "bad keyed calldata was accepted"
+      except ValueError:
+        pass
+    try:
+      tree.build_calldata(keys)
+      assert False, "MerkleTree built calldata with hashed keys"
+    except ValueError as e:
+      assert "key_hash_salt" in str(e)
+    print("wrong salt, missing or misordered addresses, and MerkleTree calldata rejected")
+  finally:
+    merkle_token.key_hash_salt = salt
+
+# calldata with one transaction record replaced
+def _replace_transaction(calldata, transaction, replacement):
+  idx = calldata.index(transaction)
+  return calldata[:idx] + replacement + calldata[idx+len(transaction):]
+
+# transactions/s for executing transactions one by one, and in bulk with numpy if it is available, checking that both give the same balances and credits
+# signatures are random bytes, since only execution is timed
+def benchmark_transaction_execution(num_address_bits=160, num_accounts_in_witness=256, num_transactions=[100, 1000, 10000], num_runs=3):
+  merkle_token.num_address_bits = num_address_bits
+  merkle_token.num_address_bytes = (num_address_bits+7)//8
+  addresses = [random.randint(0,2**num_address_bits-1) for i in range(num_accounts_in_witness)]
+  balances = b''.join(random.randint(2**62, 2**63).to_bytes(merkle_token.num_balance_bytes,'little') for address in addresses)
+  for num in num_transactions:
+    transactions = b''.join(bytes([random.randrange(num_accounts_in_witness)]) + random.choice(addresses).to_bytes(32,'big') \
+                            + random.randint(0, 2**32).to_bytes(8,'little') + os.urandom(64) for i in range(num))
+    execute = {"one by one":merkle_token.Verifier.execute_transactions_one_by_one}
+    if merkle_token.numpy is not None:
+      execute["in bulk"] = merkle_token.Verifier.execute_transactions_in_bulk
+    results = []
+    for name, execute_transactions in execute.items():
+      best = float('inf')
+      for i in range(num_runs):
+        verifier = merkle_token.Verifier()
+        verifier.balances = balances
+        verifier.transactions = transactions
+        start = time.perf_counter()
+        execute_transactions(verifier)
+        best = min(best, time.perf_counter()-start)
+      results.append((bytes(verifier.new_balances), verifier.credits))
+      print("transactions:", num, "  execution:", name, "  transactions/s:", round(num/best))
+    assert all(result == results[0] for result in results)
 
+# signatures/s for each signature verifier from merkle_token_ed25519, given to merkle_token.Verifier
+def benchmark_signature_verification(num_signatures=[16, 64, 256], num_workers=None, num_runs=3):
+  pre_root = os.urandom(merkle_token.num_hash_bytes)
+  items = []
+  for i in range(max(num_signatures)):
+    secret = os.urandom(32)
+    message = pre_root + os.urandom(40)
+    items.append((merkle_token_ed25519.public_key(secret), message, merkle_token_ed25519.sign(secret, message)))
+  with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+    signature_verifiers = {"each":merkle_token_ed25519.verify_each, "batch":merkle_token_ed25519.verify_batch,
+                           "batch in pool":functools.partial(merkle_token_ed25519.verify_batch_in_pool, executor=executor)}
+    for num in num_signatures:
+      for name, signature_verifier in signature_verifiers.items():
+        best = float('inf')
+        for i in range(num_runs):
+          start = time.perf_counter()
+          assert signature_verifier(items[:num])
+          best = min(best, time.perf_counter()-start)
+        print("signatures:", num, "  verifier:", name, "  signatures/s:", round(num/best))
 
 
 if __name__ == "__main__":
@@ -528,3 +2580,25 @@ if __name__ == "__main__":
   generate_various_scout_tests()
   #generate_scout_test_yaml()
   #test_handwritten(7)
+  #test_incremental_merkle_tree()
+  #test_snapshot_journal()
+  #test_packed_calldata_padding()
+  #test_concurrent_verification()
+  #test_parallel_merkleization()
+  #benchmark_merkle_tree_memory()
+  #benchmark_merkleization()
+  #benchmark_parallel_build()
+  #benchmark_proof_generation()
+  #benchmark_snapshot()
+  #benchmark_build_latency()
+  #benchmark_streaming_import()
+  #benchmark_delta_witnesses()
+  #benchmark_calldata_decoding()
+  #benchmark_unchanged_subtrees()
+  #benchmark_parallel_merkleization()
+  #benchmark_tree_arity()
+  #benchmark_depth_attack()
+  #test_signed_transactions()
+  #test_key_hashing()
+  #benchmark_signature_verification()
+  #benchmark_transaction_execution()